@@ -2,11 +2,22 @@ import os
 import re
 
 import time
-from typing import Callable
+from typing import Callable, List, Optional
 
-from openai import OpenAI
+from core.deadline import Deadline
+from core.exceptions import GenerationCancelled, LLMCacheMiss
+from core.llm_cache import LLMResponseCache
+from llm_client import get_llm_transport, rate_limiter
+from prompt_budget import PromptBudget
+from user_config import global_config
 
-from core.exceptions import GenerationCancelled
+# shared by every agent (and, through SQLite, every server process) so identical prompts are answered once
+llm_cache = LLMResponseCache(
+    path=global_config.get('llm_cache', 'path', fallback=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'llm_cache.sqlite3')),
+    mode=os.environ.get('LLM_CACHE_MODE') or global_config.get('llm_cache', 'mode', fallback='on'),
+    max_bytes=global_config.getint('llm_cache', 'max_size_mb', fallback=512) * 1024 * 1024,
+    max_age=global_config.getfloat('llm_cache', 'max_age_days', fallback=30) * 24 * 3600,
+)
 
 
 class Agent:
@@ -14,18 +25,26 @@ class Agent:
         self.system_prompt = None
         self.model_name = llm_name
 
-        self.client = OpenAI(
-            api_key=os.environ.get('OPEN_AI_KEY'), 
-            base_url=os.environ.get('OPENAI_BASE_URL')
-            )
+        # pooled connections shared by all agents and sessions
+        self.transport = get_llm_transport()
+        self.client = self.transport.client
+        self.request_timeout = self.transport.request_timeout
         self.temp = 0.0  # for GPT-4o. For DeepSeek-R1-Distill-Qwen-7B, the temperature is fixed to 0.5
         self.top_p = 0.1
         self.seed = 1203
         self.max_completion_tokens = 5120
         self.cancel_check: Callable[[], bool] = lambda: False
+        # the session's deadline: no call outlives it, and request_timeout is cut to the time left
+        self.deadline: Optional[Deadline] = None
+        # waiting calls are served round-robin across keys, so one session's retries cannot starve the others
+        self.rate_limit_key = 'default'
+        # called with (messages, '') when a streamed completion starts, (messages, text) per chunk and (messages, None) at the end
+        self.stream_callback: Optional[Callable[[List[dict], Optional[str]], None]] = None
+        self._visible_messages: List[dict] = []
 
     def get_response(self, messages, n=1, skip_deepseek_think: bool=False):
         self._check_cancel()
+        self._visible_messages = messages
         if self.model_name == 'gpt-4o' or self.model_name == 'gpt-3.5-turbo':
             if self.system_prompt:
                 messages = [{'role': 'system', 'content': self.system_prompt}] + messages
@@ -37,12 +56,14 @@ class Agent:
         elif self.model_name == 'o1-mini-2024-09-12':
             if self.system_prompt:
                 messages = [{'role': 'user', 'content': self.system_prompt}] + messages
+            n_empty = 0
             while True:
                 response = self._get_gpt_o1_mini_response(messages, n=n)
                 if len(response) > 0:
                     break
-                print('\nsleeping for 10 seconds... Then retrying...\n\n')
-                time.sleep(10)
+                print('\nEmpty response...')
+                self._wait_before_retry(None, n_empty)
+                n_empty += 1
         else:
             raise ValueError(f"Unknown LLM name: {self.model_name}")
         return response
@@ -53,9 +74,94 @@ class Agent:
         else:
             self.cancel_check = lambda: False
 
+    def set_deadline(self, deadline: Optional[Deadline]) -> None:
+        self.deadline = deadline
+
+    def set_stream_callback(self, callback: Optional[Callable[[List[dict], Optional[str]], None]]) -> None:
+        self.stream_callback = callback
+
+    def set_rate_limit_key(self, key: Optional[str]) -> None:
+        self.rate_limit_key = key or 'default'
+
+    def prompt_budget(self) -> PromptBudget:
+        return PromptBudget.for_model(self.model_name, self.max_completion_tokens, self.system_prompt)
+
     def _check_cancel(self) -> None:
+        if self.deadline is not None:
+            self.deadline.check()
         if self.cancel_check and self.cancel_check():
             raise GenerationCancelled()
+
+    def _wait_before_retry(self, error: Optional[Exception], attempt: int) -> None:
+        """Sleep for the provider's Retry-After, or a jittered exponential backoff, while still honouring /session/stop."""
+        delay = rate_limiter.backoff(error, attempt) if error is not None else rate_limiter.backoff_delay(attempt)
+        print(f'\nRetrying in {delay:.1f} seconds...\n\n')
+        deadline = time.monotonic() + delay
+        while True:
+            self._check_cancel()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.5))
+
+    @staticmethod
+    def _estimate_prompt_tokens(messages) -> int:
+        # ~4 characters per token is close enough for budgeting; the real usage is reconciled afterwards
+        return sum(len(str(message.get('content') or '')) for message in messages) // 4
+
+    def _create_completion(self, messages, n=1, **kwargs) -> str:
+        """Return the content of the first choice, from `llm_cache` if the same request was answered before."""
+        cache_request = dict(model=self.model_name, messages=messages, n=n, **kwargs)
+        content = llm_cache.get(cache_request)
+        if content is not None:
+            if self.stream_callback is not None and n == 1:
+                for text in ('', content, None):
+                    self.stream_callback(self._visible_messages, text)
+            return content
+
+        content = self._request_completion(messages, n=n, **kwargs)
+        llm_cache.put(cache_request, content)
+        return content
+
+    def _request_completion(self, messages, n=1, **kwargs) -> str:
+        """Return the content of the first choice, streaming it through `stream_callback` when one is set."""
+        prompt_tokens = self._estimate_prompt_tokens(messages)
+        # like the provider, reserve max_tokens for every choice up front
+        estimated_tokens = prompt_tokens + kwargs.get('max_tokens', 0) * n
+        rate_limiter.acquire(self.rate_limit_key, estimated_tokens, self.cancel_check)
+        self._check_cancel()
+        with self.transport.in_flight():
+            timeout = self.deadline.timeout(self.request_timeout) if self.deadline is not None else self.request_timeout
+            completions = self.client.chat.completions.with_raw_response
+            if self.stream_callback is None or n != 1:
+                raw_response = completions.create(model=self.model_name, messages=messages, stream=False, n=n, timeout=timeout, **kwargs)
+                rate_limiter.update_from_headers(raw_response.headers)
+                response = raw_response.parse()
+                usage = getattr(response, 'usage', None)
+                rate_limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+                return response.choices[0].message.content
+
+            raw_response = completions.create(model=self.model_name, messages=messages, stream=True, n=1, timeout=timeout, **kwargs)
+            rate_limiter.update_from_headers(raw_response.headers)
+            stream = raw_response.parse()
+            visible_messages = self._visible_messages
+            self.stream_callback(visible_messages, '')
+            parts = []
+            try:
+                for chunk in stream:
+                    # checked per chunk so /session/stop aborts mid-generation
+                    self._check_cancel()
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if text:
+                        parts.append(text)
+                        self.stream_callback(visible_messages, text)
+            finally:
+                stream.close()
+                self.stream_callback(visible_messages, None)
+                rate_limiter.record_usage(estimated_tokens, prompt_tokens + len(''.join(parts)) // 4)
+            return ''.join(parts)
     
     def _get_gpt_response(self, messages, n=1):
         response = []
@@ -66,16 +172,16 @@ class Agent:
             s_time = time.time()
             try:
                 print(f'\n\n{messages}\n\n')
-                each_response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
+                each_response = self._create_completion(
+                    messages,
                     temperature=self.temp,
                     top_p=self.top_p,
                     seed=self.seed,
-                    stream=False,
                     max_tokens=self.max_completion_tokens,
                     n=n,
                 )
+            except (GenerationCancelled, LLMCacheMiss):
+                raise
             except Exception as e:
                 self._check_cancel()
                 print(f'\nError: {e}\n\n')
@@ -84,11 +190,12 @@ class Agent:
                     fallback = '```\n[ERROR] Failed to generate due to API error or quota.\n```'
                     response.append(fallback)
                     break
+                self._wait_before_retry(e, n_tries)
                 continue
             
             print(f'\nTime consuming for one generation: {time.time()-s_time:.2f} seconds\n\n\n')
 
-            response.append(each_response.choices[0].message.content)
+            response.append(each_response)
             self._check_cancel()
 
         if n == 1:
@@ -100,26 +207,27 @@ class Agent:
         response = []
         max_tries = n + 2
         n_tries = 0
+        n_waits = 0  # channel/quota waits do not count as failed tries
         while len(response) < n:
             self._check_cancel()
             s_time = time.time()
             try:
                 print(f'\n\n{messages}\n\n')
-                each_response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
+                each_response = self._create_completion(
+                    messages,
                     temperature=self.temp,
                     seed=self.seed,
-                    stream=False,
                     max_tokens=self.max_completion_tokens,
                     n=n,
                 )
+            except (GenerationCancelled, LLMCacheMiss):
+                raise
             except Exception as e:
                 self._check_cancel()
                 print(f'\nError: {e}\n\n')
                 if "无可用渠道" in str(e):
-                    time.sleep(2)
-                    self._check_cancel()
+                    self._wait_before_retry(e, n_waits)
+                    n_waits += 1
                     continue
 
                 if "potentially violating our usage policy" in str(e) or 'bad response status' in str(e):  # triggered by o1-mini
@@ -142,8 +250,8 @@ class Agent:
                     continue
 
                 if "quota is not enough" in str(e):
-                    time.sleep(10)
-                    self._check_cancel()
+                    self._wait_before_retry(e, n_waits)
+                    n_waits += 1
                     continue
                 
                 n_tries += 1
@@ -151,11 +259,12 @@ class Agent:
                     fallback = '```\n[ERROR] Failed to generate due to API error or quota.\n```'
                     response.append(fallback)
                     break
+                self._wait_before_retry(e, n_tries)
                 continue
             
             print(f'\nTime consuming for one generation: {time.time()-s_time:.2f} seconds\n\n\n')
 
-            response.append(each_response.choices[0].message.content)
+            response.append(each_response)
             self._check_cancel()
 
         if n == 1:
@@ -175,15 +284,15 @@ class Agent:
             self._check_cancel()
             s_time = time.time()
             try:
-                each_response_raw = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
+                each_response_raw = self._create_completion(
+                    messages,
                     temperature=0.6,
                     seed=self.seed,
-                    stream=False,
                     max_tokens=self.max_completion_tokens,
                     n=1
                 )
+            except (GenerationCancelled, LLMCacheMiss):
+                raise
             except Exception as e:
                 self._check_cancel()
                 # the input is too long
@@ -206,16 +315,18 @@ class Agent:
                 if n_tries >= max_tries:
                     response.append('```\n[ERROR] Failed to generate due to API error or quota.\n```')
                     break
+                self._wait_before_retry(e, n_tries)
+                continue
 
             print(f'Time consuming for one generation: {time.time()-s_time:.2f} seconds\n\n')
-            print(f'[INFO] Response:\n{each_response_raw.choices[0].message.content}\n\n\n')
+            print(f'[INFO] Response:\n{each_response_raw}\n\n\n')
             
-            each_response = self.remove_thinking(each_response_raw.choices[0].message.content)
+            each_response = self.remove_thinking(each_response_raw)
             if each_response is None:
                 messages[0]['content'] += '\n\n<think>\n\n</think>\n\n'
                 print('Seems a too long thinking. Enforcing the model to skip thinking.\n')
                 print('Messages (after modified):', messages, '\n\n\n')
-                print('Response:\n', each_response_raw.choices[0].message.content, '\n\n\n')
+                print('Response:\n', each_response_raw, '\n\n\n')
                 n_tries += 1
 
                 if n_tries < max_tries:
@@ -348,6 +459,11 @@ class TestGenAgent(Agent):
         return messages
 
     def construct_prompt(self, target_focal_method, target_context, target_test_class_name, target_test_desc, referable_test: str, facts: list, junit_version: str, forbid_using_facts: bool=False):
+        # trim the context, facts and referable test up front instead of waiting for a "reduce the length" error
+        render = lambda context, kept_facts, referable: self._render_prompt(target_focal_method, context, target_test_class_name, target_test_desc, referable, kept_facts, junit_version, forbid_using_facts)
+        return self.prompt_budget().fit(render, target_focal_method, target_context, facts, referable_test)
+
+    def _render_prompt(self, target_focal_method, target_context, target_test_class_name, target_test_desc, referable_test: str, facts: list, junit_version: str, forbid_using_facts: bool=False):
         instruction = f"""# Target Focal Method\n```\n{target_focal_method}\n```\n\n# Target Focal Method Context\nThe Target Focal Method belongs to the following class (with some details omitted):\n```\n{target_context}\n```\n\n# Target Test Case\n// A JUnit {junit_version} test case to be generated, whose class name is {target_test_class_name}.\n\n# Target Test Case Description\n```\n{target_test_desc}\n```\n\n"""
 
         if referable_test:
@@ -405,6 +521,10 @@ class TestRefineAgent(Agent):
         return generated_tc, prompt, messages
 
     def construct_prompt(self, gen_test_case, error_msg, target_focal_method, target_context, target_test_desc, facts: list, forbid_using_facts: bool=False):
+        render = lambda context, kept_facts, _: self._render_prompt(gen_test_case, error_msg, target_focal_method, context, target_test_desc, kept_facts, forbid_using_facts)
+        return self.prompt_budget().fit(render, target_focal_method, target_context, facts)
+
+    def _render_prompt(self, gen_test_case, error_msg, target_focal_method, target_context, target_test_desc, facts: list, forbid_using_facts: bool=False):
         instruction = f"""# Target Focal Method\n```\n{target_focal_method}\n```\n\n# Target Focal Method Context\nThe Target Focal Method belongs to the following class (with some details omitted):\n```\n{target_context}\n```\n\n# Target Test Case Description\n```\n{target_test_desc}\n```\n\n"""
         
         if facts:
@@ -1,19 +1,27 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import concurrent.futures
 import json
 import logging
+import pathlib
 import socketserver
 import threading
 from http.server import BaseHTTPRequestHandler
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 try:
     from backend import main as generation_entry_module  # when run as package
 except ImportError:
     import main as generation_entry_module  # when invoked from backend directory
+from core.admission import GenerationPool
+from core.exceptions import AdmissionRejected
 from core.registry import SessionRegistry
 from core.session import ModelQuerySession
+from llm_client import rate_limiter
+from test_case_runner import outcome_cache
+from user_config import global_config
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -22,6 +30,17 @@ logging.basicConfig(
 )
 
 DEFAULT_PORT = 8080
+DEFAULT_MODE = global_config.get("server", "mode", fallback="threaded")
+DEFAULT_WORKERS = global_config.getint("server", "workers", fallback=2)
+DEFAULT_QUEUE_SIZE = global_config.getint("server", "queue_size", fallback=8)
+DEFAULT_MAX_QUEUED_PER_PROJECT = global_config.getint("server", "max_queued_per_project", fallback=4)
+DEFAULT_RETRY_AFTER = global_config.getint("server", "retry_after", fallback=30)
+DEFAULT_RESUME_GRACE = global_config.getfloat("server", "resume_grace_seconds", fallback=30.0)
+DEFAULT_STREAM_FLUSH_INTERVAL = global_config.getint("server", "stream_flush_ms", fallback=50) / 1000
+# a worker writing to a client whose send buffer stays above the high-water mark this long detaches the client
+DEFAULT_WRITE_TIMEOUT = global_config.getfloat("server", "write_timeout_seconds", fallback=60.0)
+# wall-clock budget of one generation session; builds and LLM calls get the time left (0 = unlimited)
+DEFAULT_SESSION_BUDGET = global_config.getfloat("timeouts", "session", fallback=1800.0)
 _global_junit_version = 4
 _session_registry = SessionRegistry()
 
@@ -44,6 +63,14 @@ class ResponseStream:
             self._handler.wfile.flush()
 
 
+def collect_metrics(pool: Optional[GenerationPool] = None) -> Dict[str, Any]:
+    """LLM 限流等待时间等指标，用于评估所需的配额。"""
+    metrics: Dict[str, Any] = {"llm_rate_limit": rate_limiter.stats(), "test_outcome_cache": outcome_cache.stats()}
+    if pool is not None:
+        metrics["generation_pool"] = pool.stats()
+    return metrics
+
+
 def run_generation(query_data: Dict[str, Any], session: ModelQuerySession) -> None:
     generation_entry_module.main(**query_data, query_session=session)
 
@@ -56,9 +83,24 @@ def build_session(session_id: str, data: Dict[str, Any], handler: BaseHTTPReques
         writer=response_stream,
         executor=run_generation,
         junit_version=_global_junit_version,
+        resume_grace=DEFAULT_RESUME_GRACE,
+        stream_flush_interval=DEFAULT_STREAM_FLUSH_INTERVAL,
+        budget=DEFAULT_SESSION_BUDGET,
     )
 
 
+def parse_resume_payload(payload: Dict[str, Any]) -> Tuple[str, int]:
+    """Validate a resume request and return (session_id, last_seq)."""
+    session_id = payload.get("session_id")
+    if not session_id:
+        raise ValueError("Missing session_id")
+    try:
+        last_seq = int(payload.get("last_seq", 0))
+    except (TypeError, ValueError):
+        raise ValueError("last_seq must be an integer")
+    return session_id, last_seq
+
+
 def validate_query_payload(payload: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
     """Validate request body and return (session_id, data)."""
     if payload.get("type") != "query":
@@ -82,11 +124,20 @@ def _generate_session_id() -> str:
 class QueryHandler(BaseHTTPRequestHandler):
     server_version = "IntentionTestHTTP/1.0"
 
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path == "/metrics":
+            self._send_json(200, collect_metrics())
+        else:
+            self.send_response(404)
+            self.end_headers()
+
     def do_POST(self) -> None:  # noqa: N802
         if self.path == "/session":
             self._handle_session_request()
         elif self.path == "/session/stop":
             self._handle_stop_request()
+        elif self.path == "/session/resume":
+            self._handle_resume_request()
         elif self.path == "/junitVersion":
             self._handle_junit_version()
         else:
@@ -113,9 +164,27 @@ class QueryHandler(BaseHTTPRequestHandler):
             logger.error("Error processing session: %s", exc, exc_info=True)
             self._end_with_error(500, "Internal Server Error", str(exc))
         finally:
+            session.close()
             _session_registry.remove(session.session_id)
             self._end_session()
 
+    def _handle_resume_request(self) -> None:
+        try:
+            session_id, last_seq = parse_resume_payload(self._read_json_body())
+        except ValueError as exc:
+            self._end_with_error(400, "Bad Request", str(exc))
+            return
+        session = _session_registry.get_resumable(session_id)
+        if not session:
+            self.send_response(404, "Session Not Found")
+            self.end_headers()
+            return
+
+        self._send_keep_alive_header()
+        session.resume(ResponseStream(self), last_seq)
+        session.wait_closed()
+        self._end_session()
+
     def _handle_stop_request(self) -> None:
         try:
             payload = self._read_json_body()
@@ -150,6 +219,14 @@ class QueryHandler(BaseHTTPRequestHandler):
         self.send_response(200, "Success")
         self.end_headers()
 
+    def _send_json(self, code: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def _send_keep_alive_header(self) -> None:
         self.send_response(200, "Success")
         self.send_header("Content-type", "application/json")
@@ -171,6 +248,266 @@ class QueryHandler(BaseHTTPRequestHandler):
         return json.loads(body) if body else {}
 
 
+STREAM_HEADERS = {"Content-type": "application/json", "Cache-Control": "no-cache", "Connection": "keep-alive"}
+
+
+class AsyncResponseStream:
+    """把 worker 线程中的写操作投递到事件循环，由事件循环负责真正写出。
+
+    worker 线程的每次写入都等待发送缓冲回落到高水位以下（``drain``），客户端读得慢时生成随之暂停；
+    超过 ``write_timeout`` 仍未回落则断开连接并抛出 ``BrokenPipeError``，会话按断线处理（可在宽限期内 resume）。
+    事件循环线程上的写入只有少量状态消息，不等待。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, write_timeout: float = DEFAULT_WRITE_TIMEOUT) -> None:
+        self._loop = loop
+        self._writer = writer
+        self._write_timeout = write_timeout
+
+    def __call__(self, data: bytes) -> None:
+        if self._writer.is_closing():
+            raise BrokenPipeError("Client connection closed")
+        try:
+            running_loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._writer.write(data + b"\n")
+            return
+        future = asyncio.run_coroutine_threadsafe(self._write(data), self._loop)
+        try:
+            future.result(self._write_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logger.warning("Client stopped reading for %.0fs, dropping the connection", self._write_timeout)
+            self._loop.call_soon_threadsafe(self._writer.transport.abort)
+            raise BrokenPipeError("Client is not reading the stream")
+
+    async def _write(self, data: bytes) -> None:
+        if self._writer.is_closing():
+            raise BrokenPipeError("Client connection closed")
+        self._writer.write(data + b"\n")
+        await self._writer.drain()
+
+
+class AsyncQueryServer:
+    """基于 asyncio 的 HTTP 前端：连接由事件循环处理，生成任务交给有界的 worker 池。"""
+
+    def __init__(self, pool: GenerationPool) -> None:
+        self._pool = pool
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await self._read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError) as exc:
+            logger.error("Malformed HTTP request: %s", exc)
+            self._write_head(writer, 400, "Bad Request")
+            await self._close(writer)
+            return
+
+        try:
+            if method == "GET" and path == "/metrics":
+                body = json.dumps(collect_metrics(self._pool)).encode("utf-8")
+                self._write_head(writer, 200, "OK", {"Content-type": "application/json", "Content-Length": str(len(body))})
+                writer.write(body)
+            elif method != "POST":
+                self._write_head(writer, 404, "Not Found")
+            elif path == "/session":
+                await self._handle_session_request(writer, body)
+            elif path == "/session/stop":
+                self._handle_stop_request(writer, body)
+            elif path == "/session/resume":
+                await self._handle_resume_request(writer, body)
+            elif path == "/junitVersion":
+                self._handle_junit_version(writer, body)
+            else:
+                self._write_head(writer, 404, "Not Found")
+        except Exception as exc:
+            logger.error("Error processing %s: %s", path, exc, exc_info=True)
+        finally:
+            await self._close(writer)
+
+    async def _handle_session_request(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            payload = json.loads(body) if body else {}
+            session_id, raw_data = validate_query_payload(payload)
+        except Exception as exc:  # broad catch to surface payload issues
+            logger.error("Invalid session request: %s", exc, exc_info=True)
+            self._write_head(writer, 400, "Bad Request")
+            return
+
+        loop = asyncio.get_running_loop()
+        done: asyncio.Future = loop.create_future()
+        errors = []
+
+        def resolve() -> None:
+            if not done.done():
+                done.set_result(None)
+
+        session = ModelQuerySession(
+            session_id=session_id,
+            raw_data=raw_data,
+            writer=AsyncResponseStream(loop, writer),
+            executor=run_generation,
+            junit_version=_global_junit_version,
+            resume_grace=DEFAULT_RESUME_GRACE,
+            stream_flush_interval=DEFAULT_STREAM_FLUSH_INTERVAL,
+            budget=DEFAULT_SESSION_BUDGET,
+        )
+
+        def run_job() -> None:
+            try:
+                if not session.should_stop():
+                    session.start_query()
+            except Exception as exc:
+                logger.error("Error processing session: %s", exc, exc_info=True)
+                errors.append(exc)
+            finally:
+                loop.call_soon_threadsafe(resolve)
+
+        _session_registry.register(session)
+        try:
+            try:
+                position = self._pool.submit(
+                    session_id,
+                    pathlib.Path(raw_data["project_path"]).stem,
+                    run_job,
+                    on_position=session.write_queued_message,
+                    on_cancel=lambda: loop.call_soon_threadsafe(resolve),
+                )
+            except AdmissionRejected as exc:
+                logger.warning("Rejected session %s: %s", session_id, exc)
+                self._write_head(writer, 503, "Service Unavailable", {"Retry-After": str(exc.retry_after)})
+                return
+
+            # no await between submit() and the start message, so it always precedes worker output
+            self._write_head(writer, 200, "Success", STREAM_HEADERS)
+            session.write_start_message()
+            if position > 0:
+                session.write_queued_message(position)
+            await done
+            if not errors:
+                session.write_finish_message()
+        finally:
+            session.close()
+            _session_registry.remove(session_id)
+
+    async def _handle_resume_request(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            session_id, last_seq = parse_resume_payload(json.loads(body) if body else {})
+        except ValueError as exc:
+            logger.error("Invalid resume request: %s", exc)
+            self._write_head(writer, 400, "Bad Request")
+            return
+        session = _session_registry.get_resumable(session_id)
+        if not session:
+            self._write_head(writer, 404, "Session Not Found")
+            return
+
+        loop = asyncio.get_running_loop()
+        self._write_head(writer, 200, "Success", STREAM_HEADERS)
+        # off the loop: resume takes the session's write lock, which a worker may hold while it waits for a drain
+        closed = asyncio.Event()
+        session.add_close_callback(lambda: loop.call_soon_threadsafe(closed.set))
+        await loop.run_in_executor(None, session.resume, AsyncResponseStream(loop, writer), last_seq)
+        # no thread is held while the resumed connection waits for the session to end
+        await closed.wait()
+
+    def _handle_stop_request(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            payload = json.loads(body) if body else {}
+            session_id = payload.get("session_id")
+            if not session_id:
+                raise ValueError("Missing session_id")
+        except ValueError as exc:
+            logger.error("Invalid stop request: %s", exc)
+            self._write_head(writer, 400, "Bad Request")
+            return
+        session = _session_registry.get(session_id)
+        if not session:
+            self._write_head(writer, 404, "Session Not Found")
+            return
+        session.request_stop()
+        self._pool.cancel(session_id)
+        self._write_head(writer, 200, "Stopping")
+
+    def _handle_junit_version(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        global _global_junit_version
+
+        try:
+            payload = json.loads(body) if body else {}
+            version = int(payload["data"])
+        except Exception as exc:
+            logger.error("Invalid junitVersion payload: %s", exc)
+            self._write_head(writer, 400, "Bad Request")
+            return
+
+        _global_junit_version = version
+        self._write_head(writer, 200, "Success")
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) < 2:
+            raise ValueError(f"Invalid request line: {request_line!r}")
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        content_length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(content_length) if content_length else b""
+        return parts[0].upper(), parts[1], body
+
+    def _write_head(
+        self,
+        writer: asyncio.StreamWriter,
+        code: int,
+        reason: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        lines = [f"HTTP/1.0 {code} {reason}", f"Server: {QueryHandler.server_version}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _close(self, writer: asyncio.StreamWriter) -> None:
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+def start_async_http_server(
+    port: int,
+    workers: int = DEFAULT_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    max_queued_per_project: int = DEFAULT_MAX_QUEUED_PER_PROJECT,
+) -> None:
+    pool = GenerationPool(workers, queue_size, max_queued_per_project, retry_after=DEFAULT_RETRY_AFTER)
+    app = AsyncQueryServer(pool)
+
+    async def serve() -> None:
+        server = await asyncio.start_server(app.handle_connection, host=None, port=port)
+        actual_port = server.sockets[0].getsockname()[1]
+        logger.info(
+            "Async HTTP server is listening on %s (workers=%s, queue_size=%s)", actual_port, workers, queue_size
+        )
+        async with server:
+            await server.serve_forever()
+
+    logger.info("Starting async HTTP server on port %s", port)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logger.info("Shutting down HTTP server")
+    finally:
+        pool.shutdown()
+
+
 def start_http_server(port: int) -> None:
     logger.info("Starting HTTP server on port %s", port)
     httpd = ThreadedTCPServer(("", port), QueryHandler)
@@ -187,8 +524,19 @@ def start_http_server(port: int) -> None:
 def main() -> None:
     parser = argparse.ArgumentParser(description="Start the model server")
     parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to start the server on")
+    parser.add_argument(
+        "--mode",
+        choices=("threaded", "async"),
+        default=DEFAULT_MODE,
+        help="threaded: one thread per session; async: event loop front end with a bounded worker pool",
+    )
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Generation workers in async mode")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="Queued sessions in async mode before rejecting with 503")
     args = parser.parse_args()
-    start_http_server(args.port)
+    if args.mode == "async":
+        start_async_http_server(args.port, args.workers, args.queue_size)
+    else:
+        start_http_server(args.port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import static org.junit.platform.engine.discovery.DiscoverySelectors.selectClass;
+
+import java.io.ByteArrayInputStream;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.io.PrintWriter;
+
+import org.jacoco.agent.rt.IAgent;
+import org.jacoco.agent.rt.RT;
+import org.jacoco.core.analysis.Analyzer;
+import org.jacoco.core.analysis.CoverageBuilder;
+import org.jacoco.core.tools.ExecFileLoader;
+import org.jacoco.report.DirectorySourceFileLocator;
+import org.jacoco.report.IReportVisitor;
+import org.jacoco.report.xml.XMLFormatter;
+import org.junit.platform.launcher.Launcher;
+import org.junit.platform.launcher.LauncherDiscoveryRequest;
+import org.junit.platform.launcher.core.LauncherDiscoveryRequestBuilder;
+import org.junit.platform.launcher.core.LauncherFactory;
+import org.junit.platform.reporting.legacy.xml.LegacyXmlReportGeneratingListener;
+
+/**
+ * Runs generated test classes one after another in this JVM, which runs with the JaCoCo agent.
+ *
+ * Usage: IntentionTestBatchRunner OUTPUT_DIR MAIN_CLASSES_DIR TIMEOUT_SECONDS (TEST_CLASS FOCAL_CLASS)...
+ * where FOCAL_CLASS is the class file of the focal class relative to MAIN_CLASSES_DIR, without ".class".
+ *
+ * A test class that runs longer than TIMEOUT_SECONDS (0 = no limit) cannot be stopped safely, so the runner
+ * exits with TIMED_OUT_STATUS; the caller starts a new runner for the classes after it.
+ *
+ * For every test class, OUTPUT_DIR/TEST_CLASS/ receives the test output (output.txt), the surefire-style
+ * report of the JUnit Platform (TEST-*.xml) and a jacoco.xml with the coverage of the focal class by this
+ * test class alone: the agent's execution data is dumped and reset after each test class.
+ */
+public final class IntentionTestBatchRunner {
+
+    static final int TIMED_OUT_STATUS = 3;
+
+    public static void main(String[] args) throws Exception {
+        File outputDir = new File(args[0]);
+        File classesDir = new File(args[1]);
+        long timeoutMillis = Long.parseLong(args[2]) * 1000;
+        Launcher launcher = LauncherFactory.create();
+        IAgent agent = RT.getAgent();
+        agent.reset();
+
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        for (int i = 3; i + 1 < args.length; i += 2) {
+            String testClass = args[i];
+            File testDir = new File(outputDir, testClass);
+            testDir.mkdirs();
+            try (PrintStream output = new PrintStream(new FileOutputStream(new File(testDir, "output.txt")), true, "UTF-8")) {
+                System.setOut(output);
+                System.setErr(output);
+                Thread run = new Thread(() -> {
+                    try {
+                        LauncherDiscoveryRequest request = LauncherDiscoveryRequestBuilder.request().selectors(selectClass(testClass)).build();
+                        launcher.execute(request, new LegacyXmlReportGeneratingListener(testDir.toPath(), new PrintWriter(output)));
+                    } catch (Throwable t) {
+                        t.printStackTrace(output);
+                    }
+                }, "test-" + testClass);
+                run.setDaemon(true);
+                run.start();
+                run.join(timeoutMillis);
+                if (run.isAlive()) {
+                    stdout.println("Timed out " + testClass);
+                    System.exit(TIMED_OUT_STATUS);
+                }
+            } finally {
+                System.setOut(stdout);
+                System.setErr(stderr);
+            }
+            writeCoverage(agent.getExecutionData(true), classesDir, args[i + 1], new File(testDir, "jacoco.xml"));
+            stdout.println("Finished " + testClass);
+        }
+        // tests may leave non-daemon threads behind
+        System.exit(0);
+    }
+
+    private static void writeCoverage(byte[] executionData, File classesDir, String focalClass, File xmlFile) throws IOException {
+        File classFile = new File(classesDir, focalClass + ".class");
+        if (!classFile.exists()) {
+            return;
+        }
+        ExecFileLoader loader = new ExecFileLoader();
+        loader.load(new ByteArrayInputStream(executionData));
+        CoverageBuilder builder = new CoverageBuilder();
+        Analyzer analyzer = new Analyzer(loader.getExecutionDataStore(), builder);
+        // only the focal class and its nested classes: analyzing every class would dominate the run
+        String nestedPrefix = classFile.getName().replace(".class", "$");
+        analyzer.analyzeAll(classFile);
+        File[] nested = classFile.getParentFile().listFiles((dir, name) -> name.startsWith(nestedPrefix) && name.endsWith(".class"));
+        if (nested != null) {
+            for (File each : nested) {
+                analyzer.analyzeAll(each);
+            }
+        }
+        try (OutputStream out = new FileOutputStream(xmlFile)) {
+            IReportVisitor visitor = new XMLFormatter().createVisitor(out);
+            visitor.visitInfo(loader.getSessionInfoStore().getInfos(), loader.getExecutionDataStore().getContents());
+            visitor.visitBundle(builder.getBundle("batch"), new DirectorySourceFileLocator(classesDir, "UTF-8", 4));
+            visitor.visitEnd();
+        }
+    }
+}
@@ -0,0 +1,211 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from core.deadline import Deadline
+from core.exceptions import DeadlineExceeded
+from jacoco_coverage import JacocoReport
+from surefire_report import SurefireResult, parse_surefire_reports
+
+logger = logging.getLogger(__name__)
+
+JACOCO_VERSION = '0.8.11'
+BATCH_RUNNER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_runner', 'IntentionTestBatchRunner.java')
+JAVAC_ERROR_PATTERN = re.compile(r'^(.+?\.java):\d+: error:', re.MULTILINE)
+# where a batch's tests are compiled, apart from target/test-classes
+BATCH_CLASSES_DIR = 'target/batch-test-classes'
+BATCH_OUTPUT_DIR = 'target/batch-test-output'
+# exit status of the batch runner when a test class ran out of time (IntentionTestBatchRunner.TIMED_OUT_STATUS)
+TIMED_OUT_STATUS = 3
+
+
+@dataclass
+class BatchTest:
+    path: str  # the test file inside the project
+    focal_class: str  # e.g. org/example/Foo
+
+
+@dataclass
+class BatchTestResult:
+    compile_success: bool
+    compile_log: str
+    output: str = ''
+    test_report: Optional[SurefireResult] = None
+    coverage: Optional[JacocoReport] = None
+    timed_out: bool = False
+
+
+class BatchTestRunner:
+    """Compiles a batch of generated tests with one javac run and runs them all in one JVM with the JaCoCo agent.
+
+    A test that does not compile is taken out of the batch and the rest compiled again, so it only fails itself.
+    Coverage is per test class: the batch runner dumps and resets the agent's execution data after each class.
+    A test class that exceeds the execute budget ends the JVM; the classes after it run in a new one.
+    Uses the classpath and main classes snapshot of the fast runner.
+    """
+
+    def __init__(self, runner, fast_runner):
+        self.runner = runner
+        self.fast_runner = fast_runner
+
+    def run(self, project_dir: str, tests: List[BatchTest], env) -> Optional[Dict[str, BatchTestResult]]:
+        """Results keyed by test path, or None when the project cannot be run without Maven (no JDK, classpath or tools)."""
+        if shutil.which('javac', path=env.get('PATH')) is None or shutil.which('java', path=env.get('PATH')) is None:
+            return None
+        classpath = self.fast_runner.load_classpath(project_dir)
+        if classpath is None:
+            # first run on this project: let Maven compile src/main and resolve the classpath once
+            self.runner.run_build(['mvn', '-q', 'test-compile', '-Dcheckstyle.skip=true'], project_dir, env)
+            self.fast_runner.refresh(project_dir, env)
+            classpath = self.fast_runner.load_classpath(project_dir)
+        if classpath is None:
+            return None
+        # pinned until every JVM of the batch is done with it
+        with self.fast_runner.main_classes(project_dir, classpath, env) as main_classes_dir:
+            return self._run(project_dir, tests, env, classpath, main_classes_dir)
+
+    def _run(self, project_dir, tests, env, classpath, main_classes_dir) -> Optional[Dict[str, BatchTestResult]]:
+        launcher = self.fast_runner.junit5_launcher(project_dir, env)
+        agent = self.fast_runner.cached_artifact(project_dir, env, f'org.jacoco:org.jacoco.agent:{JACOCO_VERSION}:jar:runtime')
+        jacoco_cli = self.fast_runner.cached_artifact(project_dir, env, f'org.jacoco:org.jacoco.cli:{JACOCO_VERSION}:jar:nodeps')
+        if main_classes_dir is None or launcher is None or agent is None or jacoco_cli is None:
+            return None
+        runner_dir = self._batch_runner_classes(project_dir, env, [launcher, agent, jacoco_cli])
+        if runner_dir is None:
+            return None
+
+        results = {}
+        classes_dir = f'{project_dir}/{BATCH_CLASSES_DIR}'
+        compiled = self._compile(project_dir, tests, classes_dir, os.pathsep.join([main_classes_dir, classpath]), env, results)
+        if not compiled:
+            return results
+
+        output_dir = f'{project_dir}/{BATCH_OUTPUT_DIR}'
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        run_classpath = os.pathsep.join([runner_dir, classes_dir, f'{project_dir}/src/test/resources', main_classes_dir, classpath, launcher, jacoco_cli])
+        execute_budget = self.runner.configs.stage_budgets['execute']
+        pending = compiled
+        while pending:
+            cmd = ['java', f'-javaagent:{agent}=output=none', '-cp', run_classpath, 'IntentionTestBatchRunner', output_dir, main_classes_dir,
+                   str(int(max(execute_budget, 0)))]
+            for test in pending:
+                cmd += [self._class_name(test), test.focal_class]
+            # the runner enforces the budget per class; this only catches a JVM that hangs outside of a test
+            backstop = Deadline(execute_budget * (len(pending) + 1) if execute_budget > 0 else None, 'execute')
+            try:
+                returncode = self.runner.run_build(cmd, project_dir, env, deadline=backstop).returncode
+            except DeadlineExceeded:
+                returncode = TIMED_OUT_STATUS
+            pending = self._not_run(pending, output_dir, returncode, results)
+
+        for test in compiled:
+            class_name = self._class_name(test)
+            test_dir = f'{output_dir}/{class_name}'
+            output = ''
+            if os.path.exists(f'{test_dir}/output.txt'):
+                with open(f'{test_dir}/output.txt', encoding='utf8', errors='replace') as f:
+                    output = f.read()
+            coverage = JacocoReport.parse(f'{test_dir}/jacoco.xml') if os.path.exists(f'{test_dir}/jacoco.xml') else None
+            results[test.path].output = output
+            results[test.path].test_report = parse_surefire_reports(sorted(glob.glob(f'{test_dir}/TEST-*.xml')), class_name)
+            results[test.path].coverage = coverage
+        return results
+
+    def _not_run(self, tests, output_dir, returncode, results) -> List[BatchTest]:
+        """The tests a new JVM still has to run after one that exited with `returncode`."""
+        # a class is done once the JUnit Platform has written its report
+        unfinished = [test for test in tests if not glob.glob(f'{output_dir}/{self._class_name(test)}/TEST-*.xml')]
+        if not unfinished:
+            return []
+        if returncode != TIMED_OUT_STATUS:
+            logger.warning(f'Batch runner exited with {returncode} before running {len(unfinished)} tests')
+            return []
+        # classes run in order, so the first unfinished one is the class that ran out of time
+        logger.info(f'{self._class_name(unfinished[0])} timed out, running the {len(unfinished) - 1} tests after it in a new JVM')
+        results[unfinished[0].path].timed_out = True
+        return unfinished[1:]
+
+    def _compile(self, project_dir, tests, classes_dir, classpath, env, results) -> List[BatchTest]:
+        """Compile the batch, dropping tests javac reports errors in until the rest compiles. Returns the compiled tests."""
+        remaining = list(tests)
+        while remaining:
+            shutil.rmtree(classes_dir, ignore_errors=True)
+            os.makedirs(classes_dir)
+            cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-d', classes_dir, '-cp', classpath,
+                   '-sourcepath', f'{project_dir}/src/test/java'] + [test.path for test in remaining]
+            result = self.runner.run_build(cmd, project_dir, env)
+            log = f'{result.stdout}\n\n{result.stderr}\n\n'
+            if result.returncode == 0:
+                for test in remaining:
+                    results[test.path] = BatchTestResult(compile_success=True, compile_log=log)
+                return remaining
+
+            failed_paths = {os.path.abspath(path) for path in JAVAC_ERROR_PATTERN.findall(log)}
+            failed = [test for test in remaining if os.path.abspath(test.path) in failed_paths]
+            if not failed:
+                # the errors are somewhere else, e.g. a shared helper: find the tests that do not compile on their own
+                failed = [test for test in remaining if not self._compiles_alone(project_dir, test, classes_dir, classpath, env, results)]
+            if not failed:
+                logger.warning(f'{len(remaining)} tests compile one by one but not together:\n{log}')
+                for test in remaining:
+                    results[test.path] = BatchTestResult(compile_success=False, compile_log=log)
+                return []
+            for test in failed:
+                if test.path not in results:
+                    results[test.path] = BatchTestResult(compile_success=False, compile_log=self._errors_of(log, test.path))
+                # keep javac from compiling it again through -sourcepath
+                os.remove(test.path)
+            remaining = [test for test in remaining if test not in failed]
+        return []
+
+    def _compiles_alone(self, project_dir, test, classes_dir, classpath, env, results) -> bool:
+        shutil.rmtree(classes_dir, ignore_errors=True)
+        os.makedirs(classes_dir)
+        cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-d', classes_dir, '-cp', classpath, '-sourcepath', f'{project_dir}/src/test/java', test.path]
+        result = self.runner.run_build(cmd, project_dir, env)
+        if result.returncode != 0:
+            results[test.path] = BatchTestResult(compile_success=False, compile_log=f'{result.stdout}\n\n{result.stderr}\n\n')
+        return result.returncode == 0
+
+    def _errors_of(self, log: str, test_path: str) -> str:
+        # javac prints each error as "path:line: error: ..." followed by indented context lines
+        lines, keep = [], False
+        for line in log.split('\n'):
+            match = JAVAC_ERROR_PATTERN.match(line)
+            if match:
+                keep = os.path.abspath(match.group(1)) == os.path.abspath(test_path)
+            elif re.match(r'^\d+ errors?$', line):
+                keep = False
+            if keep:
+                lines.append(line)
+        return '\n'.join(lines)
+
+    def _batch_runner_classes(self, project_dir, env, jars) -> Optional[str]:
+        with open(BATCH_RUNNER_SOURCE, 'rb') as f:
+            digest = hashlib.sha1(f.read() + '\0'.join(jars).encode('utf8')).hexdigest()[:12]
+        runner_dir = f'{self.fast_runner.cache_dir}/batch-runner-{digest}'
+        if os.path.exists(f'{runner_dir}/IntentionTestBatchRunner.class'):
+            return runner_dir
+        tmp_dir = f'{runner_dir}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-d', tmp_dir, '-cp', os.pathsep.join(jars), BATCH_RUNNER_SOURCE]
+        result = self.runner.run_build(cmd, project_dir, env)
+        if result.returncode != 0:
+            logger.warning(f'Failed to compile the batch runner:\n{result.stdout}{result.stderr}')
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+        try:
+            os.replace(tmp_dir, runner_dir)
+        except OSError:  # compiled by another process meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return runner_dir
+
+    def _class_name(self, test: BatchTest) -> str:
+        return test.path.split('/src/test/java/')[1].replace('.java', '').replace('/', '.')
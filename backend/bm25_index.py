@@ -0,0 +1,242 @@
+import hashlib
+import math
+import os
+import pickle
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+INDEX_FORMAT = 1
+
+
+def content_key(text: str) -> str:
+    return hashlib.sha1(text.encode('utf8', errors='surrogatepass')).hexdigest()
+
+
+class BM25Index:
+    """An inverted index that scores like rank_bm25's BM25Okapi over the same documents, without rebuilding it per query.
+
+    Documents keep the id they were added with; a removed document scores 0 and no longer counts for IDF or avgdl.
+    `get_scores_with_self` gives the scores BM25Okapi would give over the corpus plus the query as one more document,
+    with the query's own score, from the postings of the query terms and a histogram of document frequencies
+    (BM25Okapi's epsilon floor depends on the average IDF over the whole vocabulary).
+
+    Scoring reads the postings as a term-major CSR matrix of term frequencies, and `score_batch` scores many queries
+    in one vectorized pass over it. The length normalization depends on each query (with the query as a document, avgdl
+    does), so the BM25 weights are computed per query from the gathered term frequencies rather than stored.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.doc_keys: List[Optional[str]] = []
+        self.doc_freqs: List[Optional[Dict[str, int]]] = []  # None once removed
+        self.doc_len: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}  # term -> {doc id: term frequency}
+        self.n_docs = 0
+        self.total_len = 0
+        self.df_hist: Counter = Counter()  # document frequency -> number of terms with it
+        self._csr: Optional[Tuple[Dict[str, int], np.ndarray, np.ndarray, np.ndarray]] = None
+        self._doc_len_array: Optional[np.ndarray] = None
+
+    @classmethod
+    def for_corpus(cls, texts: List[str], tokenize: Callable[[str], List[str]], path: Optional[str] = None) -> 'BM25Index':
+        """Index of `texts` with document ids equal to their positions, reusing the index saved at `path`.
+
+        Documents already in the saved index (by content) are not tokenized again; when the saved corpus is a prefix of
+        `texts`, only the new documents are added. The index is saved back whenever it changed.
+        """
+        keys = [content_key(text) for text in texts]
+        stored = cls.load(path) if path is not None and os.path.exists(path) else None
+        if stored is not None and stored.doc_keys == keys:
+            return stored
+        if stored is not None and stored.doc_keys == keys[:len(stored.doc_keys)]:
+            index = stored
+            for text, key in zip(texts[len(stored.doc_keys):], keys[len(stored.doc_keys):]):
+                index.add(tokenize(text), key)
+        else:
+            known = {}
+            if stored is not None:
+                known = {key: freqs for key, freqs in zip(stored.doc_keys, stored.doc_freqs) if freqs is not None}
+            index = cls()
+            for text, key in zip(texts, keys):
+                freqs = known.get(key)
+                if freqs is None:
+                    index.add(tokenize(text), key)
+                else:
+                    index._add_freqs(dict(freqs), key)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def add(self, tokens: List[str], key: Optional[str] = None) -> int:
+        return self._add_freqs(Counter(tokens), key)
+
+    def remove(self, doc_id: int) -> None:
+        freqs = self.doc_freqs[doc_id]
+        if freqs is None:
+            return
+        for term in freqs:
+            posting = self.postings[term]
+            self.df_hist[len(posting)] -= 1
+            del posting[doc_id]
+            if posting:
+                self.df_hist[len(posting)] += 1
+            else:
+                del self.postings[term]
+        self.n_docs -= 1
+        self.total_len -= self.doc_len[doc_id]
+        self.doc_freqs[doc_id] = None
+        self.doc_keys[doc_id] = None
+        self.doc_len[doc_id] = 0
+        self._csr = None
+        self._doc_len_array = None
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """Score of every document id for `query`, as BM25Okapi(corpus).get_scores(query)."""
+        return self.score_batch([query], with_self=False)[1][0]
+
+    def get_scores_with_self(self, query: List[str]) -> Tuple[float, np.ndarray]:
+        """(score of the query itself, scores of every document id), as BM25Okapi(corpus + [query]).get_scores(query)."""
+        self_scores, scores = self.score_batch([query], with_self=True)
+        return float(self_scores[0]), scores[0]
+
+    def score_batch(self, queries: List[List[str]], with_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """(self scores of shape (len(queries),), scores of shape (len(queries), number of document ids)).
+
+        Each row is what get_scores_with_self (or get_scores, without `with_self`; the self scores are then 0) gives
+        for that query alone.
+        """
+        vocab, indptr, doc_ids, tfs = self._csr_arrays()
+        n_ids = len(self.doc_len)
+        self_scores = np.zeros(len(queries))
+        avgdls = np.empty(len(queries))
+        pair_rows, pair_queries, pair_weights = [], [], []
+        for j, query in enumerate(queries):
+            query_freqs = Counter(query)
+            idf = self._idf(query_freqs, with_self)
+            if with_self:
+                avgdl = (self.total_len + len(query)) / (self.n_docs + 1)
+                norm = self.k1 * (1 - self.b + self.b * len(query) / avgdl)
+                for term, count in query_freqs.items():
+                    self_scores[j] += count * idf[term] * (count * (self.k1 + 1) / (count + norm))
+            else:
+                avgdl = self.total_len / self.n_docs
+            avgdls[j] = avgdl
+            for term, count in query_freqs.items():
+                row = vocab.get(term)
+                if row is not None:
+                    # the query term counts once per occurrence, as in BM25Okapi
+                    pair_rows.append(row)
+                    pair_queries.append(j)
+                    pair_weights.append(count * idf[term])
+
+        scores = np.zeros(len(queries) * n_ids)
+        if pair_rows:
+            # gather the postings of every (query, term) pair: one sparse-dense product Q @ W with query-dependent W
+            rows = np.array(pair_rows, dtype=np.int64)
+            starts, lengths = indptr[rows], indptr[rows + 1] - indptr[rows]
+            pair_of_entry = np.repeat(np.arange(len(rows)), lengths)
+            offsets = np.cumsum(lengths) - lengths
+            entries = starts[pair_of_entry] + np.arange(len(pair_of_entry)) - offsets[pair_of_entry]
+            docs, tf = doc_ids[entries], tfs[entries]
+            query_of_entry = np.array(pair_queries, dtype=np.int64)[pair_of_entry]
+            doc_len = self._doc_lengths()[docs]
+            weights = np.array(pair_weights)[pair_of_entry] * (
+                tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len / avgdls[query_of_entry])))
+            scores = np.bincount(query_of_entry * n_ids + docs, weights=weights, minlength=len(queries) * n_ids)
+        return self_scores, scores.reshape(len(queries), n_ids)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        state = {
+            'format': INDEX_FORMAT, 'k1': self.k1, 'b': self.b, 'epsilon': self.epsilon,
+            'doc_keys': self.doc_keys, 'doc_freqs': self.doc_freqs, 'doc_len': self.doc_len, 'postings': self.postings,
+        }
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['BM25Index']:
+        """The index saved at `path`, or None if it is unreadable or of another format."""
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if not isinstance(state, dict) or state.get('format') != INDEX_FORMAT:
+            return None
+        index = cls(state['k1'], state['b'], state['epsilon'])
+        index.doc_keys = state['doc_keys']
+        index.doc_freqs = state['doc_freqs']
+        index.doc_len = state['doc_len']
+        index.postings = state['postings']
+        index.n_docs = sum(freqs is not None for freqs in index.doc_freqs)
+        index.total_len = sum(index.doc_len)
+        index.df_hist = Counter(len(posting) for posting in index.postings.values())
+        return index
+
+    def _add_freqs(self, freqs: Dict[str, int], key: Optional[str]) -> int:
+        doc_id = len(self.doc_freqs)
+        for term, tf in freqs.items():
+            posting = self.postings.setdefault(term, {})
+            if posting:
+                self.df_hist[len(posting)] -= 1
+            posting[doc_id] = tf
+            self.df_hist[len(posting)] += 1
+        length = sum(freqs.values())
+        self.doc_keys.append(key)
+        self.doc_freqs.append(freqs)
+        self.doc_len.append(length)
+        self.n_docs += 1
+        self.total_len += length
+        self._csr = None
+        self._doc_len_array = None
+        return doc_id
+
+    def _idf(self, query_freqs: Dict[str, int], with_query: bool) -> Dict[str, float]:
+        n_docs = self.n_docs + 1 if with_query else self.n_docs
+        hist = Counter({df: count for df, count in self.df_hist.items() if count})
+        if with_query:
+            # the query as one more document: each of its terms occurs in one more document
+            for term in query_freqs:
+                df = len(self.postings.get(term, ()))
+                if df:
+                    hist[df] -= 1
+                hist[df + 1] += 1
+        dfs = np.array([df for df, count in hist.items() if count], dtype=float)
+        counts = np.array([count for count in hist.values() if count], dtype=float)
+        idfs = np.log(n_docs - dfs + 0.5) - np.log(dfs + 0.5)
+        eps = self.epsilon * float(np.dot(counts, idfs)) / float(counts.sum())
+
+        idf = {}
+        for term in query_freqs:
+            df = len(self.postings.get(term, ())) + (1 if with_query else 0)
+            if df == 0:
+                idf[term] = 0.0
+                continue
+            value = math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+            idf[term] = eps if value < 0 else value
+        return idf
+
+    def _csr_arrays(self) -> Tuple[Dict[str, int], np.ndarray, np.ndarray, np.ndarray]:
+        # (term -> row, indptr, document ids, term frequencies); rebuilt on the first query after a change
+        if self._csr is None:
+            vocab = {term: row for row, term in enumerate(self.postings)}
+            lengths = np.fromiter((len(posting) for posting in self.postings.values()), dtype=np.int64, count=len(self.postings))
+            indptr = np.zeros(len(self.postings) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            doc_ids = np.fromiter((doc_id for posting in self.postings.values() for doc_id in posting), dtype=np.int64, count=int(indptr[-1]))
+            tfs = np.fromiter((tf for posting in self.postings.values() for tf in posting.values()), dtype=float, count=int(indptr[-1]))
+            self._csr = (vocab, indptr, doc_ids, tfs)
+        return self._csr
+
+    def _doc_lengths(self) -> np.ndarray:
+        if self._doc_len_array is None:
+            self._doc_len_array = np.array(self.doc_len, dtype=float)
+        return self._doc_len_array
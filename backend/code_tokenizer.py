@@ -0,0 +1,62 @@
+import functools
+import re
+import threading
+from collections import OrderedDict
+from typing import FrozenSet, List, Tuple
+
+from nltk.corpus import stopwords
+
+from bm25_index import content_key
+
+SPLIT_PATTERN = re.compile(r'\W+')
+# getHTTPResponse2 -> get, HTTP, Response, 2; snake_case parts are split first
+SUBTOKEN_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+CUSTOM_STOP_WORDS = frozenset(['public', 'private', 'protected', 'void', 'int', 'double', 'float', 'string', 'package', 'junit', 'assert', 'import', 'class', 'cn', 'org'])
+
+
+@functools.lru_cache(maxsize=None)
+def english_stop_words() -> FrozenSet[str]:
+    # nltk reads the word list from disk on every call
+    return frozenset(stopwords.words('english'))
+
+
+class CodeTokenizer:
+    """Splits code into lowercase words for BM25, dropping English and Java stop words and one-letter words.
+
+    With `split_subtokens`, an identifier made of several camelCase or snake_case parts is followed by its parts
+    (`getValue` -> `getvalue`, `get`, `value`). Token lists are cached by content hash, so a document that appears in
+    several corpora (focal methods, coverage, tests) or is queried again is tokenized once.
+    """
+
+    def __init__(self, split_subtokens: bool = False, cache_size: int = 100_000):
+        self.split_subtokens = split_subtokens
+        self.stop_words = english_stop_words() | CUSTOM_STOP_WORDS
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[str, Tuple[str, ...]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, code: str) -> List[str]:
+        key = content_key(code)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                return list(tokens)
+        tokens = tuple(self.tokenize(code))
+        with self._lock:
+            self._cache[key] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return list(tokens)
+
+    def tokenize(self, code: str) -> List[str]:
+        stop_words = self.stop_words
+        if not self.split_subtokens:
+            return [token for token in (each.lower() for each in SPLIT_PATTERN.split(code)) if len(token) > 1 and token not in stop_words]
+        tokens = []
+        for word in SPLIT_PATTERN.split(code):
+            parts = [part.lower() for piece in word.split('_') for part in SUBTOKEN_PATTERN.findall(piece)]
+            for token in [word.lower()] + (parts if len(parts) > 1 else []):
+                if len(token) > 1 and token not in stop_words:
+                    tokens.append(token)
+        return tokens
@@ -16,6 +16,24 @@ class Configs:
         self.max_input_len = 4096
         self.max_num_generated_tokens = 1024
         self.verbose = True
+        # forward LLM output to the client chunk by chunk while it is being generated
+        self.stream_llm_output = global_config.getboolean('openai', 'stream', fallback=True)
+        # beam mode: race this many candidates per session in separate project copies (1 = one candidate at a time)
+        self.beam_width = global_config.getint('generation', 'beam_width', fallback=1)
+        self.beam_refine_width = global_config.getint('generation', 'beam_refine_width', fallback=2)
+        self.beam_temperature = global_config.getfloat('generation', 'beam_temperature', fallback=0.7)
+        # fast: javac + JUnit launcher against a cached classpath, falling back to Maven; maven: always run Maven
+        self.test_runner_engine = global_config.get('runner', 'engine', fallback='fast')
+        # lines of build output kept in memory per stream; the full output goes to test_case_run_log_dir/builds
+        self.build_log_tail_lines = global_config.getint('runner', 'log_tail_lines', fallback=2000)
+        # run_all_test_cases: tests compiled and run together in one JVM (1 = one Maven build per test)
+        self.test_batch_size = global_config.getint('runner', 'batch_size', fallback=50)
+        # seconds one javac run, one test run and one coverage report may take before they are killed (0 = unlimited)
+        self.stage_budgets = {
+            'compile': global_config.getfloat('timeouts', 'compile', fallback=300),
+            'execute': global_config.getfloat('timeouts', 'execute', fallback=120),
+            'coverage': global_config.getfloat('timeouts', 'coverage', fallback=120),
+        }
 
         if tester_path.strip():
             self.workspace = tester_path
@@ -29,6 +47,8 @@ class Configs:
         
         self.generation_log_dir = f'{self.workspace}/data/generation_logs/{project_name}'
         self.test_case_run_log_dir = f'{self.workspace}/data/test_case_running_logs/{project_name}'
+        self.workspace_pool_dir = f'{self.workspace}/data/workspaces'
+        self.classpath_cache_dir = f'{self.workspace}/data/classpath_cache'
 
         # dataset relevant paths
         self.coverage_human_labeled_dir = f'{self.root_dir}/data/collected_coverages'
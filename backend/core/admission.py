@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+
+from .exceptions import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], None]
+
+
+@dataclass
+class _PendingJob:
+    session_id: str
+    project_key: str
+    run: Callable[[], None]
+    on_position: Optional[PositionCallback] = None
+    on_cancel: Optional[Callable[[], None]] = None
+    last_position: int = field(default=-1)
+
+
+class GenerationPool:
+    """固定数量的生成 worker 与有界排队队列。
+
+    排队中的会话按项目轮转调度，避免单个繁忙项目占满所有 worker。
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        max_queued_per_project: int = 0,
+        retry_after: int = 30,
+    ) -> None:
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        self.workers = workers
+        self.queue_size = max(queue_size, 0)
+        self.max_queued_per_project = max(max_queued_per_project, 0)
+        self.retry_after = retry_after
+
+        self._queues: "OrderedDict[str, Deque[_PendingJob]]" = OrderedDict()
+        self._queued = 0
+        self._running: Dict[str, str] = {}  # session_id -> project_key
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads: List[threading.Thread] = []
+        for idx in range(workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"generation-worker-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(
+        self,
+        session_id: str,
+        project_key: str,
+        run: Callable[[], None],
+        on_position: Optional[PositionCallback] = None,
+        on_cancel: Optional[Callable[[], None]] = None,
+    ) -> int:
+        """提交一个生成任务，返回排队位置（0 表示会立即被 worker 领取）。"""
+        with self._cond:
+            if self._closed:
+                raise AdmissionRejected("Generation pool is shutting down", self.retry_after)
+            idle_workers = self.workers - len(self._running)
+            if self._queued - idle_workers >= self.queue_size:
+                raise AdmissionRejected("Generation queue is full", self.retry_after)
+            project_queue = self._queues.get(project_key)
+            if (
+                self.max_queued_per_project
+                and project_queue is not None
+                and len(project_queue) >= self.max_queued_per_project
+            ):
+                raise AdmissionRejected(f"Too many queued sessions for project {project_key}", self.retry_after)
+
+            job = _PendingJob(session_id, project_key, run, on_position, on_cancel)
+            self._queues.setdefault(project_key, deque()).append(job)
+            self._queued += 1
+            position = self._dispatch_order().index(job) + 1 - idle_workers
+            job.last_position = max(position, 0)
+            self._cond.notify()
+            return job.last_position
+
+    def cancel(self, session_id: str) -> bool:
+        """从队列中移除尚未开始的会话。"""
+        with self._cond:
+            job = self._remove_queued(session_id)
+            if job is None:
+                return False
+            self._notify_positions()
+        if job.on_cancel:
+            job.on_cancel()
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"workers": self.workers, "running": len(self._running), "queued": self._queued}
+
+    def shutdown(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queued and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._queued:
+                    return
+                job = self._pop_next()
+                self._running[job.session_id] = job.project_key
+                self._notify_positions()
+            try:
+                job.run()
+            except Exception:  # the job reports its own errors to the client
+                logger.error("Generation job %s failed", job.session_id, exc_info=True)
+            finally:
+                with self._cond:
+                    self._running.pop(job.session_id, None)
+
+    def _pop_next(self) -> _PendingJob:
+        # round-robin across projects: take the head of the first project, then rotate it to the back
+        project_key, project_queue = next(iter(self._queues.items()))
+        job = project_queue.popleft()
+        self._queued -= 1
+        del self._queues[project_key]
+        if project_queue:
+            self._queues[project_key] = project_queue
+        return job
+
+    def _remove_queued(self, session_id: str) -> Optional[_PendingJob]:
+        for project_key, project_queue in self._queues.items():
+            for job in project_queue:
+                if job.session_id == session_id:
+                    project_queue.remove(job)
+                    self._queued -= 1
+                    if not project_queue:
+                        del self._queues[project_key]
+                    return job
+        return None
+
+    def _dispatch_order(self) -> List[_PendingJob]:
+        queues = [list(q) for q in self._queues.values()]
+        order: List[_PendingJob] = []
+        depth = 0
+        while len(order) < self._queued:
+            for q in queues:
+                if depth < len(q):
+                    order.append(q[depth])
+            depth += 1
+        return order
+
+    def _notify_positions(self) -> None:
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.on_position and job.last_position != position:
+                job.last_position = position
+                try:
+                    job.on_position(position)
+                except Exception:
+                    logger.warning("Failed to notify queue position for %s", job.session_id, exc_info=True)
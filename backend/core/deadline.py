@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import time
+from typing import Optional
+
+from .exceptions import DeadlineExceeded
+
+
+class Deadline:
+    """一次会话或其中一个阶段的截止时间（单调时钟）。
+
+    会话开始时创建，贯穿生成、编译、运行与覆盖率各阶段：每个阶段通过 :meth:`for_stage` 取得自己的时间片，
+    时间片不会超过会话剩余的时间。``budget`` 为 None 表示不限时。
+    """
+
+    def __init__(self, budget: Optional[float] = None, name: str = "session", parent: Optional[Deadline] = None) -> None:
+        self.name = name
+        self.budget = budget
+        self.parent = parent
+        self.expires_at = None if budget is None else time.monotonic() + budget
+
+    def remaining(self) -> Optional[float]:
+        """剩余秒数（不小于 0）；自身与上级都不限时则返回 None。"""
+        remaining = None if self.expires_at is None else max(0.0, self.expires_at - time.monotonic())
+        if self.parent is not None:
+            parent_remaining = self.parent.remaining()
+            if remaining is None or (parent_remaining is not None and parent_remaining < remaining):
+                remaining = parent_remaining
+        return remaining
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def check(self) -> None:
+        """已到期则抛出 :class:`DeadlineExceeded`；上级先到期时，异常中的阶段是上级的。"""
+        if self.parent is not None:
+            self.parent.check()
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(self.name, self.budget)
+
+    def timeout(self, cap: Optional[float] = None) -> Optional[float]:
+        """单次调用（如一次 HTTP 请求）可用的超时：``cap`` 与剩余时间中较小者。"""
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        return remaining if cap is None else min(cap, remaining)
+
+    def for_stage(self, name: str, budget: Optional[float]) -> Deadline:
+        """从现在起最多 ``budget`` 秒的阶段时间片；``budget`` 为 None 或不大于 0 时只受本截止时间约束。"""
+        return Deadline(budget if budget and budget > 0 else None, name, parent=self)
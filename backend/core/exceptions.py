@@ -1,5 +1,34 @@
+from typing import Optional
+
+
 class GenerationCancelled(Exception):
     """Raised when a generation session is cancelled by the user."""
 
     def __init__(self, message: str = "Generation cancelled by user") -> None:
         super().__init__(message)
+
+
+class AdmissionRejected(Exception):
+    """Raised when the generation pool cannot accept another session."""
+
+    def __init__(self, message: str = "Generation queue is full", retry_after: int = 30) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay-only mode when a prompt has no recorded response."""
+
+    def __init__(self, key: str) -> None:
+        super().__init__(f"No cached LLM response for request {key} (replay-only mode)")
+        self.key = key
+
+
+class DeadlineExceeded(GenerationCancelled):
+    """Raised when a session, or one stage of it, runs past its time budget."""
+
+    def __init__(self, stage: str = "session", budget: Optional[float] = None) -> None:
+        budget_text = f" of {budget:.0f}s" if budget is not None else ""
+        super().__init__(f"The {stage} stage exceeded its time budget{budget_text}")
+        self.stage = stage
+        self.budget = budget
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any, Dict, Optional
+
+from .exceptions import LLMCacheMiss
+from .sqlite_store import SQLiteLRUStore
+
+CACHE_MODES = ("off", "on", "replay")
+
+
+class LLMResponseCache:
+    """按请求内容寻址的 LLM 响应缓存，基于 SQLite，可被多个进程共享。
+
+    mode:
+        off     不读不写；
+        on      命中则直接返回，未命中时调用模型并写入；
+        replay  只读回放，未命中抛出 ``LLMCacheMiss``，用于离线跑基准与 CI。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str = "on",
+        max_bytes: int = 512 * 1024 * 1024,
+        max_age: float = 30 * 24 * 3600,
+        evict_every: int = 50,
+    ) -> None:
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._store: Optional[SQLiteLRUStore] = None
+        if self.enabled:
+            self._store = SQLiteLRUStore(
+                path,
+                "responses",
+                {"model": "TEXT", "response": "TEXT NOT NULL"},
+                max_bytes,
+                max_age,
+                evict_every,
+                "LLM cache",
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        """请求参数（model、messages、temperature、top_p、seed、max_tokens 等）的 SHA-256。"""
+        canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, request: Dict[str, Any]) -> Optional[str]:
+        if not self.enabled:
+            return None
+        key = self.make_key(request)
+        row = self._store.get(key, ("response",))
+        # an empty answer is never served: callers retry until the model returns content
+        if row is None or not row[0].strip():
+            self.misses += 1
+            if self.mode == "replay":
+                raise LLMCacheMiss(key)
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, request: Dict[str, Any], response: str) -> None:
+        if self.mode != "on" or not response or not response.strip():
+            return
+        self._store.put(
+            self.make_key(request),
+            {"model": request.get("model"), "response": response},
+            len(response.encode("utf-8")),
+        )
+
+    def evict(self) -> None:
+        if self._store is not None:
+            self._store.evict()
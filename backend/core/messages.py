@@ -40,3 +40,31 @@ class NoRefMessage:
 
     def to_bytes(self) -> bytes:
         return _to_bytes({"type": "noreference", "data": self.data})
+
+
+@dataclass
+class MessageDelta:
+    """Only the messages changed since the previous update, each tagged with a sequence number.
+
+    ``data["length"]`` is the full conversation length after applying the delta; the client truncates
+    its copy to this length and then places every entry at its ``index``.
+    """
+
+    data: Dict[str, Any]
+
+    def to_bytes(self) -> bytes:
+        return _to_bytes({"type": "msg_delta", "data": self.data})
+
+
+@dataclass
+class MessageChunk:
+    """Partial text of the assistant message being generated at ``data["index"]``.
+
+    ``data["text"]`` replaces everything from ``data["offset"]`` on. Chunks are not sequence-numbered;
+    the complete message follows in a later ``msg_delta``.
+    """
+
+    data: Dict[str, Any]
+
+    def to_bytes(self) -> bytes:
+        return _to_bytes({"type": "msg_chunk", "data": self.data})
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import zlib
+from typing import Any, Dict, Optional
+
+from .sqlite_store import SQLiteLRUStore
+
+
+class TestOutcomeCache:
+    """按测试内容寻址的编译/运行结果缓存，基于 SQLite，可被多个进程共享。
+
+    键是测试源码、测试路径、JUnit 版本与项目快照指纹的 SHA-256；项目源码一变，指纹随之改变，旧条目自然失效，
+    之后按 ``max_age`` 与 ``max_bytes`` 淘汰。值是 JSON 结果，连同 zlib 压缩的覆盖率报告。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        enabled: bool = True,
+        max_bytes: int = 1024 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        evict_every: int = 50,
+    ) -> None:
+        self.path = path
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._store: Optional[SQLiteLRUStore] = None
+        if self.enabled:
+            self._store = SQLiteLRUStore(
+                path,
+                "outcomes",
+                {"outcome": "TEXT NOT NULL", "coverage": "BLOB"},
+                max_bytes,
+                max_age,
+                evict_every,
+                "test outcome cache",
+            )
+
+    @staticmethod
+    def make_key(test_case: str, test_path: str, junit_version: Any, fingerprint: str) -> str:
+        canonical = json.dumps([test_case, test_path, str(junit_version), fingerprint], ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """命中时返回结果字典；``coverage`` 为解压后的覆盖率报告（没有则为 None）。"""
+        if not self.enabled:
+            return None
+        row = self._store.get(key, ("outcome", "coverage"))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        outcome = json.loads(row[0])
+        outcome["coverage"] = zlib.decompress(row[1]) if row[1] is not None else None
+        return outcome
+
+    def put(self, key: str, outcome: Dict[str, Any], coverage: Optional[bytes] = None) -> None:
+        if not self.enabled:
+            return
+        payload = json.dumps(outcome, ensure_ascii=False)
+        compressed = zlib.compress(coverage) if coverage is not None else None
+        size = len(payload.encode("utf-8")) + (len(compressed) if compressed is not None else 0)
+        self._store.put(key, {"outcome": payload, "coverage": compressed}, size)
+
+    def evict(self) -> None:
+        if self._store is not None:
+            self._store.evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
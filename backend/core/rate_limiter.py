@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Mapping, Optional
+
+from .exceptions import GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """解析 ``x-ratelimit-reset-*`` 形式的时长，例如 ``20ms``、``1s``、``6m0s``。"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_from_headers(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None
+    return None
+
+
+class _Bucket:
+    """令牌桶；``capacity`` 为每分钟额度，0 表示不限制。"""
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def refill(self, now: float) -> None:
+        if self.unlimited:
+            return
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.unlimited:
+            return 0.0
+        # a request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        if not self.unlimited:
+            self.level -= amount
+
+    def cap(self, remaining: float) -> None:
+        if not self.unlimited:
+            self.level = min(self.level, remaining)
+
+
+class LLMRateLimiter:
+    """所有会话共享的 LLM 调用调度器。
+
+    - 按每分钟请求数 / token 数维护两个令牌桶，并依据响应头中的剩余额度校正；
+    - 遵守 ``Retry-After``：服务端要求退避时，所有等待中的调用一起暂停；
+    - 等待中的调用按会话轮转放行，避免单个会话的重试挤占其它会话；
+    - 记录等待时间，供 ``/metrics`` 导出以评估配额。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+    ) -> None:
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self._cond = threading.Condition()
+        self._waiting: "OrderedDict[str, Deque[object]]" = OrderedDict()
+        self._blocked_until = 0.0
+
+        self._granted = 0
+        self._throttled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._retry_after_total = 0.0
+
+    def acquire(self, session_key: str, tokens: int, cancel_check: Optional[Callable[[], bool]] = None) -> float:
+        """阻塞直到轮到该会话且额度足够，返回等待的秒数。"""
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._waiting.setdefault(session_key, deque()).append(ticket)
+            try:
+                while True:
+                    if cancel_check and cancel_check():
+                        raise GenerationCancelled()
+                    now = time.monotonic()
+                    self._requests.refill(now)
+                    self._tokens.refill(now)
+                    delay = self._blocked_until - now
+                    if self._is_next(session_key, ticket):
+                        delay = max(delay, self._requests.wait_time(1), self._tokens.wait_time(tokens))
+                        if delay <= 0:
+                            break
+                    # wake up periodically to notice cancellation
+                    self._cond.wait(timeout=min(max(delay, 0.05), 0.5))
+            finally:
+                self._remove_ticket(session_key, ticket)
+                self._cond.notify_all()
+
+            self._requests.take(1)
+            self._tokens.take(tokens)
+            waited = time.monotonic() - start
+            self._granted += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            if waited > 0.01:
+                self._throttled += 1
+        return waited
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self._tokens.take(actual_tokens - estimated_tokens)
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]) -> None:
+        """依据 ``x-ratelimit-remaining-*`` 校正本地额度。"""
+        if not headers:
+            return
+        with self._cond:
+            for bucket, name in ((self._requests, "requests"), (self._tokens, "tokens")):
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if remaining is None:
+                    continue
+                try:
+                    bucket.cap(float(remaining))
+                except ValueError:
+                    continue
+
+    def backoff(self, error: Exception, attempt: int) -> float:
+        """返回下一次重试前应等待的秒数；服务端给出 ``Retry-After`` 时对所有会话生效。"""
+        response = getattr(error, "response", None)
+        retry_after = retry_after_from_headers(getattr(response, "headers", None))
+        if retry_after is None and response is not None and getattr(response, "status_code", None) == 429:
+            retry_after = parse_duration(response.headers.get("x-ratelimit-reset-requests", "") or "")
+        if retry_after is not None:
+            with self._cond:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+                self._retry_after_total += retry_after
+            logger.warning("LLM provider asked to retry after %.1fs, pausing all sessions", retry_after)
+            return retry_after
+        return self.backoff_delay(attempt)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """带完全抖动的指数退避，避免多个会话在同一时刻重试。"""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "granted": self._granted,
+                "throttled": self._throttled,
+                "waiting": sum(len(q) for q in self._waiting.values()),
+                "wait_seconds_total": round(self._wait_total, 3),
+                "wait_seconds_avg": round(self._wait_total / self._granted, 3) if self._granted else 0.0,
+                "wait_seconds_max": round(self._wait_max, 3),
+                "retry_after_seconds_total": round(self._retry_after_total, 3),
+            }
+
+    def _is_next(self, session_key: str, ticket: object) -> bool:
+        # round-robin: the first session in the order goes first, and moves to the back once served
+        first_key, first_queue = next(iter(self._waiting.items()))
+        return first_key == session_key and first_queue[0] is ticket
+
+    def _remove_ticket(self, session_key: str, ticket: object) -> None:
+        queue = self._waiting.get(session_key)
+        if queue is None:
+            return
+        queue.remove(ticket)
+        del self._waiting[session_key]
+        if queue:
+            self._waiting[session_key] = queue
@@ -1,16 +1,22 @@
 from __future__ import annotations
 
 import threading
+from collections import OrderedDict
 from typing import Dict, Iterable, Optional
 
 from .session import ModelQuerySession
 
 
 class SessionRegistry:
-    """线程安全的会话注册表。"""
+    """线程安全的会话注册表。
 
-    def __init__(self) -> None:
+    已结束的会话会在 ``_recent`` 中保留一段时间，便于断线的客户端通过 resume 补齐最后的消息。
+    """
+
+    def __init__(self, keep_recent: int = 32) -> None:
         self._sessions: Dict[str, ModelQuerySession] = {}
+        self._recent: "OrderedDict[str, ModelQuerySession]" = OrderedDict()
+        self._keep_recent = keep_recent
         self._lock = threading.Lock()
 
     def register(self, session: ModelQuerySession) -> None:
@@ -19,12 +25,20 @@ class SessionRegistry:
 
     def remove(self, session_id: str) -> None:
         with self._lock:
-            self._sessions.pop(session_id, None)
+            session = self._sessions.pop(session_id, None)
+            if session is not None and self._keep_recent > 0:
+                self._recent[session_id] = session
+                while len(self._recent) > self._keep_recent:
+                    self._recent.popitem(last=False)
 
     def get(self, session_id: str) -> Optional[ModelQuerySession]:
         with self._lock:
             return self._sessions.get(session_id)
 
+    def get_resumable(self, session_id: str) -> Optional[ModelQuerySession]:
+        with self._lock:
+            return self._sessions.get(session_id) or self._recent.get(session_id)
+
     def list_active_ids(self) -> Iterable[str]:
         with self._lock:
             return tuple(self._sessions.keys())
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 import logging
 import threading
-from typing import Any, Callable, Dict, List
+import time
+from typing import Any, Callable, Dict, List, Optional
 
-from .exceptions import GenerationCancelled
-from .messages import ModelMessage, NoRefMessage, StatusMessage
+from .deadline import Deadline
+from .exceptions import DeadlineExceeded, GenerationCancelled
+from .messages import MessageChunk, MessageDelta, NoRefMessage, StatusMessage
 
 logger = logging.getLogger(__name__)
 
@@ -31,17 +33,35 @@ class ModelQuerySession:
         writer: ResponseWriter,
         executor: QueryExecutor,
         junit_version: int,
+        resume_grace: float = 0.0,
+        stream_flush_interval: float = 0.05,
+        budget: Optional[float] = None,
     ) -> None:
         self.session_id = session_id
         self.raw_data = raw_data
-        self._writer = writer
+        self._writer: Optional[ResponseWriter] = writer
         self._executor = executor
         self.junit_version = junit_version
+        self.resume_grace = resume_grace
+        self.stream_flush_interval = stream_flush_interval
+        # wall-clock budget of the whole generation, counted from start_query (queueing is not charged)
+        self.budget = budget
+        self.deadline = Deadline(None)
 
         self.messages: List[Dict[str, Any]] = []
+        self._message_seqs: List[int] = []
+        self._last_seq = 0
+        self._write_lock = threading.RLock()
+        self._detached_at: Optional[float] = None
+        self._stream_text = ""
+        self._stream_pending: List[str] = []
+        self._stream_flushed_at = 0.0
         self.query_data = {field: self.raw_data[field] for field in self.required_fields}
         self._session_running = False
         self._cancel_event = threading.Event()
+        self._closed_event = threading.Event()
+        self._close_callbacks: List[Callable[[], None]] = []
+        self._close_lock = threading.Lock()
 
     def start_query(self) -> None:
         if self._session_running:
@@ -49,17 +69,71 @@ class ModelQuerySession:
             return
         self._session_running = True
         logger.info("Starting query session %s", self.session_id)
+        self.deadline = Deadline(self.budget if self.budget and self.budget > 0 else None)
         try:
             self._executor(self.query_data, self)
+        except DeadlineExceeded as exc:
+            self._on_timeout(exc.stage, exc.budget)
         except GenerationCancelled:
-            logger.info("Query session %s cancelled by user", self.session_id)
+            # waits (workspace lease, rate limiter) stop through the same check once the budget is spent
+            if self.deadline.expired():
+                self._on_timeout("session", self.budget)
+            else:
+                logger.info("Query session %s cancelled by user", self.session_id)
         finally:
             self._session_running = False
 
     def update_messages(self, messages: List[Dict[str, Any]]) -> None:
-        self.messages = messages
-        data_to_send = {"session_id": self.session_id, "messages": messages}
-        self._safe_write(ModelMessage(data_to_send).to_bytes())
+        """发送相对上一次更新的增量：公共前缀保持原序号，其后的消息分配新的序号。"""
+        with self._write_lock:
+            # the complete message supersedes any partial text still buffered
+            self._reset_stream()
+            start = 0
+            limit = min(len(self.messages), len(messages))
+            while start < limit and self.messages[start] == messages[start]:
+                start += 1
+            if start == len(messages) == len(self.messages):
+                return
+
+            # copy so later in-place edits by the generator show up as changes
+            self.messages = [dict(message) for message in messages]
+            del self._message_seqs[start:]
+            for _ in range(start, len(messages)):
+                self._last_seq += 1
+                self._message_seqs.append(self._last_seq)
+            self._write_delta(start)
+
+    def resume(self, writer: ResponseWriter, last_seq: int) -> None:
+        """重新绑定客户端连接，并补发序号大于 ``last_seq`` 的消息。"""
+        with self._write_lock:
+            self._writer = writer
+            self._detached_at = None
+            logger.info("Session %s resumed from seq %s", self.session_id, last_seq)
+            self.write_start_message()
+            first_missing = next(
+                (index for index, seq in enumerate(self._message_seqs) if seq > last_seq),
+                len(self._message_seqs),
+            )
+            self._write_delta(first_missing)
+            if self._stream_text:
+                self._write_chunk(self._stream_text, 0)
+            if self._closed_event.is_set():
+                self.write_finish_message()
+
+    def append_stream_text(self, text: str) -> None:
+        """缓冲正在生成的助手消息片段，每个 ``stream_flush_interval`` 时间窗内最多写出一次。"""
+        with self._write_lock:
+            self._stream_pending.append(text)
+            if time.monotonic() - self._stream_flushed_at >= self.stream_flush_interval:
+                self._flush_stream()
+
+    def flush_stream(self) -> None:
+        with self._write_lock:
+            self._flush_stream()
+
+    @property
+    def last_seq(self) -> int:
+        return self._last_seq
 
     def write_start_message(self) -> None:
         self._safe_write(StatusMessage("start", {"session_id": self.session_id}).to_bytes())
@@ -68,18 +142,100 @@ class ModelQuerySession:
         payload = {"session_id": self.session_id, "junit_version": self.junit_version}
         self._safe_write(NoRefMessage(payload).to_bytes())
 
+    def write_queued_message(self, position: int) -> None:
+        payload = {"session_id": self.session_id, "position": position}
+        self._safe_write(StatusMessage("queued", payload).to_bytes())
+
+    def write_build_progress(self, lines: List[str]) -> None:
+        """转发编译/测试运行中新产生的输出行。"""
+        payload = {"session_id": self.session_id, "lines": lines}
+        self._safe_write(StatusMessage("build_progress", payload).to_bytes())
+
+    def write_timeout_message(self, stage: str, budget: Optional[float]) -> None:
+        payload = {"session_id": self.session_id, "stage": stage, "budget": budget}
+        self._safe_write(StatusMessage("timeout", payload).to_bytes())
+
     def write_finish_message(self) -> None:
         self._safe_write(StatusMessage("finish", {"session_id": self.session_id}).to_bytes())
 
+    def close(self) -> None:
+        """标记会话已结束（finish 已发出或出错），等待中的 resume 连接随之结束。"""
+        with self._close_lock:
+            self._closed_event.set()
+            callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_close_callback(self, callback: Callable[[], None]) -> None:
+        """会话结束时调用 ``callback``（在调用 :meth:`close` 的线程中）；已结束则立即调用。"""
+        with self._close_lock:
+            if not self._closed_event.is_set():
+                self._close_callbacks.append(callback)
+                return
+        callback()
+
+    def wait_closed(self, timeout: Optional[float] = None) -> bool:
+        return self._closed_event.wait(timeout)
+
     def request_stop(self) -> None:
         self._cancel_event.set()
 
     def should_stop(self) -> bool:
-        return self._cancel_event.is_set()
+        if self._cancel_event.is_set():
+            return True
+        detached_at = self._detached_at
+        if detached_at is not None and time.monotonic() - detached_at >= self.resume_grace:
+            logger.info("Session %s was not resumed within %ss, stopping", self.session_id, self.resume_grace)
+            self.request_stop()
+            return True
+        return False
+
+    def _on_timeout(self, stage: str, budget: Optional[float]) -> None:
+        logger.warning("Query session %s timed out in the %s stage (budget %ss)", self.session_id, stage, budget)
+        self.flush_stream()
+        self.write_timeout_message(stage, budget)
+
+    def _flush_stream(self) -> None:
+        self._stream_flushed_at = time.monotonic()
+        if not self._stream_pending:
+            return
+        text = "".join(self._stream_pending)
+        self._stream_pending = []
+        offset = len(self._stream_text)
+        self._stream_text += text
+        self._write_chunk(text, offset)
+
+    def _reset_stream(self) -> None:
+        self._stream_text = ""
+        self._stream_pending = []
+        self._stream_flushed_at = 0.0
+
+    def _write_chunk(self, text: str, offset: int) -> None:
+        data_to_send = {"session_id": self.session_id, "index": len(self.messages), "offset": offset, "text": text}
+        self._safe_write(MessageChunk(data_to_send).to_bytes())
+
+    def _write_delta(self, start: int) -> None:
+        entries = [
+            {"seq": self._message_seqs[index], "index": index, **self.messages[index]}
+            for index in range(start, len(self.messages))
+        ]
+        data_to_send = {
+            "session_id": self.session_id,
+            "seq": self._last_seq,
+            "length": len(self.messages),
+            "messages": entries,
+        }
+        self._safe_write(MessageDelta(data_to_send).to_bytes())
 
     def _safe_write(self, payload: bytes) -> None:
-        try:
-            self._writer(payload)
-        except BrokenPipeError:
-            logger.warning("Connection closed for session %s", self.session_id)
-            self.request_stop()
+        with self._write_lock:
+            if self._writer is None:
+                return
+            try:
+                self._writer(payload)
+            except ConnectionError:
+                logger.warning("Connection closed for session %s", self.session_id)
+                self._writer = None
+                self._detached_at = time.monotonic()
+                if self.resume_grace <= 0:
+                    self.request_stop()
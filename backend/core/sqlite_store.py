@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteLRUStore:
+    """按键寻址的 SQLite 表，按最近访问时间与总大小淘汰，可被多个进程共享（WAL）。
+
+    表由 ``key`` 主键、调用方给出的数据列 ``columns``（列名到 SQL 类型）以及 ``size``、``created_at``、
+    ``accessed_at`` 组成；读取会刷新 ``accessed_at``，每写入 ``evict_every`` 次淘汰一次。键的构造与数据列的
+    编码由调用方负责。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        table: str,
+        columns: Dict[str, str],
+        max_bytes: int,
+        max_age: float,
+        evict_every: int = 50,
+        description: str = "cache",
+    ) -> None:
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.description = description
+
+        self._local = threading.local()
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        column_defs = "".join(f" {name} {sql_type}," for name, sql_type in columns.items())
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY,{column_defs}"
+                " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table}(accessed_at)")
+
+    def get(self, key: str, columns: Sequence[str]) -> Optional[Tuple[Any, ...]]:
+        """``key`` 对应行中 ``columns`` 的值，未命中返回 None。"""
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(columns)} FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, values: Dict[str, Any], size: int) -> None:
+        """写入（或覆盖）``key`` 的数据列，``size`` 计入淘汰用的总大小。"""
+        names = ["key", *values, "size", "created_at", "accessed_at"]
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                (key, *values.values(), size, now, now),
+            )
+        with self._lock:
+            self._puts_since_evict += 1
+            should_evict = self._puts_since_evict >= self.evict_every
+            if should_evict:
+                self._puts_since_evict = 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """先删除超过 ``max_age`` 未被访问的条目，再按最近访问时间淘汰直到总大小不超过 ``max_bytes``。"""
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE accessed_at < ?", (time.time() - self.max_age,))
+            total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            freed = 0
+            stale_keys = []
+            for key, size in conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at"):
+                stale_keys.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", stale_keys)
+            logger.info("Evicted %s %s entries (%s bytes)", len(stale_keys), self.description, freed)
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads; keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
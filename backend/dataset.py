@@ -165,8 +165,11 @@ class Dataset:
 
         return desc_dict
         
+    def offline_fact_ref_data_path(self, reference_setting = 'retrieve', fact_setting = 'disc', test_desc_setting = 'full', max_exploration_depth = 5, retrieval_threshold = 0.2):
+        return f'{self.configs.fact_set_dir}/ref_{reference_setting}_fact_{fact_setting}_desc_{test_desc_setting}_depth_{max_exploration_depth}_refThres_{retrieval_threshold}.json'
+
     def load_offline_fact_ref_data(self, reference_setting = 'retrieve', fact_setting = 'disc', test_desc_setting = 'full', max_exploration_depth = 5, retrieval_threshold = 0.2):
-        save_path = f'{self.configs.fact_set_dir}/ref_{reference_setting}_fact_{fact_setting}_desc_{test_desc_setting}_depth_{max_exploration_depth}_refThres_{retrieval_threshold}.json'
+        save_path = self.offline_fact_ref_data_path(reference_setting, fact_setting, test_desc_setting, max_exploration_depth, retrieval_threshold)
         with open(save_path, 'r') as f:
             fact_ref_data = json.load(f)
         return fact_ref_data
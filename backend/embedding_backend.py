@@ -0,0 +1,140 @@
+import logging
+import os
+from typing import List, Optional
+
+import torch
+
+from user_config import global_config
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "Salesforce/codet5p-110m-embedding"
+
+
+def model_name(model=None) -> str:
+    """Short name of a model loaded with transformers (`codet5p-110m-embedding`), of the default one when None."""
+    name_or_path = EMBEDDING_MODEL if model is None else getattr(model, 'name_or_path', '')
+    return os.path.basename(name_or_path.rstrip('/\\')) or type(model).__name__
+
+
+class EmbeddingBackend:
+    """Encodes texts with the embedding model in batches of texts of similar token length.
+
+    Texts are tokenized once, sorted by length and cut into batches that are each padded only to their own longest
+    text, so a batch of short descriptions does not pay for the longest one in the corpus. Embeddings come back in the
+    order of the texts. Subclasses run the model on one padded batch.
+
+    `name` identifies the model and its quantization; embeddings of backends with different names are not comparable.
+    """
+
+    def __init__(self, tokenizer, batch_size: int = 32, name: str = EMBEDDING_MODEL.split('/')[-1]) -> None:
+        self.name = name
+        self.tokenizer = tokenizer
+        self.batch_size = max(1, batch_size)
+        self.device = 'cpu'
+
+    def encode(self, texts: List[str]) -> torch.Tensor:
+        """Embeddings of `texts`, (len(texts), dim) on `self.device`."""
+        if not texts:
+            return torch.empty(0, 0, device=self.device)
+        input_ids = self.tokenizer(list(texts), truncation=True)['input_ids']
+        order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]))
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            padded = self.tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, padding='longest', return_tensors='pt')
+            batch_embeddings = self._forward(padded['input_ids'], padded['attention_mask'])
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+        return torch.stack(embeddings)
+
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class TorchEmbeddingBackend(EmbeddingBackend):
+    """The PyTorch model on CUDA when available, otherwise on CPU, optionally with int8 dynamic quantization on CPU."""
+
+    def __init__(self, model, tokenizer, device: str = 'auto', num_threads: int = 0, quantize: bool = False, batch_size: int = 32) -> None:
+        super().__init__(tokenizer, batch_size, model_name(model))
+        self.device = ('cuda' if torch.cuda.is_available() else 'cpu') if device == 'auto' else device
+        if num_threads > 0:
+            # process-wide: also caps the threads of any other torch work in this process
+            torch.set_num_threads(num_threads)
+        model = model.eval().to(self.device)
+        if quantize:
+            if self.device == 'cpu':
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                self.name = f'{self.name}-torch-int8'
+            else:
+                logger.warning('int8 quantization is only applied on CPU, running the model on %s unquantized', self.device)
+        self.model = model
+
+    @torch.no_grad()
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(input_ids.to(self.device), attention_mask=attention_mask.to(self.device))
+
+
+class OnnxEmbeddingBackend(EmbeddingBackend):
+    """The model exported to ONNX (see `export_onnx`) and run on CPU with onnxruntime."""
+
+    def __init__(self, model_path: str, tokenizer, num_threads: int = 0, batch_size: int = 32) -> None:
+        super().__init__(tokenizer, batch_size, os.path.splitext(os.path.basename(model_path))[0])
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError('the onnx embedding backend needs onnxruntime (pip install -r requirements-onnx.txt)') from e
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+    def _forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(None, {'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+def export_onnx(model, path: str, quantize: bool = False) -> None:
+    """Export `model` to `path` with dynamic batch and sequence axes; with `quantize`, its weights are int8."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fp32_path = f'{path}.fp32.onnx' if quantize else path
+    dummy = torch.ones(1, 8, dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval().cpu(), (dummy, {'attention_mask': dummy}), fp32_path,
+            input_names=['input_ids', 'attention_mask'], output_names=['embeddings'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'embeddings': {0: 'batch'}},
+            opset_version=14,
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+
+
+def load_embedding_backend(model=None, tokenizer=None) -> EmbeddingBackend:
+    """The backend configured in the [embedding] section, for `model`/`tokenizer` or the default embedding model."""
+    from transformers import AutoModel, AutoTokenizer
+
+    backend = global_config.get('embedding', 'backend', fallback='torch')
+    num_threads = global_config.getint('embedding', 'threads', fallback=0)
+    quantize = global_config.getboolean('embedding', 'quantize', fallback=False)
+    batch_size = global_config.getint('embedding', 'batch_size', fallback=32)
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(getattr(model, 'name_or_path', '') or EMBEDDING_MODEL, trust_remote_code=True)
+    if backend == 'onnx':
+        # named after the model, so another model is exported next to the default one instead of reusing its export
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'embedding_model', f"{model_name(model)}{'-int8' if quantize else ''}.onnx")
+        model_path = os.path.expanduser(global_config.get('embedding', 'onnx_path', fallback='') or default_path)
+        if not os.path.exists(model_path):
+            if model is None:
+                model = AutoModel.from_pretrained(EMBEDDING_MODEL, trust_remote_code=True)
+            logger.info('Exporting the embedding model to %s', model_path)
+            export_onnx(model, model_path, quantize)
+        return OnnxEmbeddingBackend(model_path, tokenizer, num_threads, batch_size)
+    if backend != 'torch':
+        raise ValueError(f'unknown embedding backend: {backend}')
+    if model is None:
+        model = AutoModel.from_pretrained(EMBEDDING_MODEL, trust_remote_code=True)
+    device = global_config.get('embedding', 'device', fallback='auto')
+    return TorchEmbeddingBackend(model, tokenizer, device, num_threads, quantize, batch_size)
@@ -0,0 +1,165 @@
+import os
+import pickle
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking between processes
+    fcntl = None
+
+from bm25_index import content_key
+
+STORE_FORMAT = 1
+
+
+class EmbeddingStore:
+    """Embeddings keyed by the content hash of their text, in a float16 matrix memory-mapped read-only from a `.npy`.
+
+    On disk the store is an index at `path` (the content hash of each row and the name of the matrix file) next to the
+    matrix itself. Matrix files are never modified: adding embeddings writes a new one with the old rows followed by the
+    new ones, then replaces the index. A process that mapped the previous matrix keeps a consistent view, and every
+    process that maps the current one shares its pages through the page cache instead of holding a private copy.
+    Server processes sharing the store hold a lock on `<path>.lock` (shared to load, exclusive to append), so an
+    append never misses rows another process added and matrix files are only deleted once no index names them.
+    Without a path the matrix is kept in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.matrix: Optional[np.ndarray] = None
+        self._matrix_name: Optional[str] = None
+        self._loaded = path is None
+        self._lock = threading.Lock()
+
+    def rows_for(self, texts: List[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Row of each of `texts` in `matrix`, first adding the embeddings (from `encode`) of texts not in the store."""
+        keys = [content_key(text) for text in texts]
+        with self._lock:
+            if not self._loaded:
+                with self._file_lock(exclusive=False):
+                    self._load()
+            missing = self._missing(texts, keys)
+            if missing and self.path is not None:
+                # another process may have added them since the store was loaded
+                with self._file_lock(exclusive=False):
+                    self._load()
+                missing = self._missing(texts, keys)
+            if missing:
+                # encoded without holding the file lock, which only covers the quick reload and write
+                embeddings = np.asarray(encode(list(missing.values())), dtype=np.float16)
+                with self._file_lock(exclusive=True):
+                    self._load()
+                    new = [i for i, key in enumerate(missing) if key not in self.rows]
+                    if new:
+                        self._append([list(missing)[i] for i in new], embeddings[new])
+            return np.array([self.rows[key] for key in keys], dtype=np.int64)
+
+    def similarities(self, queries: np.ndarray, rows: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+        """queries @ matrix[rows].T as float32, (len(queries), len(rows)).
+
+        The rows are read and converted to float32 `chunk_size` at a time, so the mapped matrix is never copied whole.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        result = np.empty((len(queries), len(rows)), dtype=np.float32)
+        if len(queries) == 0 or len(rows) == 0:
+            return result
+        matrix = self.matrix
+        for start in range(0, len(rows), chunk_size):
+            block = matrix[rows[start:start + chunk_size]].astype(np.float32)
+            np.matmul(queries, block.T, out=result[:, start:start + chunk_size])
+        return result
+
+    def _missing(self, texts: List[str], keys: List[str]) -> Dict[str, str]:
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in self.rows and key not in missing:
+                missing[key] = text
+        return missing
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool) -> Iterator[None]:
+        if self.path is None or fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+        if not isinstance(state, dict) or state.get('format') != STORE_FORMAT:
+            return
+        if state['matrix'] == self._matrix_name:
+            return
+        try:
+            matrix = np.load(os.path.join(os.path.dirname(os.path.abspath(self.path)), state['matrix']), mmap_mode='r')
+        except (OSError, ValueError):
+            return
+        self.keys = state['keys'][:len(matrix)]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.matrix = matrix
+        self._matrix_name = state['matrix']
+
+    def _append(self, keys: List[str], embeddings: np.ndarray) -> None:
+        if self.matrix is not None and self.matrix.shape[1] != embeddings.shape[1]:
+            # made by another model: start over
+            self.keys, self.rows, self.matrix = [], {}, None
+        n_rows = 0 if self.matrix is None else len(self.matrix)
+        if self.path is None:
+            self.matrix = embeddings if self.matrix is None else np.concatenate([self.matrix, embeddings])
+        else:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            name = f'{os.path.basename(self.path)}.{uuid.uuid4().hex[:12]}.npy'
+            tmp_path = os.path.join(directory, f'{name}.tmp')
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(n_rows + len(embeddings), embeddings.shape[1]))
+            if n_rows:
+                out[:n_rows] = self.matrix
+            out[n_rows:] = embeddings
+            out.flush()
+            del out
+            os.replace(tmp_path, os.path.join(directory, name))
+            self._save_index(name, self.keys + keys)
+            previous = self._matrix_name
+            self.matrix = np.load(os.path.join(directory, name), mmap_mode='r')
+            self._matrix_name = name
+            self._remove_stale_matrices(directory, previous)
+        for row, key in enumerate(keys, n_rows):
+            self.rows[key] = row
+        self.keys = self.keys + keys
+
+    def _remove_stale_matrices(self, directory: str, previous: Optional[str]) -> None:
+        # processes that still map a removed matrix keep their pages until they unmap it
+        prefix = f'{os.path.basename(self.path)}.'
+        if fcntl is None:
+            # without the lock another process may be between writing its matrix and its index: only drop our own
+            stale = [previous] if previous is not None else []
+        else:
+            # under the exclusive lock: the index just written names the only matrix still in use
+            stale = [name for name in os.listdir(directory)
+                     if name.startswith(prefix) and name.endswith(('.npy', '.npy.tmp')) and name != self._matrix_name]
+        for name in stale:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _save_index(self, matrix_name: str, keys: List[str]) -> None:
+        state = {'format': STORE_FORMAT, 'matrix': matrix_name, 'keys': keys}
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
@@ -1,8 +1,16 @@
 from ast import arg
+import os
+import sys
 import subprocess
 from bs4 import BeautifulSoup
 import logging
 
+try:
+    from jacoco_coverage import lines_coverage_from_html_path
+except ImportError:  # run as a script from this directory
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from jacoco_coverage import lines_coverage_from_html_path
+
 logger = logging.getLogger(__name__)
 
 method_lines_jar_path_new = "../javaparser_utils/javaparser-method-lines-1.0-SNAPSHOT-shaded.jar"
@@ -164,6 +172,10 @@ def get_jacoco_report(base_path, test_class_name, test_method_name, org_name, te
 # jacoco_path (path of relevant jacoco report) = '/bernard/dataset_construction/prep/repos/spark/target/site/jacoco/spark/utils/CollectionUtils.java.html'
 # get the covered and uncovered lines within the focal file
 def get_lines_coverage(jacoco_path):
+    # the jacoco.xml next to the HTML report has the same lines and is much cheaper to read
+    lines_coverage = lines_coverage_from_html_path(jacoco_path)
+    if lines_coverage is not None:
+        return lines_coverage
     with open(jacoco_path) as f:
         soup = BeautifulSoup(f, 'html.parser')
         # find all spans with class 'fc' or 'pc' or 'bpc', and extract the ID
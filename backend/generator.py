@@ -1,14 +1,40 @@
 import json
 import os
 import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
 
 from pyexpat.errors import messages
 
 from core.session import ModelQuerySession
-from core.exceptions import GenerationCancelled
+from core.exceptions import DeadlineExceeded, GenerationCancelled
 from configs import Configs
 from agents import TestGenAgent, TestRefineAgent
 from test_case_runner import TestCaseRunner
+from workspace_pool import workspace_pools
+
+# how close a failing candidate is to passing: it compiles and runs but an assertion fails > it compiles > it does not compile
+STATUS_RANK = {'success': 3, 'fail_pass': 2, 'fail_execute': 1, 'timeout': 1, 'fail_compile': 0}
+
+
+class Candidate:
+    """One beam candidate: its own agents, test runner, copy of the project and conversation."""
+
+    def __init__(self, index, test_case_path, test_gen_agent, test_refine_agent, test_runner):
+        self.index = index
+        self.test_case_path = test_case_path
+        self.test_gen_agent = test_gen_agent
+        self.test_refine_agent = test_refine_agent
+        self.test_runner = test_runner
+        self.test_case = None
+        self.test_status = None
+        self.error_msg = ''
+        self.messages = []
+
+    def rank(self):
+        # fewer error lines is closer to passing; the deterministic candidate 0 wins ties
+        return (STATUS_RANK.get(self.test_status, -1), -len(self.error_msg.split('\n')), -self.index)
 
 
 class IntentionTester:
@@ -16,6 +42,9 @@ class IntentionTester:
         self.configs = configs
         self.max_round = max_round
         self.max_line_error_msg = 20
+        self.skip_deepseek_think = skip_deepseek_think
+        self.junit_version = None
+        self._beam_agents = []  # (TestGenAgent, TestRefineAgent, TestCaseRunner) for candidates after the first
 
         self.test_gen_agent = TestGenAgent(configs.llm_name, configs.project_name, configs.project_url, n_responses=1, skip_deepseek_think=skip_deepseek_think)
         self.test_refine_agent = TestRefineAgent(configs.llm_name, configs.project_name, configs.project_url, n_responses=1, skip_deepseek_think=skip_deepseek_think)
@@ -34,7 +63,25 @@ class IntentionTester:
         if self.query_session:
             self.query_session.update_messages(messages)
 
+    def _stream_to_remote(self, base_messages):
+        # show the prompt right away, then the assistant reply as it streams in after `base_messages`
+        if not (self.query_session and self.configs.stream_llm_output):
+            return None
+        query_session = self.query_session
+
+        def on_stream(prompt_messages, text):
+            if text == '':
+                query_session.update_messages(base_messages + prompt_messages)
+            elif text is None:
+                query_session.flush_stream()
+            else:
+                query_session.append_stream_text(text)
+
+        return on_stream
+
     def _ensure_not_cancelled(self):
+        if self.query_session:
+            self.query_session.deadline.check()
         if self.query_session and self.query_session.should_stop():
             raise GenerationCancelled()
 
@@ -43,11 +90,45 @@ class IntentionTester:
                                        referable_test_case, facts, junit_version,
                                        prohibit_fact: bool = False, query_session: ModelQuerySession | None = None):
         self.generation_with_refine_log = []
+        self.junit_version = junit_version
         self.query_session = query_session
         self._apply_cancel_hook()
         self._ensure_not_cancelled()
 
         target_test_class_name = target_test_case_path.split('/')[-1].replace('.java', '')
+        # tests are compiled and run in leased copies of the project, so concurrent sessions never share a target/ directory
+        pool = workspace_pools.get(self._workspace_source_dir(target_test_case_path), self.configs.workspace_pool_dir)
+        with ExitStack() as leases:
+            if self.configs.beam_width > 1:
+                gen_test_case, test_status, messages = self.generate_test_case_with_beam(
+                    target_focal_method, target_context, target_test_class_name, target_test_case_desc, target_test_case_path,
+                    referable_test_case, facts, junit_version, prohibit_fact, pool, leases)
+            else:
+                workspace = leases.enter_context(pool.lease(self._cancel_check))
+                gen_test_case, test_status, messages = self._generate_serial(
+                    target_focal_method, target_context, target_test_class_name, target_test_case_desc, workspace.map_path(target_test_case_path),
+                    referable_test_case, facts, junit_version, prohibit_fact)
+
+        # leave the final test in the project, as running it in place used to
+        if gen_test_case:
+            os.makedirs(os.path.dirname(target_test_case_path), exist_ok=True)
+            # a new file replaces the old one: workspaces hard link the original's files, writing in place would change them too
+            tmp_path = f'{target_test_case_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                f.write(gen_test_case)
+            os.replace(tmp_path, target_test_case_path)
+        return gen_test_case, test_status, messages
+
+    def _workspace_source_dir(self, target_test_case_path):
+        # copy the whole project when the test belongs to it, so a module still finds its parent pom
+        project_dir = self.configs.project_without_test_file_path
+        if target_test_case_path.startswith(project_dir + '/'):
+            return project_dir
+        return target_test_case_path.split('/src/test/')[0]
+
+    def _generate_serial(self, target_focal_method, target_context, target_test_class_name, target_test_case_desc, target_test_case_path,
+                         referable_test_case, facts, junit_version, prohibit_fact):
+        self.test_gen_agent.set_stream_callback(self._stream_to_remote([]))
         gen_test_case, prompt, messages = self.generate_test_case(target_focal_method, target_context, target_test_class_name, target_test_case_desc, referable_test_case, facts, junit_version, prohibit_fact)
         self.update_messages_to_remote(messages)
         self._ensure_not_cancelled()
@@ -56,10 +137,12 @@ class IntentionTester:
 
         if test_status == 'success':
             messages = self.finish_generate()
+            self.update_messages_to_remote(messages)
             return gen_test_case, test_status, messages
 
         for round in range(self.max_round):
             self._ensure_not_cancelled()
+            self.test_refine_agent.set_stream_callback(self._stream_to_remote(messages))
             gen_test_case, prompt, refine_messages = self.refine(gen_test_case, error_msg, target_focal_method, target_context, target_test_case_desc, target_test_case_path, facts, prohibit_fact)
             messages += refine_messages
             self.update_messages_to_remote(messages)
@@ -74,8 +157,133 @@ class IntentionTester:
 
         return gen_test_case, test_status, messages
 
+    def generate_test_case_with_beam(self, target_focal_method, target_context, target_test_class_name, target_test_case_desc, target_test_case_path,
+                                     referable_test_case, facts, junit_version, prohibit_fact, pool, leases):
+        candidates = self._prepare_candidates(target_test_case_path, pool, leases)
+        beam_done = threading.Event()
+
+        def generate(candidate):
+            candidate.test_case, prompt, candidate.messages = candidate.test_gen_agent.generate_test_case(
+                target_focal_method, target_context, target_test_class_name, target_test_case_desc, referable_test_case, facts, junit_version, prohibit_fact)
+            self._run_candidate(candidate, prompt, beam_done)
+
+        def refine(candidate):
+            error_msg_cut = '\n'.join(candidate.error_msg.split('\n')[:self.max_line_error_msg])
+            candidate.test_case, prompt, refine_messages = candidate.test_refine_agent.refine(
+                candidate.test_case, error_msg_cut, target_focal_method, target_context, target_test_case_desc, facts, prohibit_fact)
+            candidate.messages = candidate.messages + refine_messages
+            self._run_candidate(candidate, prompt, beam_done)
+
+        # the first candidate keeps the deterministic settings and is the one shown to the client while it streams
+        self._stream_candidate(candidates, candidates[0].test_gen_agent, [])
+        winner = self._race(candidates, generate, beam_done)
+
+        for round in range(self.max_round):
+            if winner is not None:
+                break
+            # only the failures closest to passing are refined further
+            survivors = sorted([each for each in candidates if each.test_status is not None], key=Candidate.rank, reverse=True)
+            survivors = survivors[:max(self.configs.beam_refine_width, 1)]
+            if not survivors:
+                break
+            self.update_messages_to_remote(survivors[0].messages)
+            self._stream_candidate(candidates, survivors[0].test_refine_agent, survivors[0].messages)
+            winner = self._race(survivors, refine, beam_done)
+
+        if winner is not None:
+            best = winner
+        else:
+            finished = [each for each in candidates if each.test_status is not None]
+            if finished:
+                best = max(finished, key=Candidate.rank)
+            else:
+                # no candidate got as far as running a test (generation failed or was cut short)
+                best = candidates[0]
+                best.test_status = 'fail_generate'
+        messages = best.messages
+        self.update_messages_to_remote(messages)
+        if best.test_status == 'success':
+            messages = self.finish_generate()
+            self.update_messages_to_remote(messages)
+        return best.test_case, best.test_status, messages
+
+    def _prepare_candidates(self, target_test_case_path, pool, leases):
+        workspace = leases.enter_context(pool.lease(self._cancel_check))
+        candidates = [Candidate(0, workspace.map_path(target_test_case_path), self.test_gen_agent, self.test_refine_agent, self.test_runner)]
+        while len(self._beam_agents) < self.configs.beam_width - 1:
+            # a runner keeps per-run state (log names, coverage), so candidates running at once do not share one
+            self._beam_agents.append((
+                TestGenAgent(self.configs.llm_name, self.configs.project_name, self.configs.project_url, n_responses=1, skip_deepseek_think=self.skip_deepseek_think),
+                TestRefineAgent(self.configs.llm_name, self.configs.project_name, self.configs.project_url, n_responses=1, skip_deepseek_think=self.skip_deepseek_think),
+                TestCaseRunner(self.configs, self.configs.test_case_run_log_dir),
+            ))
+        for index in range(1, self.configs.beam_width):
+            test_gen_agent, test_refine_agent, test_runner = self._beam_agents[index - 1]
+            for agent in (test_gen_agent, test_refine_agent):
+                # sample different candidates; the seed keeps each of them reproducible
+                agent.temp = self.configs.beam_temperature
+                agent.seed = self.test_gen_agent.seed + index
+            # extra candidates only take idle workspaces: waiting for one could deadlock sessions that each hold some
+            workspace = leases.enter_context(pool.lease(self._cancel_check, block=False))
+            if workspace is None:
+                print(f'[INFO] No idle workspace for beam candidate {index}, running {index} candidates')
+                break
+            candidates.append(Candidate(index, workspace.map_path(target_test_case_path), test_gen_agent, test_refine_agent, test_runner))
+        return candidates
+
+    def _stream_candidate(self, candidates, agent, base_messages):
+        # interleaving several streams would garble the client's view, so only one agent streams at a time
+        for candidate in candidates:
+            candidate.test_gen_agent.set_stream_callback(None)
+            candidate.test_refine_agent.set_stream_callback(None)
+        agent.set_stream_callback(self._stream_to_remote(base_messages))
+
+    def _run_candidate(self, candidate, prompt, beam_done):
+        should_stop = lambda: self._cancel_check() or beam_done.is_set()
+        candidate.error_msg, candidate.test_status = self.run_test_case(candidate.test_case, candidate.test_case_path, should_stop, candidate.test_runner)
+        self.generation_with_refine_log.append((candidate.test_status, prompt, candidate.test_case))
+
+    def _race(self, candidates, work, beam_done):
+        """Run `work` for every candidate in parallel and return the first one that reaches success, cancelling the rest."""
+        should_stop = lambda: self._cancel_check() or beam_done.is_set()
+        for candidate in candidates:
+            candidate.test_status = None
+            for agent in (candidate.test_gen_agent, candidate.test_refine_agent):
+                agent.set_cancel_check(should_stop)
+                agent.set_deadline(self.query_session.deadline if self.query_session else None)
+                agent.set_rate_limit_key(self.query_session.session_id if self.query_session else None)
+
+        winner, errors = None, []
+        with ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='beam') as executor:
+            pending = {executor.submit(work, candidate): candidate for candidate in candidates}
+            try:
+                while pending and winner is None:
+                    if self._cancel_check():
+                        break
+                    done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        candidate = pending.pop(future)
+                        error = future.exception()
+                        if error is not None:
+                            candidate.test_status = None
+                            if not isinstance(error, GenerationCancelled):
+                                print(f'[WARNING] Beam candidate {candidate.index} failed: {error}')
+                                errors.append(error)
+                        elif candidate.test_status == 'success' and winner is None:
+                            winner = candidate
+            finally:
+                beam_done.set()
+        beam_done.clear()
+        self._apply_cancel_hook()
+        self._ensure_not_cancelled()
+
+        if winner is None and errors and all(each.test_status is None for each in candidates):
+            raise errors[0]
+        return winner
+
     def finish_generate(self):
         self._ensure_not_cancelled()
+        self.test_gen_agent.set_stream_callback(self._stream_to_remote([]))
         messages = self.test_gen_agent.generate_finish()
         return messages
 
@@ -92,7 +300,7 @@ class IntentionTester:
         refined_tc, prompt, messages = self.test_refine_agent.refine(gen_test_case, error_msg_cut, target_focal_method, target_context, target_test_case_desc, facts, prohibit_fact)
         return refined_tc, prompt, messages
 
-    def run_test_case(self, test_case, test_case_path):
+    def run_test_case(self, test_case, test_case_path, should_stop=None, test_runner=None):
         self._ensure_not_cancelled()
         def _extract_error_msg(log):
             error_msg = []
@@ -119,11 +327,26 @@ class IntentionTester:
             error_msg = '\n'.join(error_msg)
             return error_msg
 
-        compile_log, test_log, compile_success, execute_success = self.test_runner.compile_and_execute_test_case(test_case, test_case_path) 
+        on_output = self.query_session.write_build_progress if self.query_session else None
+        deadline = self.query_session.deadline if self.query_session else None
+        try:
+            compile_log, test_log, compile_success, execute_success, test_report = (test_runner or self.test_runner).compile_and_execute_test_case(test_case, test_case_path, should_stop or self._cancel_check, self.junit_version, on_output, deadline)
+        except DeadlineExceeded as e:
+            if e.stage == 'session':
+                raise
+            # only this build ran out of its slice: the session goes on, and the refine prompt says why the test failed
+            print(f'[INFO] {e}: {test_case_path}')
+            return f'[ERROR] The {e.stage} stage did not finish within {e.budget:.0f} seconds and was killed. The test may loop forever or wait for something that never happens.', 'timeout'
 
         if not compile_success:
             error_msg = _extract_error_msg(compile_log)
             test_status = 'fail_compile'
+        elif test_report is not None:
+            # per-method results from the XML report: exact status, and only the failing methods' errors for the refine prompt
+            if test_report.tests_run > 1:
+                print(f'[INFO] Multiple test methods in a single test case: {test_case_path}')
+            test_status = test_report.test_status()
+            error_msg = '' if test_status == 'success' else test_report.error_summary()
         elif not execute_success:
             error_msg = _extract_error_msg(test_log)
             test_status = 'fail_execute'
@@ -152,8 +375,14 @@ class IntentionTester:
 
     def _apply_cancel_hook(self):
         def cancel_check() -> bool:
-            return bool(self.query_session and self.query_session.should_stop())
+            # an expired session stops waits and builds the same way /session/stop does
+            return bool(self.query_session and (self.query_session.should_stop() or self.query_session.deadline.expired()))
 
         self._cancel_check = cancel_check
-        self.test_gen_agent.set_cancel_check(cancel_check)
-        self.test_refine_agent.set_cancel_check(cancel_check)
+        deadline = self.query_session.deadline if self.query_session else None
+        for agent in (self.test_gen_agent, self.test_refine_agent):
+            agent.set_cancel_check(cancel_check)
+            agent.set_deadline(deadline)
+        rate_limit_key = self.query_session.session_id if self.query_session else None
+        self.test_gen_agent.set_rate_limit_key(rate_limit_key)
+        self.test_refine_agent.set_rate_limit_key(rate_limit_key)
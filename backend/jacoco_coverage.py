@@ -0,0 +1,247 @@
+import functools
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+PRIMITIVE_DESCRIPTORS = {
+    'Z': 'boolean', 'B': 'byte', 'C': 'char', 'S': 'short', 'I': 'int', 'J': 'long', 'F': 'float', 'D': 'double', 'V': 'void',
+}
+
+
+def _floor_percent(missed: int, covered: int) -> Optional[float]:
+    # the HTML report rounds percentages down to whole numbers, and the collected statistics were read from it
+    total = missed + covered
+    if total == 0:
+        return None
+    return float(covered * 100 // total)
+
+
+def _descriptor_types(desc: str) -> List[str]:
+    """`(Ljava/util/Map;[Ljava/lang/Object;)V` -> ['Map', 'Object[]'], the parameter names the HTML report shows."""
+    types = []
+    i, end = 1, desc.index(')')
+    while i < end:
+        dims = 0
+        while desc[i] == '[':
+            dims += 1
+            i += 1
+        if desc[i] == 'L':
+            semicolon = desc.index(';', i)
+            name = desc[i + 1:semicolon].rsplit('/', 1)[-1].replace('$', '.')
+            i = semicolon + 1
+        else:
+            name = PRIMITIVE_DESCRIPTORS[desc[i]]
+            i += 1
+        types.append(name + '[]' * dims)
+    return types
+
+
+class MethodCoverage:
+    __slots__ = ('class_name', 'name', 'desc', 'line', 'counters')
+
+    def __init__(self, class_name: str, name: str, desc: str, line: int):
+        self.class_name = class_name
+        self.name = name
+        self.desc = desc
+        self.line = line
+        self.counters: Dict[str, Tuple[int, int]] = {}  # type -> (missed, covered)
+
+    @property
+    def element(self) -> str:
+        """The method as the HTML report's element column shows it, e.g. `valuesOfKeys(Map, Object[])`."""
+        if self.name == '<clinit>':
+            return 'static {...}'
+        name = self.class_name.rsplit('/', 1)[-1].rsplit('$', 1)[-1] if self.name == '<init>' else self.name
+        return f"{name}({', '.join(_descriptor_types(self.desc))})"
+
+    def statistic(self) -> dict:
+        # same keys and meaning as the columns read from the HTML method table, including
+        # `line_coverage` being its instruction coverage column
+        lines = self.counters.get('LINE', (0, 0))
+        complexity = self.counters.get('COMPLEXITY', (0, 0))
+        instructions = _floor_percent(*self.counters.get('INSTRUCTION', (0, 0)))
+        branches = _floor_percent(*self.counters.get('BRANCH', (0, 0)))
+        return {
+            'number_of_lines': sum(lines),
+            'number_of_branches': sum(complexity) - 1,
+            'line_coverage': instructions if instructions is not None else 0.0,
+            'branch_coverage': branches if branches is not None else 'n/a',
+        }
+
+
+class JacocoReport:
+    """Line and method coverage of every class in a `jacoco.xml`, read in one streaming pass.
+
+    Lines are kept per source file as two sorted int arrays, methods per class in report order.
+    Source files are keyed `org/example/Foo.java`, classes `org/example/Foo`.
+    """
+
+    def __init__(self):
+        self.covered_lines: Dict[str, array] = {}
+        self.uncovered_lines: Dict[str, array] = {}
+        self.methods: Dict[str, List[MethodCoverage]] = {}
+
+    @classmethod
+    def parse(cls, xml_path: str) -> 'JacocoReport':
+        report = cls()
+        package = ''
+        class_name = None
+        method = None
+        covered, uncovered = array('i'), array('i')
+        for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'package':
+                    package = elem.get('name', '')
+                elif tag == 'class':
+                    class_name = elem.get('name', '')
+                    report.methods[class_name] = []
+                elif tag == 'method':
+                    method = MethodCoverage(class_name, elem.get('name', ''), elem.get('desc', '()V'), int(elem.get('line', 0)))
+                elif tag == 'sourcefile':
+                    covered, uncovered = array('i'), array('i')
+                continue
+
+            if tag == 'line':
+                # a line with any executed instruction counts as covered, like the fc/pc spans of the HTML report
+                if int(elem.get('ci', 0)) > 0:
+                    covered.append(int(elem.get('nr')))
+                elif int(elem.get('mi', 0)) > 0:
+                    uncovered.append(int(elem.get('nr')))
+            elif tag == 'counter':
+                if method is not None:
+                    method.counters[elem.get('type')] = (int(elem.get('missed', 0)), int(elem.get('covered', 0)))
+            elif tag == 'method':
+                report.methods[class_name].append(method)
+                method = None
+            elif tag == 'class':
+                class_name = None
+            elif tag == 'sourcefile':
+                key = f"{package}/{elem.get('name')}" if package else elem.get('name')
+                report.covered_lines[key] = covered
+                report.uncovered_lines[key] = uncovered
+            elif tag == 'package':
+                package = ''
+            else:
+                continue
+            elem.clear()
+        return report
+
+    def lines_coverage(self, sourcefile: str) -> Optional[Tuple[List[int], List[int]]]:
+        if sourcefile not in self.covered_lines:
+            return None
+        return self.covered_lines[sourcefile].tolist(), self.uncovered_lines[sourcefile].tolist()
+
+    def method_statistic(self, class_name: str, focal_method_name_param: str) -> Optional[dict]:
+        """Coverage statistic of the focal method, e.g. `filter(java.util.Map<K, V>,cn.hutool.core.lang.Filter<...>)`.
+
+        Returns an empty dict when the method is not found and None when the class is not in the report.
+        """
+        if class_name not in self.methods:
+            return None
+        target_fm_name = focal_method_name_param.strip().split('(')[0]
+        target_fm_params = parse_focal_method_params(focal_method_name_param)
+
+        candidates = [each for each in self.methods[class_name] if each.element.split('(')[0] == target_fm_name]
+        method = None
+        if len(candidates) > 1:
+            method = select_method(target_fm_params, candidates)
+        elif candidates:
+            method = candidates[0]
+        if method is None:
+            logger.warning(f'[WARNING] Cannot find the focal method in the jacoco report. Need manual check\nfocal_method_name: {focal_method_name_param}\n\n')
+            return {'available_methods': [each.element for each in self.methods[class_name]]}
+        return method.statistic()
+
+
+@functools.lru_cache(maxsize=4)
+def _load_report(xml_path: str, mtime_ns: int, size: int) -> JacocoReport:
+    return JacocoReport.parse(xml_path)
+
+
+def load_report(xml_path: str) -> Optional[JacocoReport]:
+    """The parsed report, shared between queries until the file changes; None if there is no report."""
+    try:
+        stat = os.stat(xml_path)
+    except FileNotFoundError:
+        return None
+    return _load_report(xml_path, stat.st_mtime_ns, stat.st_size)
+
+
+def report_path(project_dir: str) -> str:
+    return f'{project_dir}/target/site/jacoco/jacoco.xml'
+
+
+def lines_coverage_from_html_path(jacoco_java_html_report_path: str) -> Optional[Tuple[List[int], List[int]]]:
+    """Covered and uncovered lines for the source file of an HTML report path such as
+    `.../target/site/jacoco/spark.utils/CollectionUtils.java.html`, read from the `jacoco.xml` next to it.
+    """
+    package_dir, html_name = os.path.split(jacoco_java_html_report_path)
+    site_dir, package = os.path.split(package_dir)
+    report = load_report(os.path.join(site_dir, 'jacoco.xml'))
+    if report is None:
+        return None
+    sourcefile = html_name[:-len('.html')]
+    if package != 'default':
+        sourcefile = package.replace('.', '/') + '/' + sourcefile
+    return report.lines_coverage(sourcefile)
+
+
+def remove_angle_brackets_substrings(input_string: str) -> str:
+    # Define the regular expression pattern to match substrings within angle brackets, including nested ones
+    pattern = re.compile(r"<[^<>]*>")
+
+    while True:
+        # Remove all substrings that match the pattern
+        input_string, count = pattern.subn('', input_string)
+        if count == 0:
+            break
+
+    return input_string
+
+
+def parse_focal_method_params(focal_method_name_param: str) -> List[str]:
+    # example: intersectionDistinct(java.util.Collection<T>,java.util.Collection<T>,java.util.Collection<T>[]) to match intersectionDistinct(Collection, Collection, Collection[])
+    # example: valuesOfKeys(java.util.Map<K, V>,K[]) to match valuesOfKeys(Map, Object[])
+    # example: groupingBy(java.util.function.Function<? super T, ? extends K>,java.util.function.Function<? super T, ? extends R>) to match groupingBy(Function, Function)
+    # example: filter(java.util.Map<K, V>,cn.hutool.core.lang.Filter<java.util.Map.Entry<K, V>>) to match filter(Map, Filter)
+    target_fm_params_str = focal_method_name_param.strip().split('(')[1][:-1]
+    target_fm_params_str = remove_angle_brackets_substrings(target_fm_params_str)
+    target_fm_params = [each_param.strip() for each_param in target_fm_params_str.split(',')]
+    return [each_param.split('.')[-1] if '.' in each_param else each_param for each_param in target_fm_params]
+
+
+def select_method(target_fm_params: Sequence[str], candidates: Sequence[MethodCoverage]) -> Optional[MethodCoverage]:
+    """Pick the overload whose element parameters match, the way it was picked from the HTML method table."""
+    def params_of(candidate):
+        return [each_param.strip() for each_param in candidate.element.strip().split('(')[1][:-1].split(',')]
+
+    # filter according to the number of parameters
+    filter_candidates = [each for each in candidates if len(params_of(each)) == len(target_fm_params)]
+    if len(filter_candidates) == 1:
+        return filter_candidates[0]
+
+    # filter according to the detailed parameters
+    for each_candidate in filter_candidates:
+        if list(target_fm_params) == params_of(each_candidate):
+            return each_candidate
+
+    # for corner case such as: valuesOfKeys(java.util.Map<K, V>,K[]) to match valuesOfKeys(Map, Object[]). need to transform K to Object
+    for each_candidate in filter_candidates:
+        candidate_fm_params = params_of(each_candidate)
+        is_match = True
+        for idx in range(len(target_fm_params)):
+            if target_fm_params[idx] != candidate_fm_params[idx]:
+                change_to_object = re.sub(r'[A-Za-z]', 'Object', target_fm_params[idx])
+                if change_to_object != candidate_fm_params[idx]:
+                    is_match = False
+                    break
+        if is_match:
+            return each_candidate
+
+    return None
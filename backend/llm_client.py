@@ -0,0 +1,73 @@
+import importlib.util
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import httpx
+from openai import OpenAI
+
+from core.rate_limiter import LLMRateLimiter
+from user_config import global_config
+
+logger = logging.getLogger(__name__)
+
+# one budget for the whole process: every agent of every session draws from the same RPM/TPM buckets
+rate_limiter = LLMRateLimiter(
+    requests_per_minute=global_config.getint('rate_limit', 'requests_per_minute', fallback=0),
+    tokens_per_minute=global_config.getint('rate_limit', 'tokens_per_minute', fallback=0),
+    backoff_base=global_config.getfloat('rate_limit', 'backoff_base_seconds', fallback=1.0),
+    backoff_cap=global_config.getfloat('rate_limit', 'backoff_cap_seconds', fallback=60.0),
+)
+
+
+class LLMTransport:
+    """One pooled HTTP client (keep-alive, HTTP/2 when `h2` is installed) and one OpenAI client
+    shared by every agent, with a cap on the number of requests in flight."""
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str], max_in_flight: int = 8, request_timeout: float = 300.0, connect_timeout: float = 10.0):
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.http2 = importlib.util.find_spec('h2') is not None
+        self.http_client = httpx.Client(
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(request_timeout, connect=connect_timeout),
+        )
+        self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    @contextmanager
+    def in_flight(self) -> Iterator[None]:
+        """Hold one of the `max_in_flight` request slots, including while a stream is consumed."""
+        self._in_flight.acquire()
+        try:
+            yield
+        finally:
+            self._in_flight.release()
+
+    def close(self) -> None:
+        self.http_client.close()
+
+
+_transports: Dict[Tuple[Optional[str], Optional[str]], LLMTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def get_llm_transport() -> LLMTransport:
+    # Configs exports the key and URL to the environment, so resolve them on first use rather than at import
+    key = (os.environ.get('OPEN_AI_KEY'), os.environ.get('OPENAI_BASE_URL'))
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = LLMTransport(
+                api_key=key[0],
+                base_url=key[1],
+                max_in_flight=global_config.getint('openai', 'max_in_flight', fallback=8),
+                request_timeout=global_config.getfloat('openai', 'request_timeout', fallback=300.0),
+                connect_timeout=global_config.getfloat('openai', 'connect_timeout', fallback=10.0),
+            )
+            logger.info('Created shared LLM transport for %s (http2=%s, max_in_flight=%s)', key[1], transport.http2, transport.max_in_flight)
+            _transports[key] = transport
+        return transport
@@ -6,6 +6,7 @@ from generator import IntentionTester
 from dataset import Dataset
 from configs import Configs
 from core.session import ModelQuerySession
+from project_context import ProjectContext, project_contexts
 from typing import Optional
 import pathlib
 from extension_api.collect_pairs.main import dump_collect_pairs
@@ -20,10 +21,60 @@ logger.warning('UTF-8 mode is enabled' if sys.flags.utf8_mode else 'UTF-8 mode i
 # because project file should be opened using UTF-8, but subprocess.run() (for Java, but CodeQL should still use UTF-8) output should still be decoded in local encoding
 # both would cause error if not set properly
 
+def _split_params(params_str):
+    # split on top-level commas only, e.g. 'Map<K, V> map, int n' -> ['Map<K, V> map', 'int n']
+    params, depth, current = [], 0, []
+    for ch in params_str:
+        if ch == '<':
+            depth += 1
+        elif ch == '>':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            params.append(''.join(current))
+            current = []
+            continue
+        current.append(ch)
+    params.append(''.join(current))
+    return [each.strip() for each in params if each.strip()]
+
+
+def normalize_method_signature(signature):
+    """
+    Reduce a method signature to 'name(SimpleType,SimpleType)' so that source text such as
+    'get(final java.util.Map<K, V> map, String... keys)' and collected names such as
+    'get(Map<K,V>,String[])' map to the same key.
+    """
+    name, _, rest = signature.partition('(')
+    name = name.strip()
+    if not rest:
+        return name
+    param_types = []
+    for param in _split_params(rest.rsplit(')', 1)[0]):
+        param = re.sub(r'@\w+(\([^)]*\))?', '', param)
+        while '<' in param:
+            param = re.sub(r'<[^<>]*>', '', param)
+        param = param.replace('...', '[]')
+        tokens = [token for token in param.replace('[]', ' []').split() if token != 'final']
+        array_suffix = '[]' * tokens.count('[]')
+        tokens = [token for token in tokens if token != '[]']
+        if not tokens:
+            continue
+        param_types.append(tokens[0].split('.')[-1] + array_suffix)
+    return f"{name}({','.join(param_types)})"
+
+
+def _count_params(normalized_signature):
+    params_str = normalized_signature.partition('(')[2].rstrip(')')
+    return len(params_str.split(',')) if params_str else 0
+
+
 class IntentionTest:
     def __init__(self, project_path, configs):
         self.project_path = project_path
         self.corpus = None
+        # 'Class::::method' -> corpus indices (overloads share one entry), and normalized full signature -> index
+        self.fm_name_index = {}
+        self.fm_signature_index = {}
 
         self.corpus_path =  configs.corpus_path
         self.generator = IntentionTester(configs)
@@ -75,27 +126,37 @@ class IntentionTest:
             'corpus_tc_name': corpus_tc_name,
             'corpus_test_case_path': corpus_test_case_path
         }
-
-
-def main(target_focal_method, target_focal_file, test_desc, project_path, focal_file_path, query_session: Optional[ModelQuerySession] = None):
-    # project_name = project_path.split('/')[-1]     not compatible with Windows path
-    project_name = pathlib.Path(project_path).stem
-    # replace the disk letter to upper case to match CodeQL path 
-    tester_path = re.sub(r'[a-z]:/', lambda s: s[0].upper(), pathlib.Path(__file__).parent.absolute().as_posix())
-    configs = Configs(project_name, tester_path)
-
-    class_name = os.path.splitext(os.path.basename(focal_file_path))[0]
-    focal_method_name = f"{class_name}::::"
-    method_signature_match = re.search(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*\)', target_focal_method)
-    if method_signature_match:
-        method_signature = method_signature_match.group(0)
-        focal_method_name += method_signature
-
+        self.build_focal_method_index()
+
+    def build_focal_method_index(self):
+        self.fm_name_index, self.fm_signature_index = {}, {}
+        for idx, fm_name in enumerate(self.corpus['corpus_fm_name']):
+            if not fm_name:
+                continue
+            self.fm_name_index.setdefault(fm_name.split('(')[0], []).append(idx)
+            self.fm_signature_index.setdefault(normalize_method_signature(fm_name), idx)
+
+    def find_focal_method(self, focal_method_name):
+        """Return the corpus index of `focal_method_name` ('Class::::method(params)'), or None if absent."""
+        idx = self.fm_signature_index.get(normalize_method_signature(focal_method_name))
+        if idx is not None:
+            return idx
+
+        candidates = self.fm_name_index.get(focal_method_name.split('(')[0], [])
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+
+        # overloads without an exact signature match: prefer the one with the same number of parameters
+        n_params = _count_params(normalize_method_signature(focal_method_name))
+        for idx in candidates:
+            if _count_params(normalize_method_signature(self.corpus['corpus_fm_name'][idx])) == n_params:
+                return idx
+        return candidates[0]
+
+
+def load_project_context(project_path, configs) -> ProjectContext:
     intention_test = IntentionTest(project_path, configs)
 
-    # Connect to query session
-    intention_test.generator.connect_to_request_session(query_session)
-
     logger.info('Checking test-focal corpus file')
     # prepare test-focal pairs
     if not configs.is_corpus_prepared():
@@ -104,25 +165,10 @@ def main(target_focal_method, target_focal_file, test_desc, project_path, focal_
 
     intention_test.load_corpus()
 
-    # prepare two copies of the project in repos_with_test and repos_removing_test. the former is used to create the initial codeql database, while the latter is used to wirte the referable and generated test case during the generation process.
-    # shutil.copytree(project_path, configs.project_with_test_file_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
-    # shutil.copytree(project_path, configs.project_without_test_file_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
-
-    # /intention_test_extension/data/repos_removing_test/spark/src/test/java/spark/embeddedserver/jetty/EmbeddedJettyFactoryTest.java
-    project_without_test_file_dir = os.path.dirname(configs.project_without_test_file_path)
-
-    # focal_file_path = f"{project_without_test_file_dir}/{focal_file_path[focal_file_path.index(project_name):]}" 
-    # TODO fix all path incompatibility
-    focal_file_path = (pathlib.Path(project_without_test_file_dir) / focal_file_path[focal_file_path.index(project_name):]).as_posix()
-    target_test_case_path = focal_file_path.replace('src/main/java', 'src/test/java').replace('.java', 'Test.java')
-
     # prepare the datasets
     dataset = Dataset(configs)
     print('Loading datasets...')
 
-    test_desc_data = dataset.load_test_desc(test_desc)
-    target_test_case_desc = test_desc_data['test_desc']['under_setting']
-
     # TODO LSP now cannot run in Windows
     try:
         offline_fact_ref_data = dataset.load_offline_fact_ref_data()
@@ -141,18 +187,52 @@ def main(target_focal_method, target_focal_file, test_desc, project_path, focal_
             for i in range(corpus_len)
         ]
 
-    # prepare test generator
-    dtester = IntentionTester(configs)
+    return ProjectContext(project_path, configs, intention_test, offline_fact_ref_data,
+                          tracked_files=[configs.corpus_path, dataset.offline_fact_ref_data_path()])
+
+
+def main(target_focal_method, target_focal_file, test_desc, project_path, focal_file_path, query_session: Optional[ModelQuerySession] = None):
+    # project_name = project_path.split('/')[-1]     not compatible with Windows path
+    project_name = pathlib.Path(project_path).stem
+    # replace the disk letter to upper case to match CodeQL path 
+    tester_path = re.sub(r'[a-z]:/', lambda s: s[0].upper(), pathlib.Path(__file__).parent.absolute().as_posix())
+
+    class_name = os.path.splitext(os.path.basename(focal_file_path))[0]
+    focal_method_name = f"{class_name}::::"
+    method_signature_match = re.search(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\s*\([^)]*\)', target_focal_method)
+    if method_signature_match:
+        method_signature = method_signature_match.group(0)
+        focal_method_name += method_signature
+
+    # corpus, facts and testers are parsed once per project and reused by later requests
+    context = project_contexts.get(project_path, lambda: load_project_context(project_path, Configs(project_name, tester_path)))
+    configs = context.configs
+    intention_test = context.intention_test
+    offline_fact_ref_data = context.offline_fact_ref_data
+
+    # prepare two copies of the project in repos_with_test and repos_removing_test. the former is used to create the initial codeql database, while the latter is used to wirte the referable and generated test case during the generation process.
+    # shutil.copytree(project_path, configs.project_with_test_file_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
+    # shutil.copytree(project_path, configs.project_without_test_file_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns('.git'))
+
+    # /intention_test_extension/data/repos_removing_test/spark/src/test/java/spark/embeddedserver/jetty/EmbeddedJettyFactoryTest.java
+    project_without_test_file_dir = os.path.dirname(configs.project_without_test_file_path)
+
+    # focal_file_path = f"{project_without_test_file_dir}/{focal_file_path[focal_file_path.index(project_name):]}" 
+    # TODO fix all path incompatibility
+    focal_file_path = (pathlib.Path(project_without_test_file_dir) / focal_file_path[focal_file_path.index(project_name):]).as_posix()
+    target_test_case_path = focal_file_path.replace('src/main/java', 'src/test/java').replace('.java', 'Test.java')
+
+    test_desc_data = Dataset(configs).load_test_desc(test_desc)
+    target_test_case_desc = test_desc_data['test_desc']['under_setting']
 
     # start generating test case
 
     # TODO extract context from local java files
-    target_pair_idx = 0
-    for i in range(0, len(intention_test.corpus['corpus_fm_name'])):
-        if focal_method_name.split("(")[0] == intention_test.corpus['corpus_fm_name'][i].split("(")[0]:
-            target_pair_idx = i
-            target_focal_file = intention_test.corpus['corpus_context'][i]
-            break
+    target_pair_idx = intention_test.find_focal_method(focal_method_name)
+    if target_pair_idx is not None:
+        target_focal_file = intention_test.corpus['corpus_context'][target_pair_idx]
+    else:
+        target_pair_idx = 0
 
     ref_score, ref_focal_method, ref_test_case = retrieve_reference_offline(target_pair_idx, offline_fact_ref_data,
                                                                             focal_method_name)
@@ -167,17 +247,21 @@ def main(target_focal_method, target_focal_file, test_desc, project_path, focal_
     facts, facts_sim, usages, usages_sim = get_crucial_facts_offline(target_pair_idx, offline_fact_ref_data, focal_method_name)
 
     logger.info('Starting a multi-round chat for generating test case')
-    # generate the test case
-    generated_test_case, test_status, messages = dtester.generate_test_case_with_refine(
-        target_focal_method=target_focal_method,
-        target_context=target_focal_file,
-        target_test_case_desc=target_test_case_desc,
-        target_test_case_path=target_test_case_path,
-        referable_test_case=top_1_reference_tc_rag,
-        facts=facts,
-        junit_version=str(query_session.junit_version),
-        query_session=query_session
-    )
+    # prepare test generator
+    with context.lease_tester() as dtester:
+        # Connect to query session
+        dtester.connect_to_request_session(query_session)
+        # generate the test case
+        generated_test_case, test_status, messages = dtester.generate_test_case_with_refine(
+            target_focal_method=target_focal_method,
+            target_context=target_focal_file,
+            target_test_case_desc=target_test_case_desc,
+            target_test_case_path=target_test_case_path,
+            referable_test_case=top_1_reference_tc_rag,
+            facts=facts,
+            junit_version=str(query_session.junit_version),
+            query_session=query_session
+        )
     
     return messages, generated_test_case
 
@@ -0,0 +1,339 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots are only pinned against pruning within this process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIRS = ('src/main/java', 'src/main/resources')
+MANIFEST = 'manifest.json'
+# snapshots kept per classpath; the least recently used are deleted once there are more
+MAX_SNAPSHOTS = 4
+
+
+def source_manifest(project_dir: str) -> Dict[str, Tuple[int, int]]:
+    """Size and mtime of every main source and resource, keyed `src/main/java/org/example/Foo.java`."""
+    manifest = {}
+    for source_dir in SOURCE_DIRS:
+        for root, dirs, files in os.walk(f'{project_dir}/{source_dir}'):
+            for name in files:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                manifest[os.path.relpath(path, project_dir).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime_ns)
+    return manifest
+
+
+def manifest_fingerprint(manifest: Dict[str, Tuple[int, int]]) -> str:
+    return hashlib.sha1(json.dumps(sorted(manifest.items())).encode('utf8')).hexdigest()
+
+
+def api_signatures(classes_dir: str, class_names: List[str], env) -> Optional[Dict[str, Tuple[str, ...]]]:
+    """What other classes compile against, per class: its declaration and non-private members with constant
+    values, from `javap -p -constants`. None when javap is missing or fails."""
+    if not class_names:
+        return {}
+    try:
+        # javap is quick and its whole output is needed, unlike the tail run_build keeps
+        result = subprocess.run(['javap', '-p', '-constants', '-cp', classes_dir] + class_names,
+                                env=env, capture_output=True, text=True, encoding='utf8', errors='replace')
+    except OSError:
+        return None
+    signatures, current = [], None
+    for line in result.stdout.splitlines():
+        if not line.startswith(' ') and line.rstrip().endswith('{'):
+            current = [line.strip()]
+        elif current is not None and line.strip() == '}':
+            signatures.append((current[0],) + tuple(sorted(current[1:])))
+            current = None
+        elif current is not None:
+            member = line.strip()
+            if member and not member.startswith('private ') and member != 'static {};':
+                current.append(member)
+    if result.returncode != 0 or len(signatures) != len(class_names):
+        return None
+    return dict(zip(class_names, signatures))
+
+
+def _link_tree(src: str, dst: str, skip: Callable[[str], bool]) -> None:
+    # snapshots are never written to, so the new one can share the unchanged class files with its base
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+        for name in files:
+            rel = os.path.normpath(os.path.join(rel_root, name)).replace(os.sep, '/')
+            if skip(rel):
+                continue
+            try:
+                os.link(os.path.join(root, name), os.path.join(dst, rel))
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(dst, rel))
+
+
+class MainClassesSnapshots:
+    """Compiled `src/main` of a project as immutable directories, one per source fingerprint.
+
+    The first snapshot is taken from `target/classes` after a Maven build. When the sources change, the next
+    snapshot starts from the latest one: unchanged class files are hard links, changed sources are recompiled
+    with javac, and removed resources lose their copies. All copies of a project with the same pom.xml share them.
+    Only the changed sources are recompiled, so this is only done when the classes compiled against them cannot tell:
+    if a changed source's classes differ in what `javap -p -constants` shows outside private members (a renamed or
+    removed method or field, other parameter or field types, another superclass, a changed constant), lose a class,
+    or a source was removed, no snapshot is built and Maven rebuilds the module instead.
+
+    A snapshot is pinned while a test runs against it: a shared lock on `<snapshot>.pin`, which pruning (in any
+    server process) must lock exclusively before deleting the snapshot.
+    """
+
+    # per snapshot directory, shared by every instance in the process (each test runner has its own)
+    _locks: Dict[str, threading.Lock] = {}
+    _locks_lock = threading.Lock()
+    # snapshot directory -> number of users, where there is no fcntl
+    _pins: Dict[str, int] = {}
+
+    def __init__(self, cache_dir: str, run_build: Callable):
+        self.cache_dir = cache_dir
+        self.run_build = run_build
+
+    @contextmanager
+    def use(self, project_dir: str, classpath_key: str, classpath: str, env, should_stop=None) -> Iterator[Optional[str]]:
+        """The classes directory for the current sources of `project_dir`, or None if none can be built without Maven.
+
+        The snapshot is not pruned before the block exits.
+        """
+        manifest = source_manifest(project_dir)
+        snapshot_dir = f'{self.cache_dir}/{classpath_key}/{manifest_fingerprint(manifest)}'
+        with self._pinned(snapshot_dir):
+            yield self._get(project_dir, classpath_key, manifest, snapshot_dir, classpath, env, should_stop)
+
+    def _get(self, project_dir, classpath_key, manifest, snapshot_dir, classpath, env, should_stop) -> Optional[str]:
+        if os.path.isdir(snapshot_dir):
+            self._touch(snapshot_dir)
+            return f'{snapshot_dir}/classes'
+        with self._lock(classpath_key):
+            if os.path.isdir(snapshot_dir):
+                return f'{snapshot_dir}/classes'
+            base = self._latest(classpath_key)
+            if base is None:
+                return None
+            if not self._build_incremental(project_dir, base, manifest, snapshot_dir, classpath, env, should_stop):
+                return None
+            self._prune(classpath_key)
+        return f'{snapshot_dir}/classes'
+
+    def seed(self, project_dir: str, classpath_key: str) -> None:
+        """Snapshot `target/classes` right after Maven compiled the current sources."""
+        classes_dir = f'{project_dir}/target/classes'
+        if not os.path.isdir(classes_dir):
+            return
+        manifest = source_manifest(project_dir)
+        snapshot_dir = f'{self.cache_dir}/{classpath_key}/{manifest_fingerprint(manifest)}'
+        with self._lock(classpath_key):
+            if os.path.isdir(snapshot_dir):
+                self._touch(snapshot_dir)
+                return
+            tmp_dir = self._tmp_dir(snapshot_dir)
+            # a real copy: Maven rewrites target/classes in place
+            shutil.copytree(classes_dir, f'{tmp_dir}/classes')
+            self._commit(tmp_dir, manifest, snapshot_dir)
+            self._prune(classpath_key)
+
+    def _build_incremental(self, project_dir, base_dir, manifest, snapshot_dir, classpath, env, should_stop) -> bool:
+        with open(f'{base_dir}/{MANIFEST}', encoding='utf8') as f:
+            base_manifest = {path: tuple(value) for path, value in json.load(f).items()}
+        changed = [path for path, value in manifest.items() if base_manifest.get(path) != value]
+        removed = [path for path in base_manifest if path not in manifest]
+        changed_java = [path for path in changed if path.startswith('src/main/java/') and path.endswith('.java')]
+        removed_java = [path for path in removed if path.startswith('src/main/java/') and path.endswith('.java')]
+        if removed_java:
+            # other classes may still refer to its classes; only a full compile tells
+            logger.info(f'{removed_java[0]} was removed, leaving the main classes to Maven')
+            return False
+
+        # classes of a changed or removed source: Foo.class and its nested Foo$*.class
+        stale_prefixes = []
+        for path in changed + removed:
+            if path.startswith('src/main/java/') and path.endswith('.java'):
+                stale_prefixes.append(path[len('src/main/java/'):-len('.java')])
+            elif path.startswith('src/main/resources/'):
+                stale_prefixes.append(path[len('src/main/resources/'):])
+
+        def is_stale(rel):
+            for prefix in stale_prefixes:
+                if rel == prefix or rel == prefix + '.class' or rel.startswith(prefix + '$'):
+                    return True
+            return False
+
+        tmp_dir = self._tmp_dir(snapshot_dir)
+        classes_dir = f'{tmp_dir}/classes'
+        try:
+            _link_tree(f'{base_dir}/classes', classes_dir, is_stale)
+            for path in changed:
+                if path.startswith('src/main/resources/'):
+                    target = f"{classes_dir}/{path[len('src/main/resources/'):]}"
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(f'{project_dir}/{path}', target)
+            if changed_java:
+                # new class files are written into a directory of their own, never through a link into the base snapshot
+                compiled_dir = f'{tmp_dir}/compiled'
+                os.makedirs(compiled_dir)
+                cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-implicit:none', '-d', compiled_dir,
+                       '-cp', os.pathsep.join([classes_dir, classpath])] + [f'{project_dir}/{path}' for path in changed_java]
+                result = self.run_build(cmd, project_dir, env, should_stop)
+                if result.returncode != 0:
+                    logger.info(f'Incremental compile of {len(changed_java)} main sources failed, leaving it to Maven:\n{result.stdout}{result.stderr}')
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return False
+                api_change = self._api_change(f'{base_dir}/classes', compiled_dir, changed_java, env)
+                if api_change is not None:
+                    logger.info(f'{api_change}, leaving the main classes to Maven so the classes using it are recompiled')
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return False
+                for root, dirs, files in os.walk(compiled_dir):
+                    for name in files:
+                        rel = os.path.relpath(os.path.join(root, name), compiled_dir)
+                        os.makedirs(os.path.dirname(os.path.join(classes_dir, rel)), exist_ok=True)
+                        os.replace(os.path.join(root, name), os.path.join(classes_dir, rel))
+                shutil.rmtree(compiled_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logger.info(f'Built main classes snapshot {os.path.basename(snapshot_dir)[:8]}: {len(changed_java)} sources recompiled, '
+                    f'{len(changed) - len(changed_java)} resources copied, {len(removed)} files removed')
+        self._commit(tmp_dir, manifest, snapshot_dir)
+        return True
+
+    def _api_change(self, base_classes_dir: str, compiled_dir: str, changed_java: List[str], env) -> Optional[str]:
+        """Why classes compiled against the base snapshot may break against the recompiled ones, or None if they cannot."""
+        def class_names(classes_dir):
+            # named classes only: anonymous ones ($1) are renumbered freely and cannot be referred to from outside
+            names = []
+            for path in changed_java:
+                package, stem = os.path.split(path[len('src/main/java/'):-len('.java')])
+                directory = os.path.join(classes_dir, package)
+                for name in os.listdir(directory) if os.path.isdir(directory) else []:
+                    if not name.endswith('.class'):
+                        continue
+                    parts = name[:-len('.class')].split('$')
+                    if parts[0] == stem and not any(part[:1].isdigit() for part in parts[1:]):
+                        names.append(f'{package}/{name[:-len(".class")]}'.lstrip('/').replace('/', '.'))
+            return names
+
+        base_names, new_names = class_names(base_classes_dir), set(class_names(compiled_dir))
+        for name in base_names:
+            if name not in new_names:
+                return f'{name} no longer exists'
+        base_api, new_api = api_signatures(base_classes_dir, base_names, env), api_signatures(compiled_dir, base_names, env)
+        if base_api is None or new_api is None:
+            return 'javap could not compare the recompiled classes'
+        for name in base_names:
+            if base_api[name] != new_api[name]:
+                return f'the API of {name} changed'
+        return None
+
+    def _commit(self, tmp_dir: str, manifest, snapshot_dir: str) -> None:
+        with open(f'{tmp_dir}/{MANIFEST}', 'w', encoding='utf8') as f:
+            json.dump(manifest, f)
+        try:
+            os.replace(tmp_dir, snapshot_dir)
+        except OSError:  # another server process built the same snapshot first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _latest(self, classpath_key: str) -> Optional[str]:
+        snapshots = self._snapshots(classpath_key)
+        return snapshots[-1] if snapshots else None
+
+    def _prune(self, classpath_key: str) -> None:
+        for stale in self._snapshots(classpath_key)[:-MAX_SNAPSHOTS]:
+            if not self._remove_unpinned(stale):
+                logger.debug(f'Keeping main classes snapshot {os.path.basename(stale)[:8]}, a test is running against it')
+
+    @contextmanager
+    def _pinned(self, snapshot_dir: str) -> Iterator[None]:
+        if fcntl is None:
+            with self._locks_lock:
+                self._pins[snapshot_dir] = self._pins.get(snapshot_dir, 0) + 1
+            try:
+                yield
+            finally:
+                with self._locks_lock:
+                    self._pins[snapshot_dir] -= 1
+                    if not self._pins[snapshot_dir]:
+                        del self._pins[snapshot_dir]
+            return
+        os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+        pin_path = f'{snapshot_dir}.pin'
+        while True:
+            pin_file = open(pin_path, 'a')
+            fcntl.flock(pin_file, fcntl.LOCK_SH)
+            try:
+                if os.fstat(pin_file.fileno()).st_ino == os.stat(pin_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # pruned while waiting for the lock: its pin file is gone, pin the new one
+            pin_file.close()
+        try:
+            yield
+        finally:
+            if not os.path.isdir(snapshot_dir):
+                # nothing was built: drop the pin file unless someone else still holds it, or it is left behind
+                try:
+                    fcntl.flock(pin_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if not os.path.isdir(snapshot_dir):
+                        os.remove(pin_path)
+                except (BlockingIOError, FileNotFoundError):
+                    pass
+            pin_file.close()
+
+    def _remove_unpinned(self, snapshot_dir: str) -> bool:
+        if fcntl is None:
+            with self._locks_lock:
+                if snapshot_dir in self._pins:
+                    return False
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+            return True
+        pin_path = f'{snapshot_dir}.pin'
+        with open(pin_path, 'a') as pin_file:
+            try:
+                fcntl.flock(pin_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            # unlinked while still locked, so a user that opened it meanwhile sees it go and pins afresh
+            os.remove(pin_path)
+        return True
+
+    def _snapshots(self, classpath_key: str) -> List[str]:
+        # oldest first, by the time the snapshot was taken or last matched
+        root = f'{self.cache_dir}/{classpath_key}'
+        if not os.path.isdir(root):
+            return []
+        paths = [os.path.join(root, name) for name in os.listdir(root)
+                 if not name.endswith('.tmp') and os.path.exists(os.path.join(root, name, MANIFEST))]
+        return sorted(paths, key=lambda path: os.path.getmtime(os.path.join(path, MANIFEST)))
+
+    def _touch(self, snapshot_dir: str) -> None:
+        try:
+            os.utime(f'{snapshot_dir}/{MANIFEST}')
+        except FileNotFoundError:  # pruned meanwhile
+            pass
+
+    def _tmp_dir(self, snapshot_dir: str) -> str:
+        tmp_dir = f'{snapshot_dir}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def _lock(self, classpath_key: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(f'{self.cache_dir}/{classpath_key}', threading.Lock())
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from configs import Configs
+from generator import IntentionTester
+from user_config import global_config
+
+logger = logging.getLogger(__name__)
+
+# parsed JSON takes several times its on-disk size once loaded into Python objects
+JSON_MEMORY_FACTOR = 4
+
+
+class FileFingerprint:
+    """(mtime, size) of a data file, falling back to a content hash when the stat changes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stat = self._stat()
+        self.digest = self._digest() if self.stat else None
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _digest(self) -> str:
+        sha1 = hashlib.sha1()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def is_fresh(self) -> bool:
+        stat = self._stat()
+        if stat == self.stat:
+            return True
+        if stat is None or self.stat is None:
+            return False
+        # touched but maybe not modified, e.g. the corpus was re-dumped with the same content
+        digest = self._digest()
+        if digest != self.digest:
+            return False
+        self.stat = stat
+        return True
+
+    @property
+    def size(self) -> int:
+        return self.stat[1] if self.stat else 0
+
+
+class ProjectContext:
+    """Everything main() needs for one project that does not depend on the request:
+    configs, the parsed corpus, the offline fact/reference data and a pool of idle testers.
+    """
+
+    def __init__(self, project_path: str, configs: Configs, intention_test: Any, offline_fact_ref_data: List[Dict[str, Any]], tracked_files: List[str]):
+        self.project_path = project_path
+        self.configs = configs
+        self.intention_test = intention_test
+        self.offline_fact_ref_data = offline_fact_ref_data
+        self.fingerprints = [FileFingerprint(path) for path in tracked_files]
+        self.size_bytes = sum(each.size for each in self.fingerprints) * JSON_MEMORY_FACTOR
+
+        self._idle_testers: List[IntentionTester] = [intention_test.generator]
+        self._lock = threading.Lock()
+
+    @property
+    def corpus(self) -> Dict[str, List[Any]]:
+        return self.intention_test.corpus
+
+    def is_fresh(self) -> bool:
+        return all(each.is_fresh() for each in self.fingerprints)
+
+    @contextmanager
+    def lease_tester(self) -> Iterator[IntentionTester]:
+        """Borrow an IntentionTester (agents + runner) that no other session is using."""
+        with self._lock:
+            tester = self._idle_testers.pop() if self._idle_testers else None
+        if tester is None:
+            tester = IntentionTester(self.configs)
+        try:
+            yield tester
+        finally:
+            tester.connect_to_request_session(None)
+            with self._lock:
+                self._idle_testers.append(tester)
+
+
+class ProjectContextCache:
+    """Process-wide LRU cache of ProjectContext keyed by project path, bounded by an estimated memory budget."""
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries: 'OrderedDict[str, ProjectContext]' = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, project_path: str, loader: Callable[[], ProjectContext]) -> ProjectContext:
+        key = os.path.normcase(os.path.abspath(project_path))
+        with self._lock:
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        # one loader per project, so concurrent first requests do not parse the corpus twice
+        with load_lock:
+            with self._lock:
+                context = self._entries.get(key)
+            if context is not None:
+                if context.is_fresh():
+                    with self._lock:
+                        if key in self._entries:
+                            self._entries.move_to_end(key)
+                    return context
+                logger.info('Project data changed on disk, reloading context for %s', key)
+
+            context = loader()
+            with self._lock:
+                self._entries[key] = context
+                self._entries.move_to_end(key)
+                self._evict(keep=key)
+            return context
+
+    def invalidate(self, project_path: Optional[str] = None) -> None:
+        with self._lock:
+            if project_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.normcase(os.path.abspath(project_path)), None)
+
+    def _evict(self, keep: str) -> None:
+        total = sum(each.size_bytes for each in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entries.pop(key).size_bytes
+            logger.info('Evicted project context %s', key)
+
+
+project_contexts = ProjectContextCache(
+    global_config.getint('cache', 'project_context_budget_mb', fallback=1024) * 1024 * 1024
+)
@@ -0,0 +1,229 @@
+import functools
+import logging
+import re
+from typing import Callable, List, Optional, Sequence
+
+from user_config import global_config
+
+logger = logging.getLogger(__name__)
+
+# context window (prompt + completion) of the models agents.py knows about
+CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-3.5-turbo': 16385,
+    'o1-mini-2024-09-12': 128000,
+    'deepseek-7B': 32768,
+    'deepseek-32B': 32768,
+    'deepseek-ai/DeepSeek-R1-Distill-Qwen-32B': 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 32768
+
+# Hugging Face tokenizers for the self-hosted models; OpenAI models are counted with tiktoken
+HF_TOKENIZERS = {
+    'deepseek-7B': 'deepseek-ai/DeepSeek-R1-Distill-Qwen-7B',
+    'deepseek-32B': 'deepseek-ai/DeepSeek-R1-Distill-Qwen-32B',
+    'deepseek-ai/DeepSeek-R1-Distill-Qwen-32B': 'deepseek-ai/DeepSeek-R1-Distill-Qwen-32B',
+}
+
+# chat formatting, the skip-thinking suffix and tokenizer drift
+SAFETY_MARGIN_TOKENS = 256
+
+OMITTED_MARKER = '\n\n    // ...'
+
+_CODE_PIECE = re.compile(r'[A-Za-z]+|\d+|[^\sA-Za-z\d]')
+
+
+def _estimate_tokens(text: str) -> int:
+    # no tokenizer available: every word, number and symbol is at least one token, and long identifiers are split
+    return max(len(_CODE_PIECE.findall(text)), len(text) // 3)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(model_name: str) -> Callable[[str], int]:
+    if model_name in HF_TOKENIZERS:
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(HF_TOKENIZERS[model_name])
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception as e:  # not installed or not downloadable
+            logger.warning('Falling back to estimated token counts for %s: %s', model_name, e)
+            return _estimate_tokens
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning('tiktoken is not installed, falling back to estimated token counts for %s', model_name)
+        return _estimate_tokens
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding('o200k_base')
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class ClassMembers:
+    """The focal class split into header, top-level members and footer, so members can be dropped one by one."""
+
+    def __init__(self, source: str, focal_method: str):
+        self.header, self.members, self.footer = self._split(source)
+        self.kept = [True] * len(self.members)
+        focal_idx = self._find_focal(focal_method)
+        # farthest from the focal method first; without a focal method, from the end of the class
+        if focal_idx is None:
+            self.trim_order = list(reversed(range(len(self.members))))
+        else:
+            others = [i for i in range(len(self.members)) if i != focal_idx]
+            self.trim_order = sorted(others, key=lambda i: (-abs(i - focal_idx), -i))
+
+    def drop_next(self) -> Optional[str]:
+        while self.trim_order:
+            idx = self.trim_order.pop(0)
+            if self.kept[idx]:
+                self.kept[idx] = False
+                return self.members[idx]
+        return None
+
+    def render(self) -> str:
+        if not self.members:
+            return self.header + self.footer
+        parts = []
+        for i, (member, kept) in enumerate(zip(self.members, self.kept)):
+            if kept:
+                parts.append(member)
+            elif i == 0 or self.kept[i - 1]:
+                # one marker per run of omitted members
+                parts.append(OMITTED_MARKER)
+        return self.header + ''.join(parts) + self.footer
+
+    def _find_focal(self, focal_method: str) -> Optional[int]:
+        if not self.members or not focal_method:
+            return None
+        declaration = ''
+        for line in focal_method.split('\n'):
+            stripped = line.strip()
+            if '(' in stripped and not stripped.startswith(('@', '//', '/*', '*')):
+                declaration = stripped
+                break
+        if not declaration:
+            return None
+        declaration = ' '.join(declaration.split('{')[0].split())
+        name_match = re.search(r'(\w+)\s*\(', declaration)
+        normalized = [' '.join(member.split()) for member in self.members]
+        for i, member in enumerate(normalized):
+            if declaration in member:
+                return i
+        if name_match:
+            call = re.compile(r'\b' + re.escape(name_match.group(1)) + r'\s*\(')
+            for i, member in enumerate(normalized):
+                if call.search(member):
+                    return i
+        return None
+
+    @staticmethod
+    def _split(source: str):
+        """Cut the body of the first top-level type at `;` and `}` that return to member depth."""
+        depth = 0
+        body_start = None
+        member_start = None
+        spans = []
+        i, n = 0, len(source)
+        while i < n:
+            c = source[i]
+            if source.startswith('//', i):
+                i = source.find('\n', i)
+                if i < 0:
+                    break
+                continue
+            if source.startswith('/*', i):
+                end = source.find('*/', i + 2)
+                i = n if end < 0 else end + 2
+                continue
+            if c in '"\'':
+                i += 1
+                while i < n and source[i] != c and source[i] != '\n':
+                    i += 2 if source[i] == '\\' else 1
+                i += 1
+                continue
+            if c == '{':
+                depth += 1
+                if depth == 1 and body_start is None:
+                    body_start = member_start = i + 1
+            elif c == '}':
+                depth -= 1
+                if body_start is not None and depth == 1:
+                    spans.append((member_start, i + 1))
+                    member_start = i + 1
+                elif body_start is not None and depth == 0:
+                    break
+            elif c == ';' and depth == 1 and body_start is not None:
+                if spans and spans[-1][1] == member_start and not source[member_start:i].strip():
+                    # `int[] a = {1, 2};` or a lambda field: the `;` belongs to the member closed by `}`
+                    spans[-1] = (spans[-1][0], i + 1)
+                else:
+                    spans.append((member_start, i + 1))
+                member_start = i + 1
+            i += 1
+
+        if body_start is None:
+            return source, [], ''
+        return source[:body_start], [source[start:end] for start, end in spans], source[member_start:]
+
+
+class PromptBudget:
+    """Keeps a prompt within the model's context window by trimming sections before the request is sent.
+
+    Sections are dropped in a fixed order: class members farthest from the focal method, then facts
+    (least relevant last in the list), then the referable test case.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], max_prompt_tokens: int):
+        self.count_tokens = count_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+
+    @classmethod
+    def for_model(cls, model_name: str, max_completion_tokens: int, system_prompt: Optional[str] = None) -> 'PromptBudget':
+        count_tokens = get_token_counter(model_name)
+        max_prompt_tokens = global_config.getint('openai', 'max_prompt_tokens', fallback=0)
+        if max_prompt_tokens <= 0:
+            max_prompt_tokens = CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW) - max_completion_tokens - SAFETY_MARGIN_TOKENS
+        if system_prompt:
+            max_prompt_tokens -= count_tokens(system_prompt)
+        return cls(count_tokens, max_prompt_tokens)
+
+    def fit(self, render: Callable[[str, List[str], str], str], focal_method: str, context: str, facts: Optional[Sequence[str]] = None, referable_test: str = '') -> str:
+        """`render(context, facts, referable_test)` builds the prompt; returns the largest rendering that fits."""
+        facts = list(facts or [])
+        prompt = render(context, facts, referable_test)
+        overflow = self.count_tokens(prompt) - self.max_prompt_tokens
+        if overflow <= 0:
+            return prompt
+
+        members = ClassMembers(context, focal_method)
+        n_members, n_facts, dropped_reference = 0, 0, False
+        while overflow > 0:
+            member = members.drop_next()
+            if member is not None:
+                # drop as many members as the overflow suggests before measuring the whole prompt again
+                n_members += 1
+                overflow -= self.count_tokens(member)
+                while overflow > 0:
+                    member = members.drop_next()
+                    if member is None:
+                        break
+                    n_members += 1
+                    overflow -= self.count_tokens(member)
+                context = members.render()
+            elif facts:
+                facts.pop()
+                n_facts += 1
+            elif referable_test:
+                referable_test = ''
+                dropped_reference = True
+            else:
+                logger.warning('Prompt still exceeds the budget of %s tokens after trimming', self.max_prompt_tokens)
+                break
+            prompt = render(context, facts, referable_test)
+            overflow = self.count_tokens(prompt) - self.max_prompt_tokens
+
+        logger.info('Trimmed prompt to fit %s tokens: dropped %s context members, %s facts%s',
+                    self.max_prompt_tokens, n_members, n_facts, ' and the referable test' if dropped_reference else '')
+        return prompt
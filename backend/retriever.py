@@ -1,55 +1,78 @@
-import re
+import os
 import torch
 import numpy as np
-from nltk.corpus import stopwords
-from typing import List
-from rank_bm25 import BM25Okapi
-from transformers import AutoModel, AutoTokenizer
+from typing import List, Optional
+from bm25_index import BM25Index
+from code_tokenizer import CodeTokenizer
+from embedding_backend import EmbeddingBackend, load_embedding_backend
+from embedding_store import EmbeddingStore
 
 
 class Retriever():
     def __init__(
         self, corpus_cov: List[str], corpus_fm: List[str], corpus_fm_name: List[str], corpus_tc: List[str], corpus_tc_desc: List[str], corpus_test_case_path,
-        embedding_model=None, tokenizer=None
+        embedding_model=None, tokenizer=None, index_dir: Optional[str] = None, code_tokenizer: Optional[CodeTokenizer] = None,
+        embedding_backend: Optional[EmbeddingBackend] = None
     ) -> None:
+        # index_dir: where the BM25 indexes and description embeddings of this corpus are kept between runs
+        # (rebuilt in memory when None)
+        # code_tokenizer: shared by the three corpora and the queries, so each distinct text is tokenized once
+        # embedding_backend: encodes test case descriptions; by default the [embedding] backend of config.ini, running
+        # embedding_model/tokenizer when given
         super().__init__()
         self.top_k_fm = 30 
-        self.embedding_model = embedding_model if embedding_model is not None else AutoModel.from_pretrained("Salesforce/codet5p-110m-embedding", trust_remote_code=True).eval().to('cuda')
-        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained("Salesforce/codet5p-110m-embedding", trust_remote_code=True)
+        self.embedding_backend = embedding_backend if embedding_backend is not None else load_embedding_backend(embedding_model, tokenizer)
         self.corpus_cov = corpus_cov
         self.corpus_fm = corpus_fm
         self.corpus_fm_name = corpus_fm_name
         self.corpus_tc = corpus_tc
         self.corpus_tc_desc = corpus_tc_desc
         self.corpus_test_case_path = corpus_test_case_path
-        self.corpus_tc_desc_base = torch.stack([self.tc_desc_embedding(tc_desc) for tc_desc in corpus_tc_desc])
-        self.corpus_fm_base = [self.preprocess_code(doc) for doc in corpus_fm]
-        self.corpus_cov_base = [self.preprocess_code(doc) for doc in corpus_cov]
-        self.bm25_fm = BM25Okapi(self.corpus_fm_base)
-        self.bm25_cov = BM25Okapi(self.corpus_cov_base)
+        self.index_dir = index_dir
+        # corpus description embeddings are looked up (and the missing ones embedded) on the first similarity query
+        self.tc_desc_store = EmbeddingStore(self._embedding_path())
+        self.corpus_tc_desc_rows = None
+        self.code_tokenizer = code_tokenizer if code_tokenizer is not None else CodeTokenizer()
+        self.bm25_fm = BM25Index.for_corpus(corpus_fm, self.preprocess_code, self._index_path('fm'))
+        self.bm25_cov = BM25Index.for_corpus(corpus_cov, self.preprocess_code, self._index_path('cov'))
+        self.bm25_tc = None  # only ideal_retrieve needs it
 
     @torch.no_grad()
     def retrieve_with_threshold(self, target_fm: str, target_tc_desc, threshold: float = 0.2, top_k: int = 1):
-        fm_self_sim_score, fm_ref_sim_scores = self.get_score_self_and_ref_fm(target_fm)
-        norm_fm_ref_sim_scores = fm_ref_sim_scores / fm_self_sim_score
-        filter_indices = norm_fm_ref_sim_scores >= threshold
-        if sum(filter_indices) == 0:
-            print(f'No reference. max score: {max(norm_fm_ref_sim_scores)} | threshold: {threshold}')
-            return [], [], [], [], [], [], []
+        return self.retrieve_batch([target_fm], [target_tc_desc], threshold, top_k)[0]
 
-        # get the similarity between the target test case name and the test case names 
-        target_tc_desc_embedding = self.tc_desc_embedding(target_tc_desc)
-        tc_desc_similarities = torch.cosine_similarity(target_tc_desc_embedding, self.corpus_tc_desc_base, dim=1).cpu().numpy()
-        
-        # combine the scores of focal methods and the similarities of test case names
-        combined_scores = norm_fm_ref_sim_scores + tc_desc_similarities
+    @torch.no_grad()
+    def retrieve_batch(self, target_fms: List[str], target_tc_descs: List[str], threshold: float = 0.2, top_k: int = 1, batch_size: int = 256):
+        """retrieve_with_threshold for many targets, one result tuple per target.
 
-        # sort the combined scores
-        combined_scores[~filter_indices] = -1
-        sorted_indices = np.argsort(combined_scores)[::-1]
-        top_k_indices = sorted_indices[:top_k]
-        
-        return [self.corpus_cov[i] for i in top_k_indices], [self.corpus_fm[i] for i in top_k_indices], [self.corpus_fm_name[i] for i in top_k_indices], [self.corpus_tc[i] for i in top_k_indices], [self.corpus_tc_desc[i] for i in top_k_indices], [combined_scores[i] for i in top_k_indices], [self.corpus_test_case_path[i] for i in top_k_indices]
+        The BM25 scores of each chunk of `batch_size` targets come from one pass over the index; the threshold, the
+        description similarities and the top-k selection are applied to the whole (targets x corpus) matrix.
+        """
+        results = []
+        for start in range(0, len(target_fms), batch_size):
+            chunk_fms = target_fms[start:start + batch_size]
+            chunk_descs = target_tc_descs[start:start + batch_size]
+            fm_self_sim_scores, fm_ref_sim_scores = self.bm25_fm.score_batch([self.preprocess_code(fm) for fm in chunk_fms])
+            norm_fm_ref_sim_scores = fm_ref_sim_scores / fm_self_sim_scores[:, None]
+            filter_indices = norm_fm_ref_sim_scores >= threshold
+            has_reference = filter_indices.any(axis=1)
+
+            # combine the scores of focal methods and the similarities of test case names, for targets with any reference
+            combined_scores = np.full(norm_fm_ref_sim_scores.shape, -1.0)
+            rows = np.flatnonzero(has_reference)
+            if len(rows) > 0:
+                tc_desc_similarities = self.tc_desc_similarities([chunk_descs[row] for row in rows])
+                combined_scores[rows] = norm_fm_ref_sim_scores[rows] + tc_desc_similarities
+                combined_scores[~filter_indices] = -1
+            top_k_indices = self.top_k_indices(combined_scores, top_k)
+
+            for row in range(len(chunk_fms)):
+                if not has_reference[row]:
+                    print(f'No reference. max score: {max(norm_fm_ref_sim_scores[row])} | threshold: {threshold}')
+                    results.append(([], [], [], [], [], [], []))
+                else:
+                    results.append(self._references(top_k_indices[row], combined_scores[row]))
+        return results
     
     def ideal_retrieve(self, target_tc: str, threshold: float = 0.6, top_k: int = 1):
         tc_self_sim_score, tc_ref_sim_scores = self.get_score_self_and_ref_tc(target_tc)
@@ -61,48 +84,76 @@ class Retriever():
 
         # sort the combined scores
         norm_tc_ref_sim_scores[~filter_indices] = -1
-        sorted_indices = np.argsort(norm_tc_ref_sim_scores)[::-1]
-        top_k_indices = sorted_indices[:top_k]
+        top_k_indices = self.top_k_indices(norm_tc_ref_sim_scores[None, :], top_k)[0]
         
-        return [self.corpus_cov[i] for i in top_k_indices], [self.corpus_fm[i] for i in top_k_indices], [self.corpus_fm_name[i] for i in top_k_indices], [self.corpus_tc[i] for i in top_k_indices], [self.corpus_tc_desc[i] for i in top_k_indices], [norm_tc_ref_sim_scores[i] for i in top_k_indices], [self.corpus_test_case_path[i] for i in top_k_indices]
+        return self._references(top_k_indices, norm_tc_ref_sim_scores)
+
+    def top_k_indices(self, scores, top_k):
+        """Column indices of the `top_k` highest scores of each row, highest first, without sorting whole rows."""
+        k = min(top_k, scores.shape[1])
+        if k <= 0:
+            return np.empty((scores.shape[0], 0), dtype=np.int64)
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(candidates, order, axis=1)
+
+    def _references(self, indices, scores):
+        return [self.corpus_cov[i] for i in indices], [self.corpus_fm[i] for i in indices], [self.corpus_fm_name[i] for i in indices], [self.corpus_tc[i] for i in indices], [self.corpus_tc_desc[i] for i in indices], [scores[i] for i in indices], [self.corpus_test_case_path[i] for i in indices]
 
     def preprocess_code(self, code):
-        # Tokenize the code
-        tokens = re.split(r'\W+', code)
-        
-        # Convert tokens to lowercase
-        tokens = [token.lower() for token in tokens]
-        
-        # Remove stop words
-        stop_words = set(stopwords.words('english'))
-        custom_stop_words = set(['public', 'private', 'protected', 'void', 'int', 'double', 'float', 'string', 'package', 'junit', 'assert', 'import', 'class', 'cn', 'org'])
-        filtered_tokens = [token for token in tokens if token not in stop_words and token not in custom_stop_words]
-        filtered_tokens = [token for token in filtered_tokens if len(token) > 1]
-        return filtered_tokens
+        # lowercase words without stop words, see CodeTokenizer
+        return self.code_tokenizer(code)
     
     @torch.no_grad()
     def tc_desc_embedding(self, test_desc):
-        inputs = self.tokenizer.encode(test_desc, return_tensors="pt", truncation=True).to("cuda")
-        embedding = self.embedding_model(inputs)[0]
-        return embedding
+        return self.tc_desc_embeddings([test_desc])[0]
+
+    @torch.no_grad()
+    def tc_desc_embeddings(self, test_descs):
+        # (len(test_descs), dim), encoded in length-sorted batches
+        return self.embedding_backend.encode(test_descs)
     
+    @torch.no_grad()
+    def tc_desc_similarities(self, target_tc_descs):
+        """Cosine similarity between each target test case description and every corpus description, (targets x corpus)."""
+        return self.tc_desc_store.similarities(self.normalized_tc_desc_embeddings(target_tc_descs), self._corpus_tc_desc_rows())
+
+    @property
+    def corpus_tc_desc_base(self):
+        # unit-length embeddings of corpus_tc_desc, (corpus, dim); a float32 copy of the stored rows
+        return torch.from_numpy(self.tc_desc_store.matrix[self._corpus_tc_desc_rows()].astype(np.float32))
+
+    @torch.no_grad()
+    def normalized_tc_desc_embeddings(self, test_descs):
+        return torch.nn.functional.normalize(self.tc_desc_embeddings(test_descs), dim=1).float().cpu().numpy()
+
     def get_score_self_and_ref_fm(self, target_fm):
+        # the scores of BM25 over the corpus plus the target itself, without building that BM25
         target_fm_proc = self.preprocess_code(target_fm)
-        corpus_added_self = self.corpus_fm_base + [target_fm_proc]
-        bm25_fm_added_self = BM25Okapi(corpus_added_self)
-        bm25_score = bm25_fm_added_self.get_scores(target_fm_proc)
-        self_score = bm25_score[-1]
-        # max_score = max(bm25_score)
-        # assert self_score == max_score
-        ref_sim_scores = bm25_score[:-1]
+        self_score, ref_sim_scores = self.bm25_fm.get_scores_with_self(target_fm_proc)
         return self_score, ref_sim_scores
     
     def get_score_self_and_ref_tc(self, target_tc):
         target_tc_proc = self.preprocess_code(target_tc)
-        corpus_tc_base = [self.preprocess_code(tc) for tc in self.corpus_tc]
-        corpus_added_self = corpus_tc_base + [target_tc_proc]
-        bm25_tc_added_self = BM25Okapi(corpus_added_self)
-        bm25_score = bm25_tc_added_self.get_scores(target_tc_proc)
-        self_score = bm25_score[-1]
-        ref_sim_scores = bm25_score[:-1]
-        return self_score, ref_sim_scores
\ No newline at end of file
+        if self.bm25_tc is None:
+            self.bm25_tc = BM25Index.for_corpus(self.corpus_tc, self.preprocess_code, self._index_path('tc'))
+        self_score, ref_sim_scores = self.bm25_tc.get_scores_with_self(target_tc_proc)
+        return self_score, ref_sim_scores
+
+    def _index_path(self, corpus_name):
+        if self.index_dir is None:
+            return None
+        # the saved token counts are only valid for the tokenizer settings they were made with
+        suffix = '-subtokens' if self.code_tokenizer.split_subtokens else ''
+        return os.path.join(self.index_dir, f'bm25_{corpus_name}{suffix}.pkl')
+
+    def _corpus_tc_desc_rows(self):
+        if self.corpus_tc_desc_rows is None:
+            self.corpus_tc_desc_rows = self.tc_desc_store.rows_for(self.corpus_tc_desc, self.normalized_tc_desc_embeddings)
+        return self.corpus_tc_desc_rows
+
+    def _embedding_path(self):
+        # one store per embedding model: vectors of different models (or quantizations) are not comparable
+        if self.index_dir is None:
+            return None
+        return os.path.join(self.index_dir, f'tc_desc_{self.embedding_backend.name}.pkl')
\ No newline at end of file
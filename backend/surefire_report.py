@@ -0,0 +1,126 @@
+import os
+import xml.etree.ElementTree as ET
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, List, Optional
+
+# frames of the test framework and reflection say nothing about why the generated test failed
+NOISE_FRAME_PREFIXES = (
+    'org.junit.', 'junit.framework.', 'org.opentest4j.', 'org.apache.maven.', 'sun.reflect.', 'java.lang.reflect.',
+    'jdk.internal.', 'java.util.ArrayList.forEach', 'java.util.stream.', 'org.mockito.internal.',
+)
+MAX_STACK_FRAMES = 5
+
+
+@dataclass
+class TestMethodResult:
+    class_name: str
+    name: str
+    status: str  # passed, failure, error or skipped
+    failure_type: str = ''
+    message: str = ''
+    stack_frames: List[str] = field(default_factory=list)
+    time: float = 0.0
+
+    def describe(self) -> str:
+        header = f'{self.name}: {self.failure_type}' + (f': {self.message}' if self.message else '')
+        return '\n'.join([header] + [f'    at {frame}' for frame in self.stack_frames])
+
+
+@dataclass
+class SurefireResult:
+    methods: List[TestMethodResult]
+
+    def count(self, status: str) -> int:
+        return sum(1 for each in self.methods if each.status == status)
+
+    @property
+    def tests_run(self) -> int:
+        return len(self.methods)
+
+    def test_status(self) -> str:
+        # same classification as the console summary: one passing method is enough
+        if self.count('passed') > 0:
+            return 'success'
+        if self.count('failure') > 0:
+            return 'fail_pass'
+        return 'fail_execute'
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SurefireResult':
+        return cls([TestMethodResult(**each) for each in data['methods']])
+
+    def error_summary(self) -> str:
+        """The failing methods with their exception and the frames that point into the test, for refine prompts."""
+        failed = [each for each in self.methods if each.status in ('failure', 'error')]
+        if not failed:
+            if not self.methods:
+                return 'No test method was executed.'
+            return '' if self.count('passed') > 0 else 'All test methods were skipped.'
+        return '\n\n'.join(each.describe() for each in failed)
+
+
+def _trim_stack(stack_trace: str) -> List[str]:
+    frames = []
+    for line in stack_trace.split('\n'):
+        line = line.strip()
+        if not line.startswith('at '):
+            continue
+        frame = line[3:]
+        method, _, location = frame.partition('(')
+        if '/' in method:
+            # drop the module prefix of Java 9+ frames, e.g. `java.base/`
+            frame = method.rsplit('/', 1)[1] + _ + location
+        if frame.startswith(NOISE_FRAME_PREFIXES):
+            continue
+        frames.append(frame)
+        if len(frames) >= MAX_STACK_FRAMES:
+            break
+    return frames
+
+
+def parse_surefire_reports(report_paths: Iterable[str], class_name: str) -> Optional[SurefireResult]:
+    """Read the `<testcase>` results of `class_name` (and its nested classes) from surefire-style XML reports.
+
+    Uses iterparse and drops each testcase once read, so large `system-out` sections are not kept around.
+    Returns None when none of the reports exists or contains the class.
+    """
+    methods = []
+    for path in report_paths:
+        if not os.path.exists(path):
+            continue
+        try:
+            for _, elem in ET.iterparse(path, events=('end',)):
+                if elem.tag != 'testcase':
+                    continue
+                case_class = elem.get('classname', '')
+                if case_class == class_name or case_class.startswith(class_name + '$'):
+                    methods.append(_parse_testcase(elem, case_class))
+                elem.clear()
+        except ET.ParseError:
+            # a report that is still being written, or truncated by a killed JVM
+            continue
+    return SurefireResult(methods) if methods else None
+
+
+def _parse_testcase(elem: ET.Element, case_class: str) -> TestMethodResult:
+    result = TestMethodResult(class_name=case_class, name=elem.get('name', ''), status='passed')
+    try:
+        result.time = float(elem.get('time', 0) or 0)
+    except ValueError:
+        pass
+    for child in elem:
+        if child.tag in ('failure', 'error'):
+            result.status = child.tag
+            result.failure_type = child.get('type', '')
+            result.message = (child.get('message') or '').strip()
+            result.stack_frames = _trim_stack(child.text or '')
+            if not result.failure_type and child.text:
+                result.failure_type = child.text.strip().split('\n')[0].split(':')[0]
+            break
+        if child.tag == 'skipped':
+            result.status = 'skipped'
+            break
+    return result
@@ -1,16 +1,39 @@
 import os
+import glob
 import json
+import hashlib
 import shutil
 import re
 from tqdm import tqdm
-from bs4 import BeautifulSoup
 import subprocess
 import sys
 import asyncio
+import signal
 import threading
+import time
 import logging
+from collections import deque
+
+from core.deadline import Deadline
+from core.exceptions import DeadlineExceeded, GenerationCancelled
+from core.outcome_cache import TestOutcomeCache
+from surefire_report import SurefireResult, parse_surefire_reports
+from user_config import global_config
+from workspace_pool import leased_workspace, project_manifest, sources_fingerprint
+from main_snapshot import MainClassesSnapshots
+from batch_test_runner import BatchTest, BatchTestRunner
+import jacoco_coverage
 logger = logging.getLogger(__name__)
 
+# shared by every session (and, through SQLite, every server process): a candidate identical to one already run
+# against the same project sources gets the earlier outcome without another build
+outcome_cache = TestOutcomeCache(
+    path=global_config.get('outcome_cache', 'path', fallback=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'outcome_cache.sqlite3')),
+    enabled=global_config.get('outcome_cache', 'mode', fallback='on') == 'on',
+    max_bytes=global_config.getint('outcome_cache', 'max_size_mb', fallback=1024) * 1024 * 1024,
+    max_age=global_config.getfloat('outcome_cache', 'max_age_days', fallback=7) * 24 * 3600,
+)
+
 # Not provided setting JAVA_HOME for Maven at runtime yet, to be implemented
 # JAVA_ENVS = {
 #     'JAVA_HOME': ''
@@ -18,53 +41,259 @@ logger = logging.getLogger(__name__)
 # env_vars = os.environ.copy()
 # env_vars.update(JAVA_ENVS)
 
-class Buffer:
-    def __init__(self):
-        self.stdout = ''
-        self.stderr = ''
-
-def stream_output(pipe, buffer, out_type):
-    for line in iter(pipe.readline, ''):
-        print(line, end='')
-        if out_type == 'stdout':
-            buffer.stdout += line
-        elif out_type == 'stderr':
-            buffer.stderr += line
-    pipe.close()
+# how often a running build checks should_stop, and how often its new output lines go to the client
+STOP_POLL_INTERVAL = 0.1
+BUILD_PROGRESS_INTERVAL = 0.25
+# asyncio's default of 64 KiB per line is too small for some stack traces printed on one line
+STREAM_LINE_LIMIT = 1 << 20
+
+class BuildOutput:
+    """Output of one build: the last `max_lines` lines of each stream in memory, every line in `log_path` (if given),
+    and batches of new lines passed to `on_lines` while the build runs."""
+
+    def __init__(self, max_lines, log_path=None, on_lines=None):
+        self.lines = {'stdout': deque(maxlen=max_lines), 'stderr': deque(maxlen=max_lines)}
+        self.dropped = {'stdout': 0, 'stderr': 0}
+        self.log_path = log_path
+        self.log_file = open(log_path, 'a', encoding='utf8') if log_path else None
+        self.on_lines = on_lines
+        self._pending = []
+        self._flushed_at = time.monotonic()
+
+    def add(self, line, stream):
+        lines = self.lines[stream]
+        if len(lines) == lines.maxlen:
+            self.dropped[stream] += 1
+        lines.append(line)
+        if self.log_file is not None:
+            self.log_file.write(line)
+        if self.on_lines is not None:
+            self._pending.append(line.rstrip('\r\n'))
+            if time.monotonic() - self._flushed_at >= BUILD_PROGRESS_INTERVAL:
+                self.flush()
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self.on_lines(pending)
+
+    def close(self):
+        if self.on_lines is not None:
+            self.flush()
+        if self.log_file is not None:
+            self.log_file.close()
+
+    def text(self, stream):
+        text = ''.join(self.lines[stream])
+        if self.dropped[stream]:
+            where = f', see {self.log_path}' if self.log_path else ''
+            text = f'[... {self.dropped[stream]} earlier lines omitted{where}]\n' + text
+        return text
+
+# Maven's compiler plugin, or javac itself on the fast runner
+COMPILE_FAILURE_PATTERN = re.compile(r'COMPILATION ERROR|Failed to execute goal \S*maven-compiler-plugin:[^:\s]+:(?:testCompile|compile)|\.java:\d+: error:')
+TESTS_RUN_PATTERN = re.compile(r'Tests run: (\d+), Failures: (\d+), Errors: (\d+), Skipped: (\d+)')
+
+def is_compile_failure(maven_log):
+    return COMPILE_FAILURE_PATTERN.search(maven_log) is not None
+
+def parse_tests_run(maven_log):
+    # the last match is surefire's summary over all test classes
+    matches = TESTS_RUN_PATTERN.findall(maven_log)
+    if not matches:
+        return None
+    return tuple(int(each) for each in matches[-1])
+
+JUNIT5_LAUNCHER_VERSION = '1.10.2'
+JUNIT_COUNT_PATTERN = re.compile(r'\[\s*(\d+) tests (found|successful|failed|skipped|aborted)\s*\]')
+ASSERTION_FAILURE_PATTERN = re.compile(r'AssertionError|AssertionFailedError|ComparisonFailure|MultipleFailuresError')
+# where the JUnit 5 launcher writes its surefire-compatible XML report
+FAST_REPORTS_DIR = 'target/fast-runner-reports'
+
+def test_class_name(test_case_path):
+    return test_case_path.split('/src/test/java/')[1].replace('.java', '').replace('/', '.')
+
+def project_fingerprint(project_dir, exclude_path=None):
+    """Hash of the path, size and mtime of every project file except build output, .git and `exclude_path`.
+
+    Workspace copies of a project are hard links (or copies that keep mtimes), so they share the original's fingerprint.
+    In a leased workspace it comes from the manifest of its last sync instead of another walk over the project.
+    """
+    workspace = leased_workspace(project_dir)
+    if workspace is not None:
+        return workspace.fingerprint(project_dir, exclude_path)
+    exclude = os.path.relpath(exclude_path, project_dir).replace(os.sep, '/') if exclude_path else None
+    return sources_fingerprint(project_manifest(project_dir), exclude)
+
+def is_deterministic_outcome(compile_log, test_log, compile_success, execute_success, test_report):
+    """Whether running the same test against the same sources again must give the same result: it passed, did not
+    compile, or only failed assertions. Errors, crashed or killed JVMs and builds that broke for other reasons may not."""
+    if not compile_success:
+        return is_compile_failure(compile_log)
+    if execute_success:
+        return True
+    if test_report is not None:
+        return test_report.count('failure') > 0 and test_report.count('error') == 0
+    tests_run = parse_tests_run(test_log)
+    return tests_run is not None and tests_run[1] > 0 and tests_run[2] == 0
+
+class FastTestRunner():
+    """Compiles only the generated test with javac and runs only that class with the JUnit launcher,
+    against the dependency classpath that Maven resolved once per pom.xml.
+
+    The main classes come from a snapshot of `src/main` compiled for the current sources (see main_snapshot), so
+    a change to src/main costs a javac run over the changed files rather than a Maven build.
+
+    compile_and_execute_test_case returns None whenever Maven has to do the work instead: no classpath or
+    main classes snapshot for this pom.xml yet, src/main does not compile on its own, or no JDK tools or launcher available.
+    """
+
+    def __init__(self, runner, cache_dir):
+        self.runner = runner
+        self.cache_dir = cache_dir
+        self.snapshots = MainClassesSnapshots(f'{cache_dir}/main_classes', runner.run_build)
+
+    def compile_and_execute_test_case(self, test_case_path, junit_version, env, should_stop=None, log_path=None, on_output=None, deadline=None):
+        project_dir = test_case_path.split('/src/test/')[0]
+        deadline = deadline or Deadline(None)
+        classpath = self.load_classpath(project_dir)
+        if classpath is None:
+            return None
+        if shutil.which('javac', path=env.get('PATH')) is None or shutil.which('java', path=env.get('PATH')) is None:
+            return None
+        # the snapshot stays pinned until the test has run, so a concurrent prune cannot delete it from under the JVM
+        with self.main_classes(project_dir, classpath, env, should_stop) as main_classes_dir:
+            if main_classes_dir is None:
+                return None
+            return self._compile_and_execute(test_case_path, project_dir, main_classes_dir, classpath, junit_version, env, should_stop, log_path, on_output, deadline)
+
+    def _compile_and_execute(self, test_case_path, project_dir, main_classes_dir, classpath, junit_version, env, should_stop, log_path, on_output, deadline):
+        stage_budgets = self.runner.configs.stage_budgets
+        junit5 = self._is_junit5(test_case_path, junit_version)
+        launcher = self.junit5_launcher(project_dir, env, should_stop) if junit5 else None
+        if junit5 and launcher is None:
+            return None
+
+        test_classes_dir = f'{project_dir}/target/test-classes'
+        os.makedirs(test_classes_dir, exist_ok=True)
+        full_classpath = os.pathsep.join([test_classes_dir, main_classes_dir, classpath])
+
+        # -sourcepath lets javac pick up test helpers the generated test refers to
+        javac_cmd = ['javac', '-nowarn', '-encoding', 'UTF-8', '-d', test_classes_dir, '-cp', full_classpath,
+                     '-sourcepath', f'{project_dir}/src/test/java', test_case_path]
+        result = self.runner.run_build(javac_cmd, project_dir, env, should_stop, log_path, on_output, deadline.for_stage('compile', stage_budgets['compile']))
+        compile_log = f'{result.stdout}\n\n{result.stderr}\n\n'
+        if result.returncode != 0:
+            return compile_log, '', False, False, None
+
+        class_name = test_class_name(test_case_path)
+        reports_dir = f'{project_dir}/{FAST_REPORTS_DIR}'
+        if junit5:
+            shutil.rmtree(reports_dir, ignore_errors=True)
+            run_cmd = ['java', '-jar', launcher, '--disable-banner', '--details=tree', '-cp', full_classpath, '--select-class', class_name,
+                       f'--reports-dir={reports_dir}']
+        else:
+            run_cmd = ['java', '-cp', full_classpath, 'org.junit.runner.JUnitCore', class_name]
+        result = self.runner.run_build(run_cmd, project_dir, env, should_stop, log_path, on_output, deadline.for_stage('execute', stage_budgets['execute']))
+        test_log = f'{result.stdout}\n\n{result.stderr}\n\n'
+        counts = self._parse_junit5_counts(test_log) if junit5 else self._parse_junit4_counts(test_log)
+        if counts is None:
+            # the launcher did not get as far as running tests, e.g. a conflicting JUnit on the classpath
+            logger.info(f'JUnit launcher gave no summary for {class_name}, falling back to Maven')
+            return None
+
+        run, failed, skipped = counts
+        # JUnit does not separate failed assertions from errors the way surefire does
+        failures, errors = (failed, 0) if ASSERTION_FAILURE_PATTERN.search(test_log) else (0, failed)
+        # same summary line as surefire, which is what IntentionTester.run_test_case reads without a report
+        test_log += f'Tests run: {run}, Failures: {failures}, Errors: {errors}, Skipped: {skipped}\n'
+        # the JUnit 5 launcher writes the same XML as surefire; JUnitCore writes none
+        test_report = parse_surefire_reports(sorted(glob.glob(f'{reports_dir}/TEST-*.xml')), class_name) if junit5 else None
+        return compile_log, test_log, True, run > skipped and failed == 0, test_report
+
+    def refresh(self, project_dir, env, should_stop=None):
+        """Called after a Maven build compiled src/main: resolve the classpath if needed and snapshot target/classes."""
+        classpath_path = self._classpath_path(project_dir)
+        if not os.path.exists(classpath_path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{classpath_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            cmd = ['mvn', '-q', 'dependency:build-classpath', f'-Dmdep.outputFile={tmp_path}', '-Dmdep.includeScope=test']
+            result = self.runner.run_build(cmd, project_dir, env, should_stop)
+            if result.returncode != 0 or not os.path.exists(tmp_path):
+                logger.warning(f'Failed to resolve the test classpath of {project_dir}, staying on Maven:\n{result.stdout}{result.stderr}')
+                return
+            os.replace(tmp_path, classpath_path)
+        self.snapshots.seed(project_dir, self._classpath_key(project_dir))
+
+    def load_classpath(self, project_dir):
+        classpath_path = self._classpath_path(project_dir)
+        if not os.path.exists(classpath_path):
+            return None
+        with open(classpath_path, encoding='utf8') as f:
+            return f.read().strip()
+
+    def main_classes(self, project_dir, classpath, env, should_stop=None):
+        """Context manager yielding the main classes snapshot for the current sources (or None), pinned while in use."""
+        return self.snapshots.use(project_dir, self._classpath_key(project_dir), classpath, env, should_stop)
+
+    def junit5_launcher(self, project_dir, env, should_stop=None):
+        return self.cached_artifact(project_dir, env, f'org.junit.platform:junit-platform-console-standalone:{JUNIT5_LAUNCHER_VERSION}', should_stop)
+
+    def cached_artifact(self, project_dir, env, artifact, should_stop=None):
+        """Path of the jar `group:artifact:version[:packaging[:classifier]]` in the cache, fetched with Maven the first time."""
+        parts = artifact.split(':')
+        classifier = f'-{parts[4]}' if len(parts) > 4 else ''
+        jar = f'{self.cache_dir}/{parts[1]}-{parts[2]}{classifier}.jar'
+        if not os.path.exists(jar):
+            cmd = ['mvn', '-q', 'dependency:copy', f'-Dartifact={artifact}', f'-DoutputDirectory={self.cache_dir}']
+            self.runner.run_build(cmd, project_dir, env, should_stop)
+        return jar if os.path.exists(jar) else None
+
+    def _classpath_path(self, project_dir):
+        return f'{self.cache_dir}/{self._classpath_key(project_dir)}.classpath'
+
+    def _classpath_key(self, project_dir):
+        # keyed by the pom and its parent, so a dependency change resolves a new classpath while copies of the same project share one
+        sha1 = hashlib.sha1()
+        for pom in (f'{project_dir}/pom.xml', f'{project_dir}/../pom.xml'):
+            if os.path.exists(pom):
+                with open(pom, 'rb') as f:
+                    sha1.update(f.read())
+        return sha1.hexdigest()
+
+    def _is_junit5(self, test_case_path, junit_version):
+        if junit_version is not None:
+            return str(junit_version) == '5'
+        with open(test_case_path, encoding='utf8') as f:
+            return 'org.junit.jupiter' in f.read()
+
+    def _parse_junit5_counts(self, output):
+        counts = {kind: int(n) for n, kind in JUNIT_COUNT_PATTERN.findall(output)}
+        if 'found' not in counts:
+            return None
+        return counts['found'], counts.get('failed', 0), counts.get('skipped', 0) + counts.get('aborted', 0)
+
+    def _parse_junit4_counts(self, output):
+        ok = re.search(r'^OK \((\d+) tests?\)', output, re.MULTILINE)
+        if ok:
+            return int(ok.group(1)), 0, 0
+        failed = re.search(r'^Tests run: (\d+),\s+Failures: (\d+)', output, re.MULTILINE)
+        if failed:
+            return int(failed.group(1)), int(failed.group(2)), 0
+        return None
 
 class TestCaseRunner():
     def __init__(self, configs, test_case_run_log_dir):
         self.configs = configs
         self.test_case_run_log_dir = test_case_run_log_dir
+        self.fast_runner = FastTestRunner(self, configs.classpath_cache_dir) if configs.test_runner_engine == 'fast' else None
         self.cur_no_ref_log_name = None
         self.cur_human_ref_log_name = None
         self.cur_rag_ref_log_name = None
 
         self.focal_file_coverage = dict()  # e.g., {'Base64_1_no_ref': cov_no_ref, 'Base64_1_with_rag_ref': cov_with_rag_ref}
 
-    def run_with_std_out(self, *args, **kwargs):
-        return asyncio.run(self.__run_with_std_out(*args, **kwargs))
-    
-    async def __run_with_std_out(self, *args, **kwargs):
-        process = subprocess.Popen(*args, **kwargs)
-
-        buffer = Buffer()
-
-        # Create threads for stdout and stderr
-        stdout_thread = threading.Thread(target=stream_output, args=(process.stdout, buffer, 'stdout'))
-        stderr_thread = threading.Thread(target=stream_output, args=(process.stderr, buffer, 'stderr'))
-
-        # Start the threads
-        stdout_thread.start()
-        stderr_thread.start()
-
-        # Wait for both threads to finish
-        stdout_thread.join()
-        stderr_thread.join()
-        process.wait()
-
-        return buffer
-    
     def run_with_err_out(self, *args, **kwargs):
         process = subprocess.run(*args, **kwargs)
         if process.returncode != 0:
@@ -77,23 +306,110 @@ class TestCaseRunner():
         return process
 
     def run_all_test_cases(self, test_cases, is_ref):
+        if self.configs.test_batch_size > 1:
+            return self.run_all_test_cases_in_batches(test_cases, is_ref)
         test_case_with_log_coverage = []
         # run the generated test cases
         for each_test_case in tqdm(test_cases, ncols=80, desc='Running test cases'):
-            focal_file_path = each_test_case['focal_file_path']
-
-            generation_relative_path = each_test_case['test_case_path']
-            tc_path = f"{self.configs.project_with_test_workspace}/{generation_relative_path}"
-            tc = each_test_case['generated_test_case']
-            fm_name_param = each_test_case['focal_method_name'].split('::::')[1]
+            self.run_one_test_case(each_test_case, is_ref)
+            test_case_with_log_coverage.append(each_test_case)
+        return test_case_with_log_coverage
 
-            log_path, focal_file_coverage, fm_cov_statistic_by_jacoco = self.run_test_case_and_get_coverage(tc, tc_path, focal_file_path, fm_name_param, is_ref=is_ref)
+    def run_one_test_case(self, each_test_case, is_ref):
+        focal_file_path = each_test_case['focal_file_path']
+        tc_path = self.get_generated_test_case_path(each_test_case)
+        tc = each_test_case['generated_test_case']
+        fm_name_param = each_test_case['focal_method_name'].split('::::')[1]
+
+        log_path, focal_file_coverage, fm_cov_statistic_by_jacoco = self.run_test_case_and_get_coverage(tc, tc_path, focal_file_path, fm_name_param, is_ref=is_ref)
+        each_test_case[f'log_path_{is_ref}'] = log_path
+        each_test_case[f'coverage_focal_file'] = focal_file_coverage  # used for analyze_coverage_with_target_coverage()
+        each_test_case[f'coverage_focal_method'] = fm_cov_statistic_by_jacoco  # used for analyze_coverage_with_target_focal_method()
+
+    def get_generated_test_case_path(self, each_test_case):
+        return f"{self.configs.project_with_test_file_path}/{each_test_case['test_case_path']}"
+
+    def run_all_test_cases_in_batches(self, test_cases, is_ref):
+        """Same results as the one-by-one loop, but each batch of tests is compiled by one javac run and run in one JVM.
+
+        A batch holds tests of one project with distinct paths; tests of the same path go into later batches.
+        """
+        batch_runner = BatchTestRunner(self, self.fast_runner or FastTestRunner(self, self.configs.classpath_cache_dir))
+        env = self.build_env()
+        pending = list(test_cases)
+        with tqdm(total=len(pending), ncols=80, desc='Running test cases') as progress:
+            while pending:
+                batch, batch_paths, rest = [], set(), []
+                for each_test_case in pending:
+                    tc_path = self.get_generated_test_case_path(each_test_case)
+                    same_project = not batch or tc_path.split('/src/test/')[0] == self.get_generated_test_case_path(batch[0]).split('/src/test/')[0]
+                    if len(batch) < self.configs.test_batch_size and tc_path not in batch_paths and same_project:
+                        batch.append(each_test_case)
+                        batch_paths.add(tc_path)
+                    else:
+                        rest.append(each_test_case)
+                pending = rest
+                self.run_test_case_batch(batch_runner, batch, is_ref, env)
+                progress.update(len(batch))
+        return list(test_cases)
+
+    def run_test_case_batch(self, batch_runner, batch, is_ref, env):
+        tests = []
+        for each_test_case in batch:
+            tc_path = self.get_generated_test_case_path(each_test_case)
+            os.makedirs(os.path.dirname(tc_path), exist_ok=True)
+            with open(tc_path, 'w', encoding='utf8') as f:
+                f.write(each_test_case['generated_test_case'])
+            focal_class = each_test_case['focal_file_path'].split('src/main/java/')[1][:-len('.java')]
+            tests.append(BatchTest(tc_path, focal_class))
+        project_dir = tests[0].path.split('/src/test/')[0]
+        try:
+            results = batch_runner.run(project_dir, tests, env)
+        finally:
+            for test in tests:
+                if os.path.exists(test.path):
+                    os.remove(test.path)
+
+        if results is None:
+            logger.warning(f'Cannot run tests of {project_dir} in batches, running them one by one with Maven')
+            for each_test_case in batch:
+                self.run_one_test_case(each_test_case, is_ref)
+            return
+
+        for each_test_case, test in zip(batch, tests):
+            result = results[test.path]
+            log_path = self.new_run_log_path(each_test_case['focal_file_path'], is_ref)
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            with open(log_path, 'w', encoding='utf8') as f:
+                f.write(result.compile_log)
+                if not result.compile_success:
+                    f.write('\nCOMPILATION ERROR\n')
+                else:
+                    f.write(result.output)
+                    if result.timed_out:
+                        f.write(f"\n[ERROR] The test did not finish within {self.configs.stage_budgets['execute']:.0f} seconds and was killed\n")
+                    if result.test_report is not None:
+                        report = result.test_report
+                        f.write(f'\n{report.error_summary()}\n')
+                        f.write(f"Tests run: {report.tests_run}, Failures: {report.count('failure')}, Errors: {report.count('error')}, Skipped: {report.count('skipped')}\n")
+
+            focal_file_coverage, fm_cov_statistic_by_jacoco = None, None
+            lines_coverage = result.coverage.lines_coverage(f'{test.focal_class}.java') if result.coverage is not None else None
+            if lines_coverage is not None:
+                with open(f'{project_dir}/src/main/java/{test.focal_class}.java', 'r', encoding='utf8') as f:
+                    focal_file = f.readlines()
+                focal_file_coverage = ''.join(self.mark_covered_lines(focal_file, lines_coverage[0]))
+                fm_name_param = each_test_case['focal_method_name'].split('::::')[1]
+                fm_cov_statistic_by_jacoco = result.coverage.method_statistic(test.focal_class, fm_name_param)
             each_test_case[f'log_path_{is_ref}'] = log_path
-            each_test_case[f'coverage_focal_file'] = focal_file_coverage  # used for analyze_coverage_with_target_coverage()
-            each_test_case[f'coverage_focal_method'] = fm_cov_statistic_by_jacoco  # used for analyze_coverage_with_target_focal_method()
+            each_test_case[f'coverage_focal_file'] = focal_file_coverage
+            each_test_case[f'coverage_focal_method'] = fm_cov_statistic_by_jacoco
 
-            test_case_with_log_coverage.append(each_test_case)
-        return test_case_with_log_coverage
+    def mark_covered_lines(self, focal_file, cov_lines):
+        for line in cov_lines:
+            if focal_file[line - 1].strip() != '}':
+                focal_file[line - 1] = "<COVER>" + focal_file[line - 1]
+        return focal_file
 
     def save_log_coverage(self, log_coverage, save_path):
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -102,9 +418,25 @@ class TestCaseRunner():
             logger.debug(f'Saved the generated test cases log and coverage to {save_path}')
 
     def run_test_case(self, test_case_path, focal_file_path, is_ref):
-        assert is_ref in ('no_ref', 'human_ref', 'rag_ref')
         test_case_relative_path = self.get_test_case_relative_path(test_case_path)
+        log_file_path = self.new_run_log_path(focal_file_path, is_ref)
 
+        cwd_path = test_case_path.split('/src/test/')[0]
+
+        cmd = ['mvn', 'clean', 'verify', f'-Dtest={test_case_relative_path}', '-Dcheckstyle.skip=true']
+
+        logger.debug(f'Running test case: f{cmd}')
+        os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+        try:
+            self.run_build(cmd, cwd_path, self.build_env(), log_path=log_file_path, deadline=self.build_deadline())
+        except DeadlineExceeded as e:
+            logger.warning(f'{e}: {test_case_path}')
+            with open(log_file_path, 'a', encoding='utf8') as f:
+                f.write(f'\n[ERROR] {e}, the build was killed\n')
+        return log_file_path
+
+    def new_run_log_path(self, focal_file_path, is_ref):
+        assert is_ref in ('no_ref', 'human_ref', 'rag_ref')
         focal_method_name = focal_file_path.split('/')[-1].split('.')[0]
 
         suffix = is_ref
@@ -114,13 +446,6 @@ class TestCaseRunner():
             index += 1
             log_file_path = f'{self.test_case_run_log_dir}/{focal_method_name}_{index}_{suffix}.log'
         setattr(self, f'cur_{is_ref}_ref_log_name', f'{focal_method_name}_{index}_{suffix}')
-
-        cwd_path = test_case_path.split('/src/test/')[0]
-
-        cmd = f"cd {cwd_path} && mvn clean verify -Dtest={test_case_relative_path} -Dcheckstyle.skip=true > '{log_file_path}' 2>&1"
-
-        logger.debug(f'Running test case: f{cmd}')
-        os.system(cmd)
         return log_file_path
 
     def run_test_case_and_get_coverage(self, test_case, test_case_path, focal_file_path, focal_method_name_parameter, is_ref):
@@ -148,19 +473,63 @@ class TestCaseRunner():
 
         return focal_file_coverage, fm_cov_statistic_by_jacoco
 
-    def compile_and_execute_test_case(self, test_case, test_case_path):
-        compile_success, execute_success = False, False
-        compile_log, test_log = '', ''
-
-        tc_rel_path = test_case_path.split('/src/test/')[1]
-        tc_base_dir = test_case_path.replace(tc_rel_path, '')
-        os.makedirs(os.path.dirname(test_case_path), exist_ok=True)
-        with open(test_case_path, 'w', encoding='utf8') as f:
-            f.write(test_case)
-
-        test_case_relative_path = self.get_test_case_relative_path(test_case_path)
+    def run_build(self, cmd, cwd, env, should_stop=None, log_path=None, on_output=None, deadline=None):
+        """Like subprocess.run, but reads the output line by line as it is produced: only the last lines are kept
+        (the full output is appended to `log_path`), `on_output(lines)` receives new lines while the build runs,
+        and the whole process tree (mvn forks JVMs) is killed as soon as `should_stop` fires (GenerationCancelled)
+        or `deadline` expires (DeadlineExceeded)."""
+        output = BuildOutput(self.configs.build_log_tail_lines, log_path, on_output)
+        try:
+            if log_path is not None:
+                output.log_file.write(f'$ {subprocess.list2cmdline(cmd)}\n')
+            returncode = asyncio.run(self._run_build(cmd, cwd, env, should_stop, deadline, output))
+        finally:
+            output.close()
+        return subprocess.CompletedProcess(cmd, returncode, output.text('stdout'), output.text('stderr'))
+
+    async def _run_build(self, cmd, cwd, env, should_stop, deadline, output):
+        pipes = {'stdout': asyncio.subprocess.PIPE, 'stderr': asyncio.subprocess.PIPE, 'limit': STREAM_LINE_LIMIT}
+        if os.name == 'nt':
+            # mvn is a .cmd script on Windows and needs the shell there
+            process = await asyncio.create_subprocess_shell(subprocess.list2cmdline(cmd), cwd=cwd, env=env, **pipes)
+        else:
+            process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env, start_new_session=True, **pipes)
+
+        async def pump(stream, name):
+            while True:
+                try:
+                    line = await stream.readline()
+                except ValueError:  # a line longer than the limit: take it in pieces
+                    line = await stream.read(STREAM_LINE_LIMIT)
+                if not line:
+                    return
+                output.add(line.decode('utf8', errors='replace'), name)
+
+        build = asyncio.ensure_future(asyncio.gather(pump(process.stdout, 'stdout'), pump(process.stderr, 'stderr'), process.wait()))
+        while True:
+            done, _ = await asyncio.wait({build}, timeout=STOP_POLL_INTERVAL)
+            if done:
+                build.result()
+                return process.returncode
+            if deadline is not None and deadline.expired():
+                self._kill_process_tree(process)
+                await build
+                deadline.check()
+            if should_stop is not None and should_stop():
+                self._kill_process_tree(process)
+                await build
+                raise GenerationCancelled()
+
+    def _kill_process_tree(self, process):
+        if os.name == 'posix':
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-        cwd_path = test_case_path.split('/src/test/')[0]
+    def build_env(self):
         # Ensure JAVA_HOME is passed to subprocess
         env = os.environ.copy()
         if 'JAVA_HOME' not in env or not env['JAVA_HOME']:
@@ -175,21 +544,117 @@ class TestCaseRunner():
                     env['JAVA_HOME'] = candidate
                     env['PATH'] = f"{candidate}/bin:{env.get('PATH', '')}"
                     break
-        
-        mvn_compile_cmd = ['mvn', 'clean', f'-Dtest={test_case_relative_path}', 'test-compile', '-Dcheckstyle.skip=true']
-        compile_result = subprocess.run(mvn_compile_cmd, cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True, env=env)
-        compile_log = f'{compile_result.stdout}\n\n{compile_result.stderr}\n\n'
-
-        if "BUILD SUCCESS" in compile_log:
-            compile_success = True
-
-            mvn_test_cmd = ['mvn', 'clean', 'verify', f'-Dtest={test_case_relative_path}', '-Dcheckstyle.skip=true']  # test and get the coverage
-            test_result = subprocess.run(mvn_test_cmd, cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True, env=env)
-            test_log = f'{test_result.stdout}\n\n{test_result.stderr}'
-            if "BUILD SUCCESS" in test_log:
-                execute_success = True
-        
-        return compile_log, test_log, compile_success, execute_success
+        return env
+
+    def compile_and_execute_test_case(self, test_case, test_case_path, should_stop=None, junit_version=None, on_output=None, deadline=None):
+        """Builds are killed once their stage budget or `deadline` (the session's) runs out, raising DeadlineExceeded."""
+        os.makedirs(os.path.dirname(test_case_path), exist_ok=True)
+        if os.path.exists(test_case_path):
+            # in a workspace the file may be a hard link to the original project's copy; write a new file instead
+            os.remove(test_case_path)
+        with open(test_case_path, 'w', encoding='utf8') as f:
+            f.write(test_case)
+
+        test_case_relative_path = self.get_test_case_relative_path(test_case_path)
+        cwd_path = test_case_path.split('/src/test/')[0]
+        env = self.build_env()
+        # the full output of every build of this test in this project copy, overwritten by the next run
+        log_path = f'{self.test_case_run_log_dir}/builds/{os.path.basename(test_case_path)[:-5]}-{os.path.basename(cwd_path)}.log'
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        open(log_path, 'w').close()
+
+        # the generated test itself is part of the key, not of the fingerprint
+        cache_key = outcome_cache.make_key(test_case, test_case_path[len(cwd_path):], junit_version, project_fingerprint(cwd_path, test_case_path))
+        cached = outcome_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f'Reusing the outcome of an identical run of {test_case_relative_path}')
+            return self._restore_outcome(cached, cwd_path)
+
+        build_start = time.time()
+        result = self._compile_and_execute(test_case_path, test_case_relative_path, cwd_path, env, should_stop, junit_version, log_path, on_output, deadline or Deadline(None))
+        self._store_outcome(cache_key, result, cwd_path, build_start)
+        return result
+
+    def _compile_and_execute(self, test_case_path, test_case_relative_path, cwd_path, env, should_stop, junit_version, log_path, on_output, deadline):
+        compile_success, execute_success = False, False
+        compile_log, test_log = '', ''
+        test_report = None
+
+        if self.fast_runner is not None:
+            result = self.fast_runner.compile_and_execute_test_case(test_case_path, junit_version, env, should_stop, log_path, on_output, deadline)
+            if result is not None:
+                return result
+
+        # without `clean` the report of the previous candidate would still be there if this one does not compile
+        class_name = test_class_name(test_case_path)
+        report_path = f'{cwd_path}/target/surefire-reports/TEST-{class_name}.xml'
+        if os.path.exists(report_path):
+            os.remove(report_path)
+
+        # one incremental build: compile, run the test and write the JaCoCo report. test failures must not stop the
+        # build before the report is written, so whether the test passed is read from the surefire report instead
+        mvn_cmd = ['mvn', 'verify', f'-Dtest={test_case_relative_path}', '-Dcheckstyle.skip=true',
+                   '-Dmaven.test.failure.ignore=true', '-DfailIfNoTests=false', '-Dsurefire.failIfNoSpecifiedTests=false']
+        log = self._run_maven(mvn_cmd, cwd_path, env, should_stop, log_path, on_output, self.build_deadline(deadline))
+        if 'BUILD FAILURE' in log and not is_compile_failure(log) and parse_tests_run(log) is None:
+            # neither the compiler nor surefire complained, e.g. stale output in target/: retry once from scratch
+            logger.info(f'Incremental build failed without compile or test errors, rebuilding {cwd_path} from clean')
+            log = self._run_maven(['mvn', 'clean'] + mvn_cmd[1:], cwd_path, env, should_stop, log_path, on_output, self.build_deadline(deadline))
+
+        compile_log = log
+        test_report = parse_surefire_reports([report_path], class_name)
+        if test_report is None and (is_compile_failure(log) or ('BUILD FAILURE' in log and parse_tests_run(log) is None)):
+            return compile_log, test_log, compile_success, execute_success, test_report
+
+        compile_success = True
+        test_log = log
+        if self.fast_runner is not None:
+            self.fast_runner.refresh(cwd_path, env, should_stop)
+        if test_report is not None:
+            execute_success = test_report.count('passed') > 0 and test_report.count('failure') + test_report.count('error') == 0
+        else:
+            tests_run = parse_tests_run(log)
+            if tests_run is not None:
+                run, failures, errors, skipped = tests_run
+                execute_success = run > skipped and failures == 0 and errors == 0
+
+        return compile_log, test_log, compile_success, execute_success, test_report
+
+    def _store_outcome(self, cache_key, result, cwd_path, build_start):
+        compile_log, test_log, compile_success, execute_success, test_report = result
+        if not is_deterministic_outcome(*result):
+            # timeouts raise before getting here; anything else that may go differently next time is not cached either
+            return
+        coverage = None
+        jacoco_xml = jacoco_coverage.report_path(cwd_path)
+        if compile_success and os.path.exists(jacoco_xml) and os.path.getmtime(jacoco_xml) >= build_start:
+            with open(jacoco_xml, 'rb') as f:
+                coverage = f.read()
+        outcome = {
+            'compile_log': compile_log, 'test_log': test_log, 'compile_success': compile_success, 'execute_success': execute_success,
+            'test_report': test_report.to_dict() if test_report is not None else None,
+        }
+        outcome_cache.put(cache_key, outcome, coverage)
+
+    def _restore_outcome(self, cached, cwd_path):
+        if cached['coverage'] is not None:
+            # later coverage queries read the report of this test, as after a real run
+            jacoco_xml = jacoco_coverage.report_path(cwd_path)
+            os.makedirs(os.path.dirname(jacoco_xml), exist_ok=True)
+            with open(jacoco_xml, 'wb') as f:
+                f.write(cached['coverage'])
+        test_report = SurefireResult.from_dict(cached['test_report']) if cached['test_report'] is not None else None
+        return cached['compile_log'], cached['test_log'], cached['compile_success'], cached['execute_success'], test_report
+
+    def _run_maven(self, cmd, cwd, env, should_stop, log_path=None, on_output=None, deadline=None):
+        result = self.run_build(cmd, cwd, env, should_stop, log_path, on_output, deadline)
+        return f'{result.stdout}\n\n{result.stderr}\n\n'
+
+    def build_deadline(self, deadline=None):
+        # a Maven build compiles and runs the test in one go, so it gets both budgets
+        budgets = self.configs.stage_budgets
+        budget = budgets['compile'] + budgets['execute'] if budgets['compile'] > 0 and budgets['execute'] > 0 else None
+        return (deadline or Deadline(None)).for_stage('build', budget)
 
     def get_test_case_relative_path(self, test_case_path):
         test_case_relative_path = test_case_path.split('/src/test/java/')[1]
@@ -206,174 +671,50 @@ class TestCaseRunner():
         test_suffix = 'Test'
         test_case_relative_path = self.get_test_case_relative_path(test_case_path)
 
-        # jacoco java.html report contains java code lines with tags.
-        jacoco_java_html_report_path = self.get_jacoco_java_html_report_path(base_path, test_case_relative_path, org_name, test_suffix)
-
-        if not os.path.exists(jacoco_java_html_report_path):
-            logger.warning(f'[WARNING] Jacoco report not found: {jacoco_java_html_report_path}')
+        report = self.load_jacoco_report(base_path)
+        if report is None:
+            logger.warning(f'[WARNING] Jacoco report not found: {jacoco_coverage.report_path(base_path)}')
             return None, None
 
+        # e.g. org/example/utils/CollectionUtils, the class the test case is named after
+        focal_class_name = self.get_jacoco_class_name(test_case_relative_path, org_name, test_suffix)
+
         # will be used for analyze_coverage_with_target_coverage(). will be used to count the target coverage's coverage
-        cov_lines, uncov_lines = self.get_lines_coverage(jacoco_java_html_report_path)
+        lines_coverage = report.lines_coverage(f'{focal_class_name}.java')
+        if lines_coverage is None:
+            logger.warning(f'[WARNING] {focal_class_name}.java not found in the Jacoco report of {base_path}')
+            return None, None
+        cov_lines, uncov_lines = lines_coverage
         with open(f'{self.configs.project_dir}/{focal_file_path}', 'r', encoding='utf8') as f:
             focal_file = f.readlines()
-        for line in cov_lines:
-            if focal_file[line - 1].strip() != '}':
-                focal_file[line - 1] = "<COVER>" + focal_file[line - 1]
+        focal_file = self.mark_covered_lines(focal_file, cov_lines)
 
         # will be used for analyze_coverage_with_target_focal_method(). directly use the focal method's coverage counted by jacoco
-        jacoco_html_report_path = jacoco_java_html_report_path.replace('.java.html', '.html')
-
-        # TODO: optimize this. here, in lambda, target_coverage_idx=171, focal method name is 'Index.Z::::get(com.jnape.palatable.lambda.adt.hlist.HList.HCons<Target, ?>)'. will throw "/evosuite_pp/rag_tester/data/raw_data/repos_removing_test/lambda/target/site/jacoco/com.jnape.palatable.lambda.adt.hlist/Index.html" not such file.
-        if not os.path.exists(jacoco_html_report_path):
-            logger.warning(f'[WARNING] Jacoco report not found: {jacoco_html_report_path}. But Jacoco java.html report is found: {jacoco_java_html_report_path}')
+        # TODO: optimize this. here, in lambda, target_coverage_idx=171, focal method name is 'Index.Z::::get(com.jnape.palatable.lambda.adt.hlist.HList.HCons<Target, ?>)'. the class com/jnape/palatable/lambda/adt/hlist/Index is not in the report.
+        fm_cov_statistic_by_jacoco = report.method_statistic(focal_class_name, focal_method_name_parameter)
+        if fm_cov_statistic_by_jacoco is None:
+            logger.warning(f'[WARNING] Class {focal_class_name} not found in the Jacoco report, but its source file is')
             return None, None
-        #
-
-        fm_cov_statistic_by_jacoco = self.get_focal_method_coverage_statistic_by_jacoco(focal_method_name_parameter, jacoco_html_report_path)
 
         return focal_file, fm_cov_statistic_by_jacoco
 
-    # copy from /bernard/dataset_construction/human_written_tests/v2/utils.py
-    def get_jacoco_java_html_report_path(self, base_path, test_class_name, org_name, test_suffix):
-        # get jacoco report
-        # append_path = "spark/" if '.' not in test_class_name else "spark." + '.'.join(test_class_name.split(".")[:-1]) + '/'
-        append_path = org_name + "/" if '.' not in test_class_name else org_name + "." + '.'.join(test_class_name.split(".")[:-1]) + '/'
+    def load_jacoco_report(self, base_path):
+        xml_path = jacoco_coverage.report_path(base_path)
+        if not os.path.exists(xml_path) and os.path.exists(f'{base_path}/target/jacoco.exec'):
+            # execution data without an XML report, e.g. the report goal only writes HTML: one report pass for the XML
+            try:
+                self.run_build(['mvn', '-q', 'jacoco:report'], base_path, self.build_env(),
+                               deadline=Deadline(None).for_stage('coverage', self.configs.stage_budgets['coverage']))
+            except DeadlineExceeded as e:
+                logger.warning(f'{e}: {base_path}')
+        return jacoco_coverage.load_report(xml_path)
+
+    def get_jacoco_class_name(self, test_class_name, org_name, test_suffix):
+        # same naming as the HTML report pages: the package of the test, and the test class without its suffix
+        package = org_name if '.' not in test_class_name else org_name + "." + '.'.join(test_class_name.split(".")[:-1])
         suff_len = len(test_suffix)
-        html_name = test_class_name.split(".")[-1][:suff_len * -1] + ".java.html" # changes from -4 to -5 depending on whether it's Test or Tests
-        
-        jacoco_path = base_path + "/target/site/jacoco/" + append_path + html_name
-        return jacoco_path
+        class_name = test_class_name.split(".")[-1][:suff_len * -1]  # changes from -4 to -5 depending on whether it's Test or Tests
+        return package.replace('.', '/') + '/' + class_name
 
-    # copy from /bernard/dataset_construction/human_written_tests/v2/utils.py
     def get_lines_coverage(self, jacoco_java_html_report_path):
-        with open(jacoco_java_html_report_path, encoding='utf8') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-            # find all spans with class 'fc' or 'pc' or 'bpc', and extract the ID
-            cov_lines = []
-            uncov_lines = []
-            for span in soup.find_all('span', class_=['fc', 'pc', 'bpc', 'nc']):
-                if span['class'][0] == 'nc':
-                    uncov_lines.append(int(span['id'][1:]))
-                else:
-                    cov_lines.append(int(span['id'][1:]))
-        
-        return cov_lines, uncov_lines
-    
-
-    def get_focal_method_coverage_statistic_by_jacoco(self, focal_method_name_param, jacoco_html_report_path):
-        with open(jacoco_html_report_path, encoding='utf8') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-
-        # example: focal_method_name_param is intersectionDistinct(java.util.Collection<T>,java.util.Collection<T>,java.util.Collection<T>[]). to match intersectionDistinct(Collection, Collection, Collection[])
-        # example: valuesOfKeys(java.util.Map<K, V>,K[]) to match valuesOfKeys(Map, Object[])
-        # example: groupingBy(java.util.function.Function<? super T, ? extends K>,java.util.function.Function<? super T, ? extends R>) to match groupingBy(Function, Function)
-        # example: filter(java.util.Map<K, V>,cn.hutool.core.lang.Filter<java.util.Map.Entry<K, V>>) to match filter(Map, Filter)
-        target_fm_name = focal_method_name_param.strip().split('(')[0]
-        target_fm_params_str = focal_method_name_param.strip().split('(')[1][:-1]
-        target_fm_params_str = self.remove_angle_brackets_substrings(target_fm_params_str)
-        target_fm_params = [each_param.strip() for each_param in target_fm_params_str.split(',')]
-        target_fm_params = [each_param.split('.')[-1] if '.' in each_param else each_param for each_param in target_fm_params]
-
-        cov_stat = {}
-
-        candidates = []
-        table = soup.find('tbody')
-        for each_tr in table.find_all('tr'):
-            # check the method name
-            candidate_all_column = each_tr.find_all('td')
-
-            method_name = candidate_all_column[0].text
-            candidate_fm_name = method_name.strip().split('(')[0]
-            if candidate_fm_name != target_fm_name:
-                continue
-            
-            candidates.append(candidate_all_column)
-
-        if len(candidates) == 0:
-            logger.warning('[WARNING] Cannot find the focal method in the jacoco report. Need manual check\n', f'focal_method_name: {focal_method_name_param}\n\n')
-            cov_stat['raw_html'] = str(soup)
-            return cov_stat        
-
-        if len(candidates) > 1:
-            all_column = self.select_focal_method_coverage_statistic_by_jacoco(target_fm_params, candidates)
-        else:
-            all_column = candidates[0]
-
-        if all_column is not None:
-            # parse the result
-            cov_stat['number_of_lines'] = int(all_column[8].text.strip())
-            cov_stat['number_of_branches'] = int(all_column[6].text.strip()) - 1
-            cov_stat['line_coverage'] = float(all_column[2].text.strip()[:-1])  # remove the '%'
-            branch_cov = all_column[4].text.strip()
-            cov_stat['branch_coverage'] = float(branch_cov[:-1]) if branch_cov != 'n/a' else branch_cov
-        else:
-            logger.warning('[WARNING] Cannot find the focal method in the jacoco report. Need manual check\n', f'focal_method_name: {focal_method_name_param}\n\n')
-            cov_stat['raw_html'] = str(soup)
-
-        return cov_stat
-
-    def select_focal_method_coverage_statistic_by_jacoco(self, target_fm_params, candidates):
-        # filter according to the number of parameters
-        filter_candidates = []
-        for each_candidate in candidates:
-            method_name = each_candidate[0].text
-
-            candidate_fm_params = [each_param.strip() for each_param in method_name.strip().split('(')[1][:-1].split(',')]
-            if len(target_fm_params) == len(candidate_fm_params):
-                filter_candidates.append(each_candidate)
-        
-        if len(filter_candidates) == 1:
-            all_column = filter_candidates[0]
-            return all_column
-
-        # filter according to the detailed parameters
-        all_column = None
-
-        for each_candidate in filter_candidates:
-            method_name = each_candidate[0].text
-
-            candidate_fm_params = [each_param.strip() for each_param in method_name.strip().split('(')[1][:-1].split(',')]
-            is_match = True
-            for idx in range(len(target_fm_params)):
-                if target_fm_params[idx] != candidate_fm_params[idx]:
-                    is_match = False
-                    break
-
-            if is_match:
-                all_column = each_candidate
-                return all_column
-
-        # for corner case such as: valuesOfKeys(java.util.Map<K, V>,K[]) to match valuesOfKeys(Map, Object[]). need to transform K to Object
-        if all_column is None:  
-            for each_candidate in filter_candidates:
-                method_name = each_candidate[0].text
-
-                candidate_fm_params = [each_param.strip() for each_param in method_name.strip().split('(')[1][:-1].split(',')]
-                is_match = True
-                for idx in range(len(target_fm_params)): 
-                    if target_fm_params[idx] != candidate_fm_params[idx]:
-                        change_to_object = re.sub(r'[A-Za-z]', 'Object', target_fm_params[idx])
-                        if change_to_object == candidate_fm_params[idx]:  # add this to check the corner case
-                            continue
-                        else:
-                            is_match = False
-                            break
-
-                if is_match:
-                    all_column = each_candidate
-                    break
-
-        return all_column
-
-    def remove_angle_brackets_substrings(self, input_string):
-        # Define the regular expression pattern to match substrings within angle brackets, including nested ones
-        pattern = re.compile(r"<[^<>]*>")
-        
-        while True:
-            # Remove all substrings that match the pattern
-            input_string, count = pattern.subn('', input_string)
-            if count == 0:
-                break
-        
-        return input_string
\ No newline at end of file
+        return jacoco_coverage.lines_coverage_from_html_path(jacoco_java_html_report_path) or ([], [])
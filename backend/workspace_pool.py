@@ -0,0 +1,349 @@
+import hashlib
+import logging
+import os
+import posixpath
+import shutil
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from core.exceptions import GenerationCancelled
+from user_config import global_config
+
+logger = logging.getLogger(__name__)
+
+# leases taken within this many seconds of a scan of the original (the candidates of one beam) reuse it
+MANIFEST_REUSE_SECONDS = 1.0
+# build output that only depends on the synced sources and survives a lease; Maven recompiles what changed
+KEPT_BUILD_OUTPUT = ('classes',)
+
+
+def is_build_dir(parent: str, name: str) -> bool:
+    # Maven output next to a pom.xml; it is copied once and then owned by the workspace's own builds
+    return name == 'target' and os.path.exists(os.path.join(parent, 'pom.xml'))
+
+
+def _same_file(src_stat: os.stat_result, dst_stat: os.stat_result) -> bool:
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    # a copy made because hard links were not possible keeps size and mtime (copy2)
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:  # other file system, or links not supported
+        shutil.copy2(src, dst)
+
+
+def _remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def project_manifest(project_dir: str) -> Dict[str, Tuple[int, int]]:
+    """Size and mtime of every project file except .git and build output, keyed by '/'-separated relative path."""
+    manifest = {}
+    for root, dirs, files in os.walk(project_dir):
+        dirs[:] = [each for each in dirs if each != '.git' and not is_build_dir(root, each)]
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # removed while scanning, or a dangling link
+                continue
+            manifest[os.path.relpath(path, project_dir).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime_ns)
+    return manifest
+
+
+def sources_fingerprint(manifest: Dict[str, Tuple[int, int]], exclude: Optional[str] = None) -> str:
+    """Hash of the path, size and mtime of every file of `manifest` except the relative path `exclude`."""
+    sha1 = hashlib.sha1()
+    for rel in sorted(manifest):
+        if rel != exclude:
+            size, mtime_ns = manifest[rel]
+            sha1.update(f'{rel}\0{size}\0{mtime_ns}\n'.encode('utf8', errors='surrogateescape'))
+    return sha1.hexdigest()
+
+
+# path -> workspace, for the workspaces currently leased
+_leased: Dict[str, 'Workspace'] = {}
+_leased_lock = threading.Lock()
+
+
+def leased_workspace(path: str) -> Optional['Workspace']:
+    """The leased workspace that `path` is in, if any."""
+    with _leased_lock:
+        for workspace_path, workspace in _leased.items():
+            if path == workspace_path or path.startswith(workspace_path + '/'):
+                return workspace
+    return None
+
+
+class Workspace:
+    """One private copy of a project. Sources are hard links to the original, build output is a real copy.
+
+    The workspace remembers the manifest of the original it was last synced to, so the next sync only relinks the
+    files that changed since, and the mtimes of its directories, so releasing it only lists the directories a lease
+    added something to.
+    """
+
+    def __init__(self, source_dir: str, path: str):
+        self.source_dir = source_dir
+        self.path = path
+        self.manifest: Optional[Dict[str, Tuple[int, int]]] = None  # None: state unknown, sync walks everything
+        self._dir_mtimes: Dict[str, int] = {}
+        self._fingerprints: Dict[Tuple[str, Optional[str]], str] = {}
+
+    def map_path(self, source_path: str) -> str:
+        """Translate a path inside the original project into the same path inside this workspace."""
+        return self.path + source_path[len(self.source_dir):]
+
+    def sync(self, manifest: Optional[Dict[str, Tuple[int, int]]] = None) -> None:
+        """Make the sources match `manifest`, a scan of the original (scanned now when not given).
+
+        Nothing is written through the links: the generated test is written as a new file (see
+        TestCaseRunner.compile_and_execute_test_case) and Maven only writes below target/, which is not linked.
+        """
+        if manifest is None:
+            manifest = project_manifest(self.source_dir)
+        if self.manifest is None:
+            self._sync_all()
+        else:
+            self._sync_changes(self.manifest, manifest)
+        self.manifest = manifest
+        self._fingerprints = {}
+        self._dir_mtimes = {}
+        for rel in self._dirs():
+            try:
+                self._dir_mtimes[rel] = os.stat(self._abs(rel)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+
+    def fingerprint(self, project_dir: str, exclude_path: Optional[str] = None) -> str:
+        """`sources_fingerprint` of the files below `project_dir` (this workspace or a module in it) as of the last sync.
+
+        Computed once per sync: a lease only changes the sources by syncing, everything else it writes is its own.
+        """
+        prefix = os.path.relpath(project_dir, self.path).replace(os.sep, '/')
+        prefix = '' if prefix == '.' else prefix + '/'
+        exclude = os.path.relpath(exclude_path, project_dir).replace(os.sep, '/') if exclude_path else None
+        key = (prefix, exclude)
+        if key not in self._fingerprints:
+            files = {rel[len(prefix):]: value for rel, value in self.manifest.items() if rel.startswith(prefix)}
+            self._fingerprints[key] = sources_fingerprint(files, exclude)
+        return self._fingerprints[key]
+
+    def reset(self) -> None:
+        """Undo a lease: delete what it added next to the sources and restore build output other than target/classes."""
+        expected: Dict[str, Set[str]] = {}
+        for rel in list(self.manifest) + list(self._dirs()):
+            if rel:
+                parent, name = posixpath.split(rel)
+                expected.setdefault(parent, set()).add(name)
+        for rel, mtime in self._dir_mtimes.items():
+            dst_dir = self._abs(rel)
+            try:
+                if os.stat(dst_dir).st_mtime_ns == mtime:
+                    continue
+                names = os.listdir(dst_dir)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name in expected.get(rel, ()) or name == '.git' or is_build_dir(dst_dir, name):
+                    continue
+                if os.path.lexists(os.path.join(self.source_dir, rel, name)):
+                    continue  # an empty directory of the original
+                _remove(os.path.join(dst_dir, name))
+        for rel in self._dirs():
+            if posixpath.join(rel, 'pom.xml') in self.manifest:
+                self._reset_build_dir(posixpath.join(rel, 'target'))
+
+    def _sync_changes(self, old: Dict[str, Tuple[int, int]], new: Dict[str, Tuple[int, int]]) -> None:
+        for rel, value in new.items():
+            if old.get(rel) == value:
+                continue
+            dst = self._abs(rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            try:
+                os.remove(dst)
+            except FileNotFoundError:
+                pass
+            try:
+                _link_or_copy(os.path.join(self.source_dir, rel), dst)
+            except FileNotFoundError:  # removed from the original since the scan; the next sync sees it gone
+                pass
+        for rel in old.keys() - new.keys():
+            try:
+                os.remove(self._abs(rel))
+            except FileNotFoundError:
+                pass
+
+    def _reset_build_dir(self, rel: str) -> None:
+        dst_dir, src_dir = self._abs(rel), os.path.join(self.source_dir, rel)
+        if not os.path.isdir(dst_dir):
+            return
+        for name in os.listdir(dst_dir):
+            if name in KEPT_BUILD_OUTPUT:
+                continue
+            _remove(os.path.join(dst_dir, name))
+            src = os.path.join(src_dir, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(dst_dir, name), symlinks=True)
+            elif os.path.exists(src):
+                shutil.copy2(src, os.path.join(dst_dir, name))
+
+    def _dirs(self) -> Set[str]:
+        # the directories holding the original's files, '' for the project root
+        dirs = {''}
+        for rel in self.manifest:
+            parent = posixpath.dirname(rel)
+            while parent not in dirs:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+        return dirs
+
+    def _abs(self, rel: str) -> str:
+        return os.path.join(self.path, rel) if rel else self.path
+
+    def _sync_all(self) -> None:
+        # a new workspace, or one left by an earlier server run: compare every file with the original
+        for src_root, dirs, files in os.walk(self.source_dir):
+            dst_root = self.map_path(src_root)
+            os.makedirs(dst_root, exist_ok=True)
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for name in [each for each in dirs if is_build_dir(src_root, each)]:
+                dirs.remove(name)
+                if not os.path.exists(os.path.join(dst_root, name)):
+                    # start from the original's compiled classes rather than an empty target/
+                    shutil.copytree(os.path.join(src_root, name), os.path.join(dst_root, name), symlinks=True)
+
+            for name in files:
+                src, dst = os.path.join(src_root, name), os.path.join(dst_root, name)
+                src_stat = os.stat(src)
+                try:
+                    if _same_file(src_stat, os.stat(dst)):
+                        continue
+                    os.remove(dst)
+                except FileNotFoundError:
+                    pass
+                _link_or_copy(src, dst)
+
+            expected = set(dirs) | set(files)
+            for name in os.listdir(dst_root):
+                if name in expected or name == '.git' or is_build_dir(dst_root, name):
+                    continue
+                _remove(os.path.join(dst_root, name))
+
+
+class WorkspacePool:
+    """Up to `max_size` workspaces of one project, leased to one session (or beam candidate) at a time."""
+
+    def __init__(self, source_dir: str, pool_dir: str, max_size: int):
+        self.source_dir = source_dir
+        self.pool_dir = pool_dir
+        self.max_size = max_size
+        self._idle: List[Workspace] = []
+        self._created = 0
+        self._cond = threading.Condition()
+        self._manifest: Optional[Dict[str, Tuple[int, int]]] = None
+        self._manifest_at = 0.0
+        self._manifest_lock = threading.Lock()
+        # workspaces left on disk by an earlier server run are reused
+        if os.path.isdir(pool_dir):
+            for name in sorted(os.listdir(pool_dir)):
+                if name.isdigit() and self._created < max_size:
+                    self._idle.append(Workspace(source_dir, os.path.join(pool_dir, name)))
+                    self._created += 1
+
+    @contextmanager
+    def lease(self, should_stop: Optional[Callable[[], bool]] = None, block: bool = True) -> Iterator[Optional[Workspace]]:
+        """Yield a workspace synced with the original, or None when `block` is False and all are in use."""
+        workspace = self._acquire(should_stop, block)
+        if workspace is None:
+            yield None
+            return
+        try:
+            start = time.time()
+            workspace.sync(self._source_manifest())
+            logger.debug(f'Synced workspace {workspace.path} in {time.time() - start:.2f}s')
+            with _leased_lock:
+                _leased[workspace.path] = workspace
+            yield workspace
+        finally:
+            with _leased_lock:
+                _leased.pop(workspace.path, None)
+            try:
+                if workspace.manifest is not None:
+                    workspace.reset()
+            except OSError as e:
+                logger.warning(f'Could not reset workspace {workspace.path}, it will be synced in full: {e}')
+                workspace.manifest = None
+            with self._cond:
+                self._idle.append(workspace)
+                self._cond.notify()
+
+    def prebuild(self, count: int) -> None:
+        """Create and sync up to `count` workspaces in the background so the first sessions do not wait for the copy."""
+        def build():
+            with ExitStack() as leases:
+                for _ in range(count):
+                    if leases.enter_context(self.lease(block=False)) is None:
+                        break
+
+        threading.Thread(target=build, name=f'prebuild-{os.path.basename(self.source_dir)}', daemon=True).start()
+
+    def _source_manifest(self) -> Dict[str, Tuple[int, int]]:
+        with self._manifest_lock:
+            if self._manifest is None or time.monotonic() - self._manifest_at > MANIFEST_REUSE_SECONDS:
+                self._manifest = project_manifest(self.source_dir)
+                self._manifest_at = time.monotonic()
+            return self._manifest
+
+    def _acquire(self, should_stop: Optional[Callable[[], bool]], block: bool) -> Optional[Workspace]:
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.max_size:
+                    self._created += 1
+                    return Workspace(self.source_dir, os.path.join(self.pool_dir, str(self._created - 1)))
+                if not block:
+                    return None
+                if should_stop and should_stop():
+                    raise GenerationCancelled()
+                self._cond.wait(timeout=0.5)
+
+
+class WorkspacePools:
+    """Process-wide registry of workspace pools keyed by the original project directory."""
+
+    def __init__(self, max_per_project: int, prebuilt: int):
+        self.max_per_project = max_per_project
+        self.prebuilt = prebuilt
+        self._pools: Dict[str, WorkspacePool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, source_dir: str, pool_root: str) -> WorkspacePool:
+        source_dir = os.path.abspath(source_dir).replace('\\', '/')
+        with self._lock:
+            pool = self._pools.get(source_dir)
+            if pool is None:
+                # the same project name can live in several places, so the pool directory includes a hash of the path
+                digest = hashlib.sha1(source_dir.encode('utf-8')).hexdigest()[:8]
+                pool = WorkspacePool(source_dir, f'{pool_root}/{os.path.basename(source_dir)}-{digest}', self.max_per_project)
+                self._pools[source_dir] = pool
+                if self.prebuilt > 0:
+                    pool.prebuild(self.prebuilt)
+            return pool
+
+
+workspace_pools = WorkspacePools(
+    max_per_project=global_config.getint('workspace', 'max_per_project', fallback=8),
+    prebuilt=global_config.getint('workspace', 'prebuilt', fallback=2),
+)
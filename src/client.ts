@@ -1,22 +1,33 @@
 // create a python subprocess and communicate with it through network
-import { request, RequestOptions, ClientRequest } from 'http';
+import { request, RequestOptions, ClientRequest, IncomingMessage } from 'http';
 
 export class TesterSession {
+    // reconnections tried after a dropped stream before the session is given up, and the wait before each
+    private static readonly MAX_RESUME_ATTEMPTS = 5;
+    private static readonly RESUME_DELAY_MS = 1000;
     private updateMessageCallback?: (...args: any[]) => any;
     private errorCallbcak?: (...args: any[]) => any;
     private showNoRefMsg?: (...args: any[]) => any;
+    private partialMessageCallback?: (index: number, content: string) => any;
     private connectToPort: number;
     private currentRequest?: ClientRequest;
     private finishActiveRequest?: () => void;
     private isCancelling = false;
     private activeSessionId?: string;
+    // conversation rebuilt from `msg_delta` updates, and the last sequence number applied
+    private messages: any[] = [];
+    private lastSeq = 0;
+    // assistant message still being streamed by `msg_chunk` updates
+    private partial?: { index: number, content: string };
+    private resumeAttempts = 0;
     
     // setting connectToPort to 0 to start up an internal server
-    constructor(updateMessageCallback?: (...args: any[]) => any, errorCallback?: (...args: any[]) => any, showNoRefMsg?: (...args: any[]) => any, connectToPort: number = 0) {
+    constructor(updateMessageCallback?: (...args: any[]) => any, errorCallback?: (...args: any[]) => any, showNoRefMsg?: (...args: any[]) => any, connectToPort: number = 0, partialMessageCallback?: (index: number, content: string) => any) {
         this.updateMessageCallback = updateMessageCallback;
         this.errorCallbcak = errorCallback;
         this.showNoRefMsg = showNoRefMsg;
         this.connectToPort = connectToPort;
+        this.partialMessageCallback = partialMessageCallback;
     }
 
     async changeJunitVersion(version: string) {
@@ -58,11 +69,29 @@ export class TesterSession {
     async startQuery(args: any, cancelCb: (e: any) => any) {
         const requestData = new TextEncoder().encode(JSON.stringify({ type: 'query', data: args }) + '\n');
         this.activeSessionId = undefined;
+        this.messages = [];
+        this.lastSeq = 0;
+        this.partial = undefined;
+        this.resumeAttempts = 0;
 
+        let finish: (value?: any) => void;
+        const finishePromise = new Promise<void>((res) => { finish = res; });
+        this.finishActiveRequest = () => {
+            finish();
+            this.resetRequestState();
+        };
+        this.isCancelling = false;
+        this.sendStreamRequest('/session', requestData, cancelCb);
+        await finishePromise;
+        this.resetRequestState();
+    }
+
+    // POST to /session or /session/resume and apply the streamed messages; a connection dropped before 'finish' is resumed
+    private sendStreamRequest(path: string, requestData: Uint8Array, cancelCb: (e: any) => any): void {
         const options: RequestOptions = {
             hostname: 'localhost',
             port: this.connectToPort,
-            path: '/session',
+            path: path,
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -70,90 +99,165 @@ export class TesterSession {
             }
         };
 
-        let finish: (value?: any) => void;
-        const finishePromise = new Promise<void>((res) => { finish = res; });
-        this.finishActiveRequest = () => {
-            finish();
-            this.resetRequestState();
+        let dropped = false;
+        const onDropped = () => {
+            if (dropped || this.isCancelling) {
+                return;
+            }
+            dropped = true;
+            this.resumeSession(cancelCb);
         };
-        this.isCancelling = false;
         const req = request(options, (res) => {
-            let status = 'before-start';
-
+            if (res.statusCode === 503) {
+                // server-side generation queue is full
+                const retryAfter = res.headers['retry-after'];
+                cancelCb(new Error(`Server is busy, retry after ${retryAfter ?? 'a while'} seconds.`));
+                res.resume();
+                this.finishActiveRequest?.();
+                return;
+            }
+            if (res.statusCode === 404 && path === '/session/resume') {
+                // the session ended, or stayed detached longer than the server's grace period
+                cancelCb(new Error('Lost the connection to the backend session.'));
+                res.resume();
+                this.activeSessionId = undefined;
+                this.finishActiveRequest?.();
+                return;
+            }
             if (res.statusCode !== 200) {
                 throw new Error('Failed request from server.');
             }
+            this.consumeStream(res, cancelCb, onDropped);
+        });
+        this.currentRequest = req;
 
-            res.on('data', (chunk) => {
-                try {
-                    const msg = JSON.parse(chunk.toString());
-                    if (status === 'before-start') {
-                        // confirm start
-                        if (!(msg.type && msg.data && msg.type === 'status' && msg.data.status === 'start')) {
-                            throw TypeError('Failed to receive start message');
-                        }
-                        this.activeSessionId = msg.data.session_id;
-                        status = 'started';
-                    } else if (status !== 'finished') {
-                        // receive messages
-                        if (msg.type && msg.data) {
-                            if (msg.type === 'status' && msg.data.status === 'finish') {
-                                status = 'finished';
-                                this.activeSessionId = undefined;
-                                this.finishActiveRequest?.();
-                                return;
-                            } else if (msg.type === 'msg' && msg.data.session_id && msg.data.messages) {
-                                if (this.updateMessageCallback) {
-                                    this.updateMessageCallback(msg.data.messages);
-                                }
-                            } else if (msg.type === 'noreference' && msg.data.session_id) {
-                                const junit_version = msg.data.junit_version;
-                                if (this.showNoRefMsg) {
-                                    this.showNoRefMsg(junit_version);
-                                }
-                            } else {
-                                throw TypeError('Invalid message type');
+        req.on('error', (e) => {
+            if (this.isCancelling) {
+                return;
+            }
+            console.error(`Problem on request: ${e}`);
+            onDropped();
+        });
+        req.write(requestData);
+        req.end();
+    }
+
+    private consumeStream(res: IncomingMessage, cancelCb: (e: any) => any, onDropped: () => void): void {
+        let status = 'before-start';
+
+        const handleLine = (line: string) => {
+            try {
+                const msg = JSON.parse(line);
+                if (status === 'before-start') {
+                    // confirm start
+                    if (!(msg.type && msg.data && msg.type === 'status' && msg.data.status === 'start')) {
+                        throw TypeError('Failed to receive start message');
+                    }
+                    this.activeSessionId = msg.data.session_id;
+                    this.resumeAttempts = 0;
+                    status = 'started';
+                } else if (status !== 'finished') {
+                    // receive messages
+                    if (msg.type && msg.data) {
+                        if (msg.type === 'status' && msg.data.status === 'finish') {
+                            status = 'finished';
+                            this.activeSessionId = undefined;
+                            this.finishActiveRequest?.();
+                            return;
+                        } else if (msg.type === 'msg_delta' && msg.data.session_id && msg.data.messages) {
+                            this.applyMessageDelta(msg.data);
+                            if (this.updateMessageCallback) {
+                                this.updateMessageCallback(this.messages.slice());
+                            }
+                        } else if (msg.type === 'msg_chunk' && msg.data.session_id) {
+                            this.applyMessageChunk(msg.data);
+                        } else if (msg.type === 'msg' && msg.data.session_id && msg.data.messages) {
+                            if (this.updateMessageCallback) {
+                                this.updateMessageCallback(msg.data.messages);
+                            }
+                        } else if (msg.type === 'status' && msg.data.status === 'queued') {
+                            console.log(`Session queued at position ${msg.data.message.position}`);
+                        } else if (msg.type === 'status' && msg.data.status === 'timeout') {
+                            // the server stopped the session once its time budget ran out; 'finish' follows
+                            console.warn(`Session timed out in the ${msg.data.message.stage} stage (budget ${msg.data.message.budget}s)`);
+                        } else if (msg.type === 'status' && msg.data.status === 'build_progress') {
+                            for (const line of msg.data.message.lines ?? []) {
+                                console.log(`[build] ${line}`);
+                            }
+                            return;
+                        } else if (msg.type === 'noreference' && msg.data.session_id) {
+                            const junit_version = msg.data.junit_version;
+                            if (this.showNoRefMsg) {
+                                this.showNoRefMsg(junit_version);
                             }
                         } else {
-                            throw TypeError('Invalid message format');
+                            throw TypeError('Invalid message type');
                         }
-                        console.log(msg);
-                    }
-                    
-                } catch (e) {
-                    if (!this.isCancelling) {
-                        console.error(e);
-                        cancelCb(e);
+                    } else {
+                        throw TypeError('Invalid message format');
                     }
+                    console.log(msg);
                 }
-            });
 
-            res.on('end', () => {
-                console.log('No more data in response.');
+            } catch (e) {
                 if (!this.isCancelling) {
-                    this.resetRequestState();
+                    console.error(e);
+                    cancelCb(e);
                 }
-            });
+            }
+        };
 
-            res.on('error', (e) => {
-                if (this.isCancelling) {
-                    return;
+        // messages are newline-delimited and may arrive merged into one chunk or split across several
+        let pending = '';
+        res.setEncoding('utf8');
+        res.on('data', (chunk: string) => {
+            const lines = (pending + chunk).split('\n');
+            pending = lines.pop() ?? '';
+            for (const line of lines) {
+                if (line.trim()) {
+                    handleLine(line);
                 }
-                console.error(e);
-            });
+            }
         });
-        this.currentRequest = req;
 
-        req.on('error', (e) => {
+        res.on('end', () => {
+            console.log('No more data in response.');
+            if (pending.trim()) {
+                handleLine(pending);
+                pending = '';
+            }
+            if (status !== 'finished') {
+                onDropped();
+            }
+        });
+
+        res.on('error', (e) => {
             if (this.isCancelling) {
                 return;
             }
-            console.error(`Problem on request: ${e}`);
+            console.error(e);
+            onDropped();
         });
-        req.write(requestData);
-        req.end();
-        await finishePromise;
-        this.resetRequestState();
+    }
+
+    // reconnect to the running session and ask for the messages after the last one applied
+    private resumeSession(cancelCb: (e: any) => any): void {
+        if (!this.finishActiveRequest) {
+            return;
+        }
+        if (!this.activeSessionId || this.resumeAttempts >= TesterSession.MAX_RESUME_ATTEMPTS) {
+            cancelCb(new Error('Lost the connection to the backend.'));
+            this.finishActiveRequest();
+            return;
+        }
+        this.resumeAttempts++;
+        console.warn(`Connection lost, resuming session ${this.activeSessionId} after seq ${this.lastSeq}`);
+        const payload = new TextEncoder().encode(JSON.stringify({ session_id: this.activeSessionId, last_seq: this.lastSeq }));
+        setTimeout(() => {
+            if (!this.isCancelling && this.finishActiveRequest) {
+                this.sendStreamRequest('/session/resume', payload, cancelCb);
+            }
+        }, TesterSession.RESUME_DELAY_MS);
     }
 
     public cancelCurrentQuery(): void {
@@ -170,6 +274,23 @@ export class TesterSession {
         await this.sendStopSignal();
     }
 
+    private applyMessageChunk(chunk: { index: number, offset: number, text: string }): void {
+        const previous = this.partial?.index === chunk.index ? this.partial.content : '';
+        this.partial = { index: chunk.index, content: previous.slice(0, chunk.offset) + chunk.text };
+        if (this.partialMessageCallback) {
+            this.partialMessageCallback(chunk.index, this.partial.content);
+        }
+    }
+
+    private applyMessageDelta(delta: { seq: number, length: number, messages: any[] }): void {
+        this.partial = undefined;
+        this.messages.length = delta.length;
+        for (const entry of delta.messages) {
+            this.messages[entry.index] = { role: entry.role, content: entry.content };
+        }
+        this.lastSeq = delta.seq;
+    }
+
     private resetRequestState(): void {
         this.currentRequest = undefined;
         this.finishActiveRequest = undefined;
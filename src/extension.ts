@@ -133,7 +133,11 @@ async function generateTest(focalMethod: string, focalFile: string, testDesc: st
         (junit_version) => {
             vscode.window.showInformationMessage('No referable test cases. Generating target test case without reference... JUnit version of ' + junit_version + ' is used. If you want to change the JUnit version, please use the command "IntentionTest: Change JUnit Version".');
         },
-        connectToPort
+        connectToPort,
+        (_index: number, content: string) => {
+            // preview of the reply being generated, replaced by the full message once it arrives
+            ui.showMessage({ cmd: 'partial', content });
+        }
     );
     activeSession = session;
     await sendSessionState(ui, 'running');
@@ -283,6 +283,22 @@ function completeTypingAnimation(message, sender, options = {}) {
     return typingElement;
 }
 
+function updateTypingPreview(text) {
+    const typingElement = document.querySelector('.message.typing');
+    if (!typingElement) {
+        return;
+    }
+    let preview = typingElement.querySelector('pre.streaming-preview');
+    if (!preview) {
+        typingElement.innerHTML = '';
+        preview = document.createElement('pre');
+        preview.className = 'streaming-preview';
+        typingElement.appendChild(preview);
+    }
+    preview.textContent = text;
+    maybeAutoScroll();
+}
+
 function removeTypingAnimation() {
     const typingElement = document.querySelector('.message.typing');
     if (typingElement) {
@@ -340,5 +356,7 @@ function handleIncomingMessage(event) {
         console.error('[IntentionTest] Webview error message received:', msg);
     } else if (msg.cmd === 'clear') {
         trimConversationTo(msg.toIndex ?? 0);
+    } else if (msg.cmd === 'partial') {
+        updateTypingPreview(msg.content ?? '');
     }
 }